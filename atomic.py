@@ -0,0 +1,34 @@
+"""
+atomic.py
+
+Atomic file replacement, shared by everything that writes files another
+process may be reading at the same time: the page cache, the manifest, the
+code database and Home Assistant packages.
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+from typing import IO, Any, Iterator
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = 'w', **open_args: Any) -> Iterator[IO[Any]]:
+    """
+    Opens a temporary file next to path and moves it over path once the
+    block finishes, so readers only ever see the old file or the whole new
+    one. The temporary name includes the process and thread, so concurrent
+    writers never share one. If the block raises, the temporary file is
+    removed and path is left as it was.
+    """
+    temp_path: str = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_path, mode, **open_args) as temp_file:
+            yield temp_file
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
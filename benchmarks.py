@@ -0,0 +1,285 @@
+"""
+benchmarks.py
+
+Times each stage of the conversion on synthetic lirc.conf files, without
+touching the network. Results are written as json so they can be stored and
+compared against later runs to catch performance regressions.
+
+    python benchmarks.py [--remotes N] [--buttons N] [--save results.json]
+                         [--baseline baseline.json] [--threshold 1.25]
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+
+import create_ha_script
+import fetch
+import lirc2broadlinkha
+import sender
+from lirc2broadlinkha import Config
+
+BIT_LENGTHS: list[int] = [8, 12, 15, 20, 24, 32, 48, 64]
+
+
+def generate_section(rng: random.Random, name: str, buttons: int) -> str:
+    """
+    Generates a single, valid, space encoded remote section with a random
+    mix of bit length, ptrail, post_data, CONST_LENGTH and gap size
+    """
+    bits: int = rng.choice(BIT_LENGTHS)
+    header: tuple[int, int] = (rng.randint(2000, 9000), rng.randint(500, 4500))
+    one: tuple[int, int] = (rng.randint(400, 1300), rng.randint(400, 1700))
+    zero: tuple[int, int] = (rng.randint(400, 700), rng.randint(400, 700))
+    ptrail: int | None = rng.choice([None, rng.randint(400, 700)])
+    const_length: bool = rng.random() < 0.5
+    post_data_bits: int = rng.choice([0, 0, 8, 16])
+
+    # The gap has to outlast the longest code when CONST_LENGTH is set.
+    # Now and then use a huge gap to exercise the 3 byte pulse encoding.
+    longest: int = sum(header) + (bits + post_data_bits) * max(sum(one), sum(zero))
+    gap: int = longest + rng.randint(10000, 60000)
+    if rng.random() < 0.2:
+        gap = rng.randint(500000, 1500000)
+
+    lines: list[str] = [
+        'begin remote',
+        f'  name  {name}',
+        f'  bits  {bits}',
+        '  flags SPACE_ENC' + ('|CONST_LENGTH' if const_length else ''),
+        '  eps  30',
+        '  aeps  100',
+        f'  header  {header[0]}  {header[1]}',
+        f'  one  {one[0]}  {one[1]}',
+        f'  zero  {zero[0]}  {zero[1]}',
+        ]
+    if ptrail:
+        lines.append(f'  ptrail  {ptrail}')
+    if post_data_bits:
+        lines.append(f'  post_data_bits  {post_data_bits}')
+        lines.append(f'  post_data  {rng.getrandbits(post_data_bits):#x}')
+    lines.append(f'  gap  {gap}')
+    lines.append(f'  min_repeat  {rng.randint(0, 5)}')
+    lines.append('  begin codes')
+    for button in range(buttons):
+        lines.append(f'    KEY_{button}  {rng.getrandbits(bits):#0{bits // 4 + 2}x}')
+    lines.append('  end codes')
+    lines.append('end remote')
+    return '\n'.join(lines) + '\n'
+
+
+def generate_conf(remotes: int, buttons: int, seed: int = 0) -> str:
+    """
+    Generates a concatenated lirc.conf file with the given number of remotes,
+    each with the given number of buttons
+    """
+    rng: random.Random = random.Random(seed)
+    return '\n'.join(
+            generate_section(rng, f'REMOTE_{remote}', buttons)
+            for remote in range(remotes)
+            )
+
+
+def time_stage(
+        stage: Callable[[Any], Any],
+        make_input: Callable[[], Any],
+        repeat: int) -> dict[str, float]:
+    """
+    Runs a stage repeat times on fresh input, as several of the functions
+    modify their input, and returns timing statistics in seconds
+    """
+    timings: list[float] = []
+    for _ in range(repeat):
+        stage_input: Any = make_input()
+        start: float = time.perf_counter()
+        stage(stage_input)
+        timings.append(time.perf_counter() - start)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'runs': repeat,
+        }
+
+
+def serve_conf(text: str) -> ThreadingHTTPServer:
+    """
+    Serves text on localhost so create_ha_script.main can be timed without
+    the network
+    """
+    body: bytes = text.encode('utf-8')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: Any) -> None:
+            pass
+
+    server: ThreadingHTTPServer = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_benchmarks(
+        remotes: int = 10,
+        buttons: int = 50,
+        repeat: int = 5,
+        seed: int = 0) -> dict[str, Any]:
+    """
+    Times every stage and returns the results along with the parameters and
+    platform they were measured with
+    """
+    text: str = generate_conf(remotes, buttons, seed)
+    parsed: Config = lirc2broadlinkha.parse_lirc(text)
+    # Pulses for every button of every section, in the shape
+    # pulses_to_broadlink_hex expects
+    all_pulses: list[tuple[lirc2broadlinkha.Pulses, int]] = []
+    for section in copy.deepcopy(parsed).values():
+        repeats: int = int(section.pop('min_repeat', 0))
+        for pulses in lirc2broadlinkha.lirc_to_pulses(section).values():
+            all_pulses.append((pulses, repeats))
+
+    stages: dict[str, dict[str, float]] = {}
+    stages['parse_lirc'] = time_stage(
+            lirc2broadlinkha.parse_lirc, lambda: text, repeat)
+    stages['lirc_to_pulses'] = time_stage(
+            lambda config: [lirc2broadlinkha.lirc_to_pulses(section)
+                            for section in config.values()],
+            lambda: copy.deepcopy(parsed), repeat)
+    stages['pulses_to_broadlink_hex'] = time_stage(
+            lambda pulse_list: [
+                lirc2broadlinkha.pulses_to_broadlink_hex(pulses, repeats)
+                for pulses, repeats in pulse_list],
+            lambda: all_pulses, repeat)
+    stages['code_to_broadlink'] = time_stage(
+            lirc2broadlinkha.code_to_broadlink,
+            lambda: copy.deepcopy(parsed), repeat)
+    if lirc2broadlinkha.load_numpy() is not None:
+        stages['code_to_broadlink_vectorized'] = time_stage(
+                lirc2broadlinkha.code_to_broadlink_vectorized,
+                lambda: copy.deepcopy(parsed), repeat)
+
+    # Sending every code to a local stand-in device, over one session
+    if sender.Cipher is not None:
+        codes: list[str] = [code for _, _, code in lirc2broadlinkha.iter_broadlink_codes(
+                copy.deepcopy(parsed).items())]
+        device: sender.FakeDevice = sender.FakeDevice()
+        code_sender: sender.Sender = sender.Sender(port=device.address[1])
+        try:
+            stages['send_codes'] = time_stage(
+                    lambda _: code_sender.send(
+                        device.address[0], '00:00:00:00:00:00', codes),
+                    lambda: None, repeat)
+        finally:
+            code_sender.close()
+            device.close()
+
+    # create_ha_script.main end to end, against a local server and without
+    # the on-disk cache
+    server: ThreadingHTTPServer = serve_conf(text)
+    url: str = f'http://127.0.0.1:{server.server_port}/bench.lircd.conf'
+    default_fetcher: fetch.ConfFetcher | None = fetch._default_fetcher
+    fetch._default_fetcher = fetch.ConfFetcher(cache_dir=None)
+    try:
+        with tempfile.TemporaryDirectory() as tempdir:
+            outfile: str = os.path.join(tempdir, 'scripts.yaml')
+            stages['create_ha_script.main'] = time_stage(
+                    lambda _: create_ha_script.main(url, 'remote.bench', outfile),
+                    lambda: None, repeat)
+    finally:
+        fetch._default_fetcher.close()
+        fetch._default_fetcher = default_fetcher
+        server.shutdown()
+        server.server_close()
+
+    return {
+        'parameters': {
+            'remotes': remotes,
+            'buttons': buttons,
+            'repeat': repeat,
+            'seed': seed,
+            'conf_bytes': len(text),
+            },
+        'platform': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            },
+        'stages': stages,
+        }
+
+
+def compare_results(
+        results: dict[str, Any],
+        baseline: dict[str, Any],
+        threshold: float = 1.25) -> list[str]:
+    """
+    Compares median timings against a baseline and returns a message for
+    every stage that is more than threshold times slower
+    """
+    regressions: list[str] = []
+    for stage, timing in results['stages'].items():
+        baseline_timing: dict[str, float] | None = baseline['stages'].get(stage)
+        if not baseline_timing or not baseline_timing['median']:
+            continue
+        ratio: float = timing['median'] / baseline_timing['median']
+        if ratio > threshold:
+            regressions.append(
+                f'{stage}: {ratio:.2f}x slower than baseline '
+                f'({timing["median"]:.6f}s vs {baseline_timing["median"]:.6f}s)'
+                )
+    return regressions
+
+
+def main(arguments: list[str]) -> int:
+    """
+    Runs the benchmarks, prints or saves the results and checks them against
+    a baseline. Returns 1 if any stage regressed.
+    """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+            description='Benchmark lirc to Broadlink conversion')
+    parser.add_argument('--remotes', type=int, default=10)
+    parser.add_argument('--buttons', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', help='File to write the json results to')
+    parser.add_argument('--baseline', help='Results file to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Slowdown ratio counted as a regression')
+    args: argparse.Namespace = parser.parse_args(arguments)
+
+    results: dict[str, Any] = run_benchmarks(
+            args.remotes, args.buttons, args.repeat, args.seed)
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions: list[str] = compare_results(
+                    results, json.load(baseline_file), args.threshold)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,225 @@
+"""
+bulk_convert.py
+
+Converts many lirc.conf files at once, spreading the work over a pool of
+processes. Takes either a local checkout of the lirc-remotes repository or a
+list of paths/urls and writes one json file per lirc.conf file, holding the
+base 64 codes of each of its remotes.
+"""
+
+import json
+import os
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from sys import argv
+from typing import Callable, Iterable
+
+from atomic import atomic_write
+from lirc2broadlinkha import (Config, encode_section, is_url, load_conf_text,
+                              parse_lirc)
+
+CONF_SUFFIX: str = '.lircd.conf'
+
+
+@dataclass
+class ConversionResult:
+    """
+    Outcome of converting a single lirc.conf file
+    """
+    source: str
+    output: str | None = None
+    buttons: int = 0
+    error: str | None = None
+
+
+def find_conf_files(root: str) -> list[str]:
+    """
+    Walks a local checkout of lirc-remotes and returns every lirc.conf file,
+    sorted so that runs are reproducible
+    """
+    conf_files: list[str] = []
+    for directory, _, files in os.walk(root):
+        for file_name in files:
+            if file_name.endswith(CONF_SUFFIX):
+                conf_files.append(os.path.join(directory, file_name))
+    return sorted(conf_files)
+
+
+def expand_sources(sources: Iterable[str]) -> list[tuple[str, str | None]]:
+    """
+    Replaces any directories in sources with the lirc.conf files inside them.
+    Returns each file with the directory it was found in, or None for files
+    and urls given directly.
+    """
+    expanded: list[tuple[str, str | None]] = []
+    for source in sources:
+        if not is_url(source) and os.path.isdir(source):
+            expanded += [(conf_file, source) for conf_file in find_conf_files(source)]
+        else:
+            expanded.append((source, None))
+    return expanded
+
+
+def output_name(source: str, root: str | None = None) -> str:
+    """
+    Relative path of the json file for a source. Local files keep their
+    position under root, urls keep the vendor directory and file name.
+    """
+    if is_url(source):
+        parts: list[str] = source.rstrip('/').split('/')
+        relative: str = os.path.join(*parts[-2:])
+    elif root:
+        relative = os.path.relpath(source, root)
+    else:
+        relative = os.path.basename(source)
+    for suffix in (CONF_SUFFIX, '.conf'):
+        if relative.endswith(suffix):
+            relative = relative[:-len(suffix)]
+            break
+    return relative + '.json'
+
+
+def output_names(sources: list[str]) -> list[tuple[str, str]]:
+    """
+    Every lirc.conf file in sources with the relative path of its json file.
+    With several sources, files found in a directory are placed under that
+    directory's name, so checkouts with the same layout don't overwrite each
+    other. Any other clash, such as two lircd.conf files given directly,
+    gets a numbered name.
+    """
+    names: list[tuple[str, str]] = []
+    seen: set[str] = set()
+    for conf_file, root in expand_sources(sources):
+        name: str = output_name(conf_file, root)
+        if root and len(sources) > 1:
+            name = os.path.join(
+                    os.path.basename(os.path.normpath(root)), name)
+        stem: str = name[:-len('.json')]
+        number: int = 2
+        while name in seen:
+            name = f'{stem}_{number}.json'
+            number += 1
+        seen.add(name)
+        names.append((conf_file, name))
+    return names
+
+
+def convert_source(source: str, output: str) -> ConversionResult:
+    """
+    Converts a single lirc.conf file and writes the codes of each of its
+    remotes to output, as {remote: {button: code}}, so buttons that share a
+    name in different remotes are all kept. Any error is recorded in the
+    result rather than raised.
+    """
+    result: ConversionResult = ConversionResult(source)
+    try:
+        sections: Config = parse_lirc(load_conf_text(source))
+        remotes: Config = {
+                section: encode_section(section, section_config)
+                for section, section_config in sections.items()
+                }
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with atomic_write(output) as json_file:
+            json.dump(remotes, json_file, indent=2)
+        result.output = output
+        result.buttons = sum(len(codes) for codes in remotes.values())
+    except Exception as error: # One bad file mustn't stop the whole run
+        result.error = f'{type(error).__name__}: {error}'
+    return result
+
+
+def convert_chunk(sources: list[tuple[str, str]]) -> list[ConversionResult]:
+    """
+    Work unit run in each worker process, given (source, output) pairs
+    """
+    return [convert_source(source, output) for source, output in sources]
+
+
+def print_progress(result: ConversionResult, done: int, total: int) -> None:
+    """
+    Default progress callback, reports each file on stderr
+    """
+    status: str = result.error or f'{result.buttons} buttons'
+    print(f'[{done}/{total}] {result.source}: {status}', file=sys.stderr)
+
+
+def bulk_convert(
+        sources: Iterable[str],
+        outdir: str,
+        workers: int | None = None,
+        chunksize: int = 16,
+        progress: Callable[[ConversionResult, int, int], None] | None = print_progress
+        ) -> list[ConversionResult]:
+    """
+    Converts every source across a pool of worker processes.
+    Parameters:
+    sources:
+        Local lirc.conf paths, urls, or directories to search for lirc.conf
+        files
+    outdir:
+        Directory to write one json file per lirc.conf file into
+    workers:
+        Number of worker processes, defaults to the number of cpus
+    chunksize:
+        Number of files handed to a worker at a time
+    progress:
+        Called with each result, the number done and the total
+    """
+    # Keep the layout of each checkout in the output directory
+    conf_files: list[tuple[str, str]] = [
+            (conf_file, os.path.join(outdir, name))
+            for conf_file, name in output_names(list(sources))
+            ]
+    chunks: list[list[tuple[str, str]]] = [
+            conf_files[start:start + chunksize]
+            for start in range(0, len(conf_files), chunksize)
+            ]
+
+    results: list[ConversionResult] = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures: dict[Future, list[tuple[str, str]]] = {
+                executor.submit(convert_chunk, chunk): chunk
+                for chunk in chunks
+                }
+        for future in as_completed(futures):
+            chunk_results: list[ConversionResult]
+            try:
+                chunk_results = future.result()
+            except BrokenProcessPool as error:
+                # A worker died, e.g. killed for running out of memory. Its
+                # files, and any still queued, are reported as failed.
+                chunk_results = [
+                        ConversionResult(source, error=f'{type(error).__name__}: {error}')
+                        for source, _ in futures[future]
+                        ]
+            for result in chunk_results:
+                results.append(result)
+                if progress:
+                    progress(result, len(results), len(conf_files))
+    return results
+
+
+def main(sources: list[str], outdir: str) -> int:
+    """
+    Converts all sources and prints a summary. Returns the number of failures.
+    """
+    results: list[ConversionResult] = bulk_convert(sources, outdir)
+    failures: list[ConversionResult] = [
+            result for result in results if result.error
+            ]
+    print(
+        f'Converted {len(results) - len(failures)} of {len(results)} files',
+        file=sys.stderr
+        )
+    for failure in failures:
+        print(f'Failed: {failure.source}: {failure.error}', file=sys.stderr)
+    return len(failures)
+
+
+if __name__ == '__main__':
+    if len(argv) < 3:
+        print('Usage: python bulk_convert.py source [source ...] output_dir')
+        sys.exit(2)
+    sys.exit(1 if main(argv[1:-1], argv[-1]) else 0)
@@ -0,0 +1,152 @@
+"""
+cli.py
+
+Single command line entry point for the tools in this repository. Each
+subcommand only imports what it needs, and requests and yaml are only
+imported once a url or the yaml emitter needs them, so converting a local
+file starts quickly enough to call from shell loops and Home Assistant
+shell_commands.
+
+    python cli.py codes SOURCE [--compact] [--tolerance 0.1]
+    python cli.py scripts SOURCE ENTITY [OUTFILE] [--template] [--manifest PATH]
+    python cli.py scripts SOURCE ENTITY --packages DIR [--workers N]
+    python cli.py bulk SOURCE [SOURCE ...] OUTPUT_DIR
+    python cli.py export [--format ndjson|csv] SOURCE [SOURCE ...]
+    python cli.py send HOST MAC SOURCE BUTTON [BUTTON ...] [--gap 0.3]
+    python cli.py serve [service options]
+    python cli.py bench [benchmark options]
+    python cli.py fuzz [fuzzer options]
+
+SOURCE is a url, a local lirc.conf file or - to read stdin. Every subcommand
+takes --profile or --profile=path for a json report of where the time went.
+"""
+
+import argparse
+import sys
+
+import instrumentation
+
+# Subcommands that hand the rest of the command line to their own parser
+PASSTHROUGH_COMMANDS: set[str] = {'export', 'send', 'serve', 'bench', 'fuzz'}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    The argument parser for every subcommand
+    """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+            prog='cli.py',
+            description='Convert lirc.conf files to Broadlink codes')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    codes: argparse.ArgumentParser = commands.add_parser(
+            'codes', help='Print the base 64 codes of every button as json')
+    codes.add_argument('source', help='Url, local file or - for stdin')
+    codes.add_argument('--compact', action='store_true',
+                       help='Shrink the codes and report the sizes on stderr')
+    codes.add_argument('--tolerance', type=float,
+                       help='Fraction a pulse may change by when compacting')
+
+    scripts: argparse.ArgumentParser = commands.add_parser(
+            'scripts', help='Write Home Assistant scripts for every button')
+    scripts.add_argument('source', help='Url, local file or - for stdin')
+    scripts.add_argument('entity', help='Broadlink remote entity, e.g. remote.tv')
+    scripts.add_argument('outfile', nargs='?', help='.yaml file, or stdout')
+    scripts.add_argument('--template', action='store_true',
+                         help='Use the template emitter, which skips yaml')
+    scripts.add_argument('--manifest',
+                         help='Manifest for incremental regeneration')
+    scripts.add_argument('--packages',
+                         help='Write one Home Assistant package per remote here')
+    scripts.add_argument('--workers', type=int,
+                         help='Worker processes for --packages')
+
+    bulk: argparse.ArgumentParser = commands.add_parser(
+            'bulk', help='Convert many files into a directory of json files')
+    bulk.add_argument('sources', nargs='+')
+    bulk.add_argument('outdir')
+
+    commands.add_parser('export', add_help=False,
+                        help='Stream every code as ndjson or csv records')
+    commands.add_parser('send', add_help=False,
+                        help='Send buttons straight to a Broadlink device')
+    commands.add_parser('serve', add_help=False,
+                        help='Run the conversion service')
+    commands.add_parser('bench', add_help=False,
+                        help='Run the benchmarks')
+    commands.add_parser('fuzz', add_help=False,
+                        help='Check the fast encoders against the reference')
+    return parser
+
+
+def run(arguments: list[str]) -> int:
+    """
+    Runs a single subcommand and returns its exit status
+    """
+    if arguments and arguments[0] in PASSTHROUGH_COMMANDS:
+        if arguments[0] == 'export':
+            import export
+            return export.main(arguments[1:])
+        if arguments[0] == 'send':
+            import sender
+            return sender.main(arguments[1:])
+        if arguments[0] == 'serve':
+            import service
+            service.main(arguments[1:])
+            return 0
+        if arguments[0] == 'fuzz':
+            import fuzz
+            return fuzz.main(arguments[1:])
+        import benchmarks
+        return benchmarks.main(arguments[1:])
+
+    args: argparse.Namespace = build_parser().parse_args(arguments)
+    if args.command == 'codes':
+        import json
+        from lirc2broadlinkha import Config, create_mapping
+        mapping: Config = create_mapping(args.source)
+        if args.compact:
+            import compact
+            tolerance: float = (compact.DEFAULT_TOLERANCE
+                                if args.tolerance is None else args.tolerance)
+            mapping, report = compact.compact_mapping(mapping, tolerance)
+            print(f'Compacted {report.before} bytes to {report.after} '
+                  f'({report.merged} pulses merged, {report.folded} frames '
+                  f'folded, {report.snapped} pulses snapped)', file=sys.stderr)
+        json.dump(mapping, sys.stdout, indent=2)
+        print()
+    elif args.command == 'scripts':
+        import create_ha_script
+        failures: int = create_ha_script.main(
+                args.source,
+                create_ha_script.remote_entity(args.entity),
+                args.outfile,
+                'template' if args.template else 'yaml',
+                args.manifest,
+                args.packages,
+                args.workers)
+        return 1 if failures else 0
+    elif args.command == 'bulk':
+        import bulk_convert
+        return 1 if bulk_convert.main(args.sources, args.outdir) else 0
+    return 0
+
+
+def main(arguments: list[str] | None = None) -> int:
+    """
+    Runs the command line, profiling it if asked to
+    """
+    arguments = list(sys.argv[1:] if arguments is None else arguments)
+    profile: bool
+    profile_path: str | None
+    profile, profile_path = instrumentation.pop_profile_argument(arguments)
+    if not profile:
+        return run(arguments)
+    with instrumentation.profile() as profiler:
+        status: int = run(arguments)
+    profiler.write_report(profile_path)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
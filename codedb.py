@@ -0,0 +1,253 @@
+"""
+codedb.py
+
+Compiles the Broadlink codes of many remotes into a single compact binary
+file, and reads codes back out of it through mmap without loading the whole
+catalogue.
+
+File layout, all integers little endian:
+    header   magic, version, record count, bucket count and the offsets of
+             the sections below
+    buckets  open addressing hash index of (remote, button) -> record
+    records  fixed size entries pointing into the string and packet tables
+    strings  utf-8 remote and button names
+    packets  raw Broadlink packets, not base 64 encoded
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from base64 import b64decode, b64encode
+from sys import argv
+from typing import Iterable, Iterator, Mapping
+
+from atomic import atomic_write
+
+MAGIC: bytes = b'LBDB'
+VERSION: int = 1
+# magic, version, record count, bucket count, bucket, record, string and
+# packet offsets
+HEADER = '<4sIIIQQQQ'
+# hash, record number + 1 (0 marks an empty bucket)
+BUCKET = '<QI'
+# remote offset, button offset, packet offset, packet length, remote length,
+# button length
+RECORD = '<IIIIHH'
+
+HEADER_SIZE: int = struct.calcsize(HEADER)
+BUCKET_SIZE: int = struct.calcsize(BUCKET)
+RECORD_SIZE: int = struct.calcsize(RECORD)
+
+
+def key_hash(remote: str, button: str) -> int:
+    """
+    Hash of a (remote, button) pair that is stable between processes
+    """
+    digest: bytes = hashlib.blake2b(
+            f'{remote}\0{button}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def build_code_db(
+        remotes: Mapping[str, Mapping[str, str | bytes]],
+        path: str) -> int:
+    """
+    Writes a code database and returns the number of codes in it.
+    Parameters:
+    remotes:
+        Maps remote names to the output of code_to_broadlink, button names to
+        base 64 codes. Raw packet bytes are accepted too.
+    path:
+        File to write. It is replaced atomically, so readers with the old
+        file open aren't affected.
+    """
+    strings: bytearray = bytearray()
+    packets: bytearray = bytearray()
+    string_offsets: dict[str, tuple[int, int]] = {}
+    records: list[tuple[int, int, int, int, int, int]] = []
+    hashes: list[int] = []
+
+    def add_string(value: str) -> tuple[int, int]:
+        # Remote names repeat for every button, so only store them once
+        if value not in string_offsets:
+            encoded: bytes = value.encode('utf-8')
+            string_offsets[value] = (len(strings), len(encoded))
+            strings.extend(encoded)
+        return string_offsets[value]
+
+    for remote, codes in remotes.items():
+        for button, code in codes.items():
+            packet: bytes = b64decode(code) if isinstance(code, str) else code
+            remote_offset, remote_length = add_string(remote)
+            button_offset, button_length = add_string(button)
+            records.append((remote_offset, button_offset, len(packets),
+                            len(packet), remote_length, button_length))
+            hashes.append(key_hash(remote, button))
+            packets.extend(packet)
+
+    # Keep the table at most half full so probes stay short
+    bucket_count: int = 1
+    while bucket_count < 2 * len(records):
+        bucket_count *= 2
+    buckets: list[tuple[int, int]] = [(0, 0)] * bucket_count
+    for number, record_hash in enumerate(hashes):
+        slot: int = record_hash & (bucket_count - 1)
+        while buckets[slot][1]:
+            slot = (slot + 1) & (bucket_count - 1)
+        buckets[slot] = (record_hash, number + 1)
+
+    bucket_offset: int = HEADER_SIZE
+    record_offset: int = bucket_offset + bucket_count * BUCKET_SIZE
+    string_offset: int = record_offset + len(records) * RECORD_SIZE
+    packet_offset: int = string_offset + len(strings)
+
+    with atomic_write(path, 'wb') as db_file:
+        db_file.write(struct.pack(
+                HEADER, MAGIC, VERSION, len(records), bucket_count,
+                bucket_offset, record_offset, string_offset, packet_offset))
+        db_file.write(b''.join(struct.pack(BUCKET, *bucket)
+                               for bucket in buckets))
+        db_file.write(b''.join(struct.pack(RECORD, *record)
+                               for record in records))
+        db_file.write(strings)
+        db_file.write(packets)
+    return len(records)
+
+
+class CodeDatabase:
+    """
+    Reads codes from a file written by build_code_db. The file is memory
+    mapped, so only the pages touched by a lookup are read from disk.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as db_file:
+            self.map: mmap.mmap = mmap.mmap(
+                    db_file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.record_count, self.bucket_count,
+         self.bucket_offset, self.record_offset, self.string_offset,
+         self.packet_offset) = struct.unpack_from(HEADER, self.map)
+        if magic != MAGIC or version != VERSION:
+            self.map.close()
+            raise ValueError(f'{path} is not a version {VERSION} code database')
+
+    def string(self, offset: int, length: int) -> str:
+        """
+        Reads a name from the string table
+        """
+        start: int = self.string_offset + offset
+        return self.map[start:start + length].decode('utf-8')
+
+    def record(self, number: int) -> tuple[int, int, int, int, int, int]:
+        """
+        Reads a single record
+        """
+        return struct.unpack_from(
+                RECORD, self.map, self.record_offset + number * RECORD_SIZE)
+
+    def find(self, remote: str, button: str) -> int | None:
+        """
+        Returns the record number for a (remote, button) pair, or None
+        """
+        if not self.bucket_count:
+            return None
+        record_hash: int = key_hash(remote, button)
+        slot: int = record_hash & (self.bucket_count - 1)
+        while True:
+            bucket_hash, number = struct.unpack_from(
+                    BUCKET, self.map, self.bucket_offset + slot * BUCKET_SIZE)
+            if not number:
+                return None
+            if bucket_hash == record_hash:
+                (remote_offset, button_offset, _, _, remote_length,
+                 button_length) = self.record(number - 1)
+                # Confirm, in case two keys share a hash
+                if (self.string(remote_offset, remote_length) == remote
+                        and self.string(button_offset, button_length) == button):
+                    return number - 1
+            slot = (slot + 1) & (self.bucket_count - 1)
+
+    def packet(self, number: int) -> bytes:
+        """
+        Reads the raw Broadlink packet of a record
+        """
+        _, _, packet_offset, packet_length, _, _ = self.record(number)
+        start: int = self.packet_offset + packet_offset
+        return self.map[start:start + packet_length]
+
+    def get(self, remote: str, button: str) -> bytes | None:
+        """
+        Returns the raw Broadlink packet for a button, or None
+        """
+        number: int | None = self.find(remote, button)
+        return None if number is None else self.packet(number)
+
+    def get_b64(self, remote: str, button: str) -> str | None:
+        """
+        Returns the base 64 code for a button, as used by Home Assistant
+        """
+        packet: bytes | None = self.get(remote, button)
+        return None if packet is None else b64encode(packet).decode('utf-8')
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        return self.find(*key) is not None
+
+    def __len__(self) -> int:
+        return self.record_count
+
+    def __iter__(self) -> Iterator[tuple[str, str]]:
+        """
+        Iterates over every (remote, button) pair in the database
+        """
+        for number in range(self.record_count):
+            (remote_offset, button_offset, _, _, remote_length,
+             button_length) = self.record(number)
+            yield (self.string(remote_offset, remote_length),
+                   self.string(button_offset, button_length))
+
+    def close(self) -> None:
+        """
+        Unmaps the file
+        """
+        self.map.close()
+
+    def __enter__(self) -> 'CodeDatabase':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def load_json_tree(root: str) -> Iterable[tuple[str, dict[str, str]]]:
+    """
+    Reads the json files written by bulk_convert. A remote is named by its
+    file's path under root without the .json extension, e.g. sony/RM-U306A,
+    followed by its own name when the file holds several remotes. Files are
+    read in sorted order, so the same tree always builds the same database.
+    """
+    for directory, directories, files in os.walk(root):
+        # Sorting in place makes os.walk descend in that order too
+        directories.sort()
+        for file_name in sorted(files):
+            if not file_name.endswith('.json'):
+                continue
+            path: str = os.path.join(directory, file_name)
+            name: str = os.path.relpath(path, root)[:-len('.json')]
+            with open(path) as json_file:
+                remotes: dict[str, dict[str, str]] = json.load(json_file)
+            if len(remotes) == 1:
+                yield name, next(iter(remotes.values()))
+                continue
+            for remote, codes in remotes.items():
+                yield f'{name}/{remote}', codes
+
+
+if __name__ == '__main__':
+    if len(argv) != 3:
+        print('Usage: python codedb.py bulk_convert_output_dir database_file')
+        sys.exit(2)
+    count: int = build_code_db(dict(load_json_tree(argv[1])), argv[2])
+    print(f'Wrote {count} codes to {argv[2]}')
@@ -0,0 +1,184 @@
+"""
+compact.py
+
+Shrinks Broadlink packets without changing what an IR receiver sees. Smaller
+packets are quicker to send to the device, which adds up in automations that
+fire many commands.
+
+A packet is compacted in three steps:
+    merging    pulses of zero ticks are merged into their neighbours. They
+               carry no signal, and a zero byte is read back as the start
+               of a 3 byte pulse.
+    folding    a packet made of identical frames is cut down to one frame
+               and the frame count moved into the repeat byte
+    snapping   pulses a little over 255 ticks are shortened to 255, so they
+               take 1 byte rather than 3, as long as the change is within
+               the tolerance
+
+A packet whose frames differ, such as a lead-in frame followed by repeat
+frames, can't be folded, as the repeat byte repeats the whole packet.
+"""
+
+from base64 import b64encode
+from dataclasses import dataclass
+from typing import Mapping
+
+from fingerprint import FRAME_GAP_TICKS, to_packet
+from lirc2broadlinkha import (Config, broadlink_hex_to_ticks,
+                              ticks_to_broadlink_hex)
+
+# Fraction of a pulse length it may change by. IR receivers typically accept
+# 20-30%, and lirc's own default eps is 30%.
+DEFAULT_TOLERANCE: float = 0.1
+# Longest pulse that fits in a single byte
+SINGLE_BYTE_TICKS: int = 255
+
+
+@dataclass
+class CompactionReport:
+    """
+    Sizes before and after compaction, and what was changed to get there
+    """
+    before: int = 0
+    after: int = 0
+    merged: int = 0
+    folded: int = 0
+    snapped: int = 0
+
+    def add(self, other: 'CompactionReport') -> None:
+        """
+        Adds the counts of another report to this one
+        """
+        self.before += other.before
+        self.after += other.after
+        self.merged += other.merged
+        self.folded += other.folded
+        self.snapped += other.snapped
+
+
+def within(first: int, second: int, tolerance: float) -> bool:
+    """
+    Whether two pulse lengths differ by no more than tolerance
+    """
+    return abs(first - second) <= tolerance * max(first, second)
+
+
+def merge_zero_pulses(ticks: list[int]) -> tuple[list[int], int]:
+    """
+    Joins the pulses either side of every zero tick pulse, which are of the
+    same kind, so on and off pulses still alternate. Returns the pulses and
+    how many were removed.
+    """
+    joined: list[int] = []
+    removed: int = 0
+    index: int = 0
+    while index < len(ticks):
+        tick: int = ticks[index]
+        if tick == 0 and joined and index + 1 < len(ticks):
+            # Skip the empty pulse and add the next one to the previous one
+            joined[-1] += ticks[index + 1]
+            removed += 2
+            index += 2
+            continue
+        joined.append(tick)
+        index += 1
+    # A trailing empty off pulse, as on learned codes, is simply dropped
+    if joined and joined[-1] == 0 and len(joined) % 2 == 0:
+        joined.pop()
+        removed += 1
+    return joined, removed
+
+
+def split_frames(ticks: list[int]) -> list[list[int]]:
+    """
+    Splits pulses into frames, each ending in a long gap
+    """
+    frames: list[list[int]] = []
+    start: int = 0
+    for index in range(1, len(ticks), 2):
+        if ticks[index] >= FRAME_GAP_TICKS:
+            frames.append(ticks[start:index + 1])
+            start = index + 1
+    if start < len(ticks):
+        frames.append(ticks[start:])
+    return frames
+
+
+def fold_repeats(
+        ticks: list[int],
+        repeats: int,
+        tolerance: float) -> tuple[list[int], int, int]:
+    """
+    Cuts a run of identical frames down to the first one and moves the
+    frame count into the repeat byte. The gap after the final frame isn't
+    compared, as only the gaps between frames are repeated. Returns the
+    pulses, the repeats and how many frames were folded away.
+    """
+    frames: list[list[int]] = split_frames(ticks)
+    if len(frames) < 2:
+        return ticks, repeats, 0
+    total_repeats: int = (repeats + 1) * len(frames) - 1
+    if total_repeats > 255:
+        return ticks, repeats, 0
+    first: list[int] = frames[0]
+    for number, frame in enumerate(frames[1:], start=2):
+        compared: int = len(first) - 1 if number == len(frames) else len(first)
+        if len(frame) != len(first) or not all(
+                within(a, b, tolerance)
+                for a, b in zip(first[:compared], frame[:compared])):
+            return ticks, repeats, 0
+    return first, total_repeats, len(frames) - 1
+
+
+def snap_pulses(ticks: list[int], tolerance: float) -> tuple[list[int], int]:
+    """
+    Shortens pulses that only just need 3 bytes down to a single byte, when
+    that's within tolerance. Returns the pulses and how many were changed.
+    """
+    snapped: list[int] = list(ticks)
+    changed: int = 0
+    for index, tick in enumerate(snapped):
+        if tick <= SINGLE_BYTE_TICKS:
+            continue
+        if within(tick, SINGLE_BYTE_TICKS, tolerance):
+            snapped[index] = SINGLE_BYTE_TICKS
+            changed += 1
+    return snapped, changed
+
+
+def compact_packet(
+        code: str | bytes,
+        tolerance: float = DEFAULT_TOLERANCE) -> tuple[bytes, CompactionReport]:
+    """
+    Compacts a single base 64 code or packet. Returns the new packet and a
+    report of the sizes before and after.
+    """
+    packet: bytes = to_packet(code)
+    ticks, repeats = broadlink_hex_to_ticks(packet)
+    report: CompactionReport = CompactionReport(before=len(packet))
+    pulses: list[int]
+    pulses, report.merged = merge_zero_pulses(list(ticks.data))
+    pulses, repeats, report.folded = fold_repeats(pulses, repeats, tolerance)
+    pulses, report.snapped = snap_pulses(pulses, tolerance)
+    compacted: bytes = ticks_to_broadlink_hex(pulses, repeats)
+    # Leave the packet alone when nothing was gained
+    if len(compacted) >= len(packet):
+        return packet, CompactionReport(before=len(packet), after=len(packet))
+    report.after = len(compacted)
+    return compacted, report
+
+
+def compact_mapping(
+        mapping: Mapping[str, str | bytes],
+        tolerance: float = DEFAULT_TOLERANCE) -> tuple[Config, CompactionReport]:
+    """
+    Compacts every code of a code_to_broadlink mapping. Returns the new base
+    64 codes and the combined report.
+    """
+    compacted: Config = {}
+    total: CompactionReport = CompactionReport()
+    for button, code in mapping.items():
+        packet, report = compact_packet(code, tolerance)
+        compacted[button] = b64encode(packet).decode('utf-8')
+        total.add(report)
+    return compacted, total
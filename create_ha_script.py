@@ -3,30 +3,80 @@ create_ha_scripts.py
 
 Creates a yaml file with Home Assistant valid scripts for every remote button
 provided in the dictionary input.
+
+With a packages directory, writes one Home Assistant package per remote
+section instead, with script names prefixed by the remote so buttons that
+share a name in different remotes are all kept. Packages are built across
+worker processes and only replaced, atomically, when their content changes,
+so Home Assistant only needs to reload the ones that did.
 """
 
-import yaml
+import io
+import json
+import os
+import re
+import sys
+import textwrap
+import instrumentation
+from atomic import atomic_write
 
+from dataclasses import dataclass
 from sys import argv
-from lirc2broadlinkha import create_mapping
+from typing import Callable, Iterable, TextIO
+from lirc2broadlinkha import (Config, create_mapping, encode_section,
+                              iter_conf_lines, iter_lirc_sections,
+                              load_conf_text)
 
-def create_script(button: str, code:str, entity_name: str) -> dict:
+def script_name(button: str) -> str:
     """
-    Creates a Home Assistant script that maps a button to it's corresponding
-    base 64 code
+    Sanitizes a button name for use as a script name. Must be lower case
+    without any dashes
     """
-
-    # First sanitize the button name. Must be lower case without any dashes
     button_name: str = button.lower()
     for char in '&;':
         button_name = button_name.replace(char, '')
     button_name = button_name.replace('+', '_plus')
     button_name = button_name.replace('-', '_minus')
-    
+    return button_name
+
+def remote_slug(remote: str) -> str:
+    """
+    Lower case name of a remote with anything other than letters and digits
+    replaced by underscores, for package file and script names
+    """
+    slug: str = re.sub(r'[^a-z0-9]+', '_', remote.lower()).strip('_')
+    return slug or 'remote'
+
+def remote_entity(entity_name: str) -> str:
+    """
+    Adds the remote. domain to an entity name if it's missing
+    """
+    if entity_name.split('.')[0] != 'remote':
+        entity_name = f'remote.{entity_name}'
+    return entity_name
+
+def create_script(
+        button: str,
+        code:str,
+        entity_name: str,
+        remote: str | None = None) -> dict:
+    """
+    Creates a Home Assistant script that maps a button to it's corresponding
+    base 64 code. Given the remote, the script name and alias are prefixed
+    with it.
+    """
+
+    # First sanitize the button name
+    button_name: str = script_name(button)
+    alias: str = button
+    if remote:
+        button_name = f'{remote_slug(remote)}_{button_name}'
+        alias = f'{remote} {button}'
+
     # Build the Home Assistant script
     script: dict = {
         button_name: {
-            'alias': button,
+            'alias': alias,
             'sequence': [
                 {
                     'service': 'remote.send_command',
@@ -43,35 +93,303 @@ def create_script(button: str, code:str, entity_name: str) -> dict:
     return script
     
 
-def main(lirc_url: str, entity_name: str, outfile: str | None = None) -> None:
-
-    mapping = create_mapping(argv[1])
-    script_file_string: str = ''
+def create_scripts(
+        mapping: dict,
+        entity_name: str,
+        remote: str | None = None) -> dict:
+    """
+    Creates the Home Assistant scripts for every button in a mapping of
+    buttons to base 64 codes, as a single dictionary
+    """
+    scripts: dict = {}
     for button, code in mapping.items():
-        script: dict = create_script(button, code, entity_name)
-        script_file_string += yaml.dump(script)
-        script_file_string += '\n'
+        scripts.update(create_script(button, code, entity_name, remote))
+    return scripts
+
+
+def write_scripts_yaml(scripts: dict, stream: TextIO) -> None:
+    """
+    Streams all scripts to a file handle in a single dump, using the libyaml
+    emitter when it's available. yaml is imported here so the template
+    emitter doesn't pay for it.
+    """
+    import yaml
+    # libyaml's C emitter is much faster, but isn't always compiled in
+    dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+    yaml.dump(scripts, stream, Dumper=dumper, sort_keys=False)
+
+
+def write_scripts_template(scripts: dict, stream: TextIO) -> None:
+    """
+    Writes scripts straight from a template of the fixed remote.send_command
+    script shape, skipping the yaml emitter altogether. Strings are written as
+    json strings, which are valid yaml scalars, so nothing needs escaping by
+    hand.
+    """
+    quote = json.dumps
+    for button_name, script in scripts.items():
+        step: dict = script['sequence'][0]
+        stream.write(
+            f"{quote(button_name)}:\n"
+            f"  alias: {quote(script['alias'])}\n"
+            f"  sequence:\n"
+            f"  - service: {quote(step['service'])}\n"
+            f"    target:\n"
+            f"      entity_id: {quote(step['target']['entity_id'])}\n"
+            f"    data:\n"
+            f"      command: {quote(step['data']['command'])}\n"
+            )
+
+
+EMITTERS: dict[str, Callable[[dict, TextIO], None]] = {
+    'yaml': write_scripts_yaml,
+    'template': write_scripts_template,
+    }
+
+
+@dataclass
+class PackageResult:
+    """
+    Outcome of writing the package of a single remote section
+    """
+    remote: str
+    path: str | None = None
+    scripts: int = 0
+    changed: bool = False
+    error: str | None = None
 
 
-    if outfile:
-        if outfile.split('.')[-1] not in ['yaml', 'yml']:
-            raise ValueError('File must be a .yaml file')
-        with open(outfile, 'w') as yaml_file:
-            yaml_file.write(script_file_string)
+def render_package(
+        scripts: dict,
+        write_scripts: Callable[[dict, TextIO], None]) -> str:
+    """
+    The text of a Home Assistant package holding the given scripts
+    """
+    stream: io.StringIO = io.StringIO()
+    write_scripts(scripts, stream)
+    return 'script:\n' + textwrap.indent(stream.getvalue(), '  ')
+
+
+def write_if_changed(path: str, text: str) -> bool:
+    """
+    Replaces the file at path with text atomically, unless it already holds
+    exactly that text. Returns whether the file was written.
+    """
+    try:
+        with open(path, encoding='utf-8') as existing_file:
+            if existing_file.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    with atomic_write(path, encoding='utf-8') as package_file:
+        package_file.write(text)
+    return True
+
+
+def build_package(
+        remote: str,
+        section_config: Config,
+        entity_name: str,
+        outdir: str,
+        emitter: str) -> PackageResult:
+    """
+    Encodes a single remote section and writes its package to outdir. Any
+    error is recorded in the result rather than raised.
+    """
+    result: PackageResult = PackageResult(remote)
+    try:
+        scripts: dict = create_scripts(
+                encode_section(remote, section_config), entity_name, remote)
+        path: str = os.path.join(outdir, f'{remote_slug(remote)}.yaml')
+        result.changed = write_if_changed(
+                path, render_package(scripts, EMITTERS[emitter]))
+        result.path = path
+        result.scripts = len(scripts)
+    except Exception as error: # One bad remote mustn't stop the whole run
+        result.error = f'{type(error).__name__}: {error}'
+    return result
+
+
+def build_packages(
+        sections: list[tuple[str, Config]],
+        entity_name: str,
+        outdir: str,
+        emitter: str) -> list[PackageResult]:
+    """
+    Work unit run in each worker process
+    """
+    return [build_package(remote, section_config, entity_name, outdir, emitter)
+            for remote, section_config in sections]
+
+
+def write_packages(
+        sources: Iterable[str],
+        entity_name: str,
+        outdir: str,
+        emitter: str = 'yaml',
+        workers: int | None = None,
+        chunksize: int = 8) -> list[PackageResult]:
+    """
+    Writes one Home Assistant package per remote section of every source.
+    Parameters:
+    sources:
+        Urls, local lirc.conf files or - for stdin
+    entity_name:
+        Broadlink remote entity every script sends with
+    outdir:
+        Packages directory, e.g. one included with !include_dir_named
+    emitter:
+        yaml or template, as for single file output
+    workers:
+        Number of worker processes, defaults to the number of cpus. With 1,
+        or only a single chunk of remotes, packages are built in this
+        process.
+    chunksize:
+        Number of remotes handed to a worker at a time
+    """
+    os.makedirs(outdir, exist_ok=True)
+    sections: list[tuple[str, Config]] = []
+    used: set[str] = set()
+    for source in sources:
+        for remote, section_config in iter_lirc_sections(iter_conf_lines(source)):
+            # Remotes whose names only differ in punctuation, or that appear
+            # in more than one source, would share a package, so number
+            # them until the name is free, including of numbered names
+            name: str = remote
+            number: int = 2
+            while remote_slug(name) in used:
+                name = f'{remote}_{number}'
+                number += 1
+            used.add(remote_slug(name))
+            sections.append((name, section_config))
+    chunks: list[list[tuple[str, Config]]] = [
+            sections[start:start + chunksize]
+            for start in range(0, len(sections), chunksize)
+            ]
+
+    if workers == 1 or len(chunks) <= 1:
+        return [result for chunk in chunks
+                for result in build_packages(chunk, entity_name, outdir, emitter)]
+    # Imported here, as it pulls in multiprocessing, which would slow down
+    # the start of every other command
+    from concurrent.futures import ProcessPoolExecutor
+    results: list[PackageResult] = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+                executor.submit(build_packages, chunk, entity_name, outdir,
+                                emitter)
+                for chunk in chunks
+                ]
+        # Keep the order of the sources
+        for future in futures:
+            results += future.result()
+    return results
+
+
+def main(
+        lirc_url: str,
+        entity_name: str,
+        outfile: str | None = None,
+        emitter: str = 'yaml',
+        manifest_path: str | None = None,
+        packages_dir: str | None = None,
+        workers: int | None = None) -> int:
+    """
+    Writes the scripts for lirc_url to outfile, or stdout, or one package per
+    remote to packages_dir. Returns the number of remotes that failed.
+    """
+    if packages_dir:
+        with instrumentation.stage('create_ha_script.main', remote=lirc_url):
+            results: list[PackageResult] = write_packages(
+                    [lirc_url], entity_name, packages_dir, emitter, workers)
+        failures: list[PackageResult] = [
+                result for result in results if result.error]
+        changed: int = sum(result.changed for result in results)
+        print(f'Wrote {changed} changed of {len(results)} packages to '
+              f'{packages_dir}', file=sys.stderr)
+        for failure in failures:
+            print(f'Failed: {failure.remote}: {failure.error}', file=sys.stderr)
+        return len(failures)
+
+    if outfile and outfile.split('.')[-1] not in ['yaml', 'yml']:
+        raise ValueError('File must be a .yaml file')
+    write_scripts: Callable[[dict, TextIO], None] = EMITTERS[emitter]
+
+    with instrumentation.stage('create_ha_script.main', remote=lirc_url):
+        write_output(lirc_url, entity_name, outfile, write_scripts,
+                     manifest_path)
+    return 0
+
+def write_output(
+        lirc_url: str,
+        entity_name: str,
+        outfile: str | None,
+        write_scripts: Callable[[dict, TextIO], None],
+        manifest_path: str | None) -> None:
+    """
+    Converts the lirc config at lirc_url and writes its scripts
+    """
+    if manifest_path:
+        # Only re-encode the remotes that changed since the last run.
+        # Imported here as the manifest module uses script_name from this one.
+        from manifest import Manifest
+        manifest: Manifest = Manifest(manifest_path)
+        mapping = manifest.convert(lirc_url, load_conf_text(lirc_url))
+        manifest.save()
     else:
-        print(script_file_string)
+        mapping = create_mapping(lirc_url)
+    scripts: dict = create_scripts(mapping, entity_name)
+
+    with instrumentation.stage('write_scripts'):
+        if outfile:
+            with open(outfile, 'w') as yaml_file:
+                write_scripts(scripts, yaml_file)
+        else:
+            write_scripts(scripts, sys.stdout)
 
 if __name__ == '__main__':
-    lirc_url: str = argv[1]
-    entity_name: str = argv[2]
+    arguments: list[str] = argv[1:]
+    emitter: str = 'yaml'
+    # Optional flag to use the template emitter
+    if '--template' in arguments:
+        arguments.remove('--template')
+        emitter = 'template'
+    # Optional manifest for incremental regeneration, --manifest=path
+    manifest_path: str | None = None
+    for argument in arguments:
+        if argument.startswith('--manifest='):
+            manifest_path = argument.split('=', 1)[1]
+            arguments.remove(argument)
+            break
+    # Optional directory to write one package per remote into, --packages=dir
+    packages_dir: str | None = None
+    for argument in arguments:
+        if argument.startswith('--packages='):
+            packages_dir = argument.split('=', 1)[1]
+            arguments.remove(argument)
+            break
+    # Optional json profile report, --profile or --profile=path
+    profile: bool
+    profile_path: str | None
+    profile, profile_path = instrumentation.pop_profile_argument(arguments)
+
+    lirc_url: str = arguments[0]
+    entity_name: str = arguments[1]
     outfile: str | None = None
 
     # Allow for entity name to either include remote. prefix or not
-    if entity_name.split('.')[0] != 'remote':
-        entity_name = f'remote.{entity_name}'
+    entity_name = remote_entity(entity_name)
 
     # Check for existence of outfile argument
-    if len(argv) > 3:
-        outfile = argv[3]
+    if len(arguments) > 2:
+        outfile = arguments[2]
 
-    main(lirc_url, entity_name, outfile)
+    if profile:
+        with instrumentation.profile() as profiler:
+            status: int = main(lirc_url, entity_name, outfile, emitter,
+                               manifest_path, packages_dir)
+        profiler.write_report(profile_path)
+    else:
+        status = main(lirc_url, entity_name, outfile, emitter, manifest_path,
+                      packages_dir)
+    sys.exit(1 if status else 0)
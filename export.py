@@ -0,0 +1,127 @@
+"""
+export.py
+
+Streams (remote, button, base 64 code) records for any number of lirc.conf
+files as newline delimited json or csv. Each remote is written and flushed as
+soon as it has been encoded, so memory use doesn't grow with the number of
+remotes and the output can be piped straight into other tools.
+
+    python export.py [--format ndjson|csv] [--output file] source [source ...]
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+from typing import Callable, Iterable, Iterator, TextIO
+
+from lirc2broadlinkha import (Record, iter_broadlink_codes, iter_conf_lines,
+                              iter_lirc_sections)
+
+CSV_HEADER: tuple[str, str, str] = ('remote', 'button', 'code')
+
+
+def iter_source_records(
+        sources: Iterable[str],
+        on_error: Callable[[str, Exception], None] | None = None
+        ) -> Iterator[Record]:
+    """
+    Yields the records of every source in turn. Sources can be urls, local
+    paths or - for stdin. Errors are raised unless on_error is given, in which
+    case it is called with the source and the error and the next source is
+    read.
+    """
+    for source in sources:
+        try:
+            yield from iter_broadlink_codes(
+                    iter_lirc_sections(iter_conf_lines(source)))
+        except Exception as error:
+            if on_error is None:
+                raise
+            on_error(source, error)
+
+
+def flush_by_remote(records: Iterable[Record], stream: TextIO) -> Iterator[Record]:
+    """
+    Passes records through, flushing the stream whenever a new remote starts
+    so readers never wait on a half written remote
+    """
+    remote: str | None = None
+    for record in records:
+        if record[0] != remote:
+            if remote is not None:
+                stream.flush()
+            remote = record[0]
+        yield record
+    stream.flush()
+
+
+def write_ndjson(records: Iterable[Record], stream: TextIO) -> int:
+    """
+    Writes one json object per line and returns the number of records
+    """
+    written: int = 0
+    for remote, button, code in flush_by_remote(records, stream):
+        stream.write(json.dumps(
+                {'remote': remote, 'button': button, 'code': code}) + '\n')
+        written += 1
+    return written
+
+
+def write_csv(records: Iterable[Record], stream: TextIO) -> int:
+    """
+    Writes a header row and one row per record. Returns the number of records.
+    """
+    writer = csv.writer(stream, lineterminator='\n')
+    writer.writerow(CSV_HEADER)
+    written: int = 0
+    for record in flush_by_remote(records, stream):
+        writer.writerow(record)
+        written += 1
+    return written
+
+
+WRITERS: dict[str, Callable[[Iterable[Record], TextIO], int]] = {
+    'ndjson': write_ndjson,
+    'jsonl': write_ndjson,
+    'csv': write_csv,
+    }
+
+
+def main(arguments: list[str] | None = None) -> int:
+    """
+    Exports every source and returns 1 if any of them failed
+    """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+            description='Stream Broadlink codes as ndjson or csv')
+    parser.add_argument('sources', nargs='+',
+                        help='Urls, local files or - for stdin')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='ndjson')
+    parser.add_argument('--output', help='File to write, or stdout')
+    args: argparse.Namespace = parser.parse_args(arguments)
+
+    failures: list[str] = []
+
+    def report(source: str, error: Exception) -> None:
+        failures.append(source)
+        print(f'Failed: {source}: {type(error).__name__}: {error}',
+              file=sys.stderr)
+
+    records: Iterator[Record] = iter_source_records(args.sources, report)
+    if args.output:
+        with open(args.output, 'w', newline='') as output_file:
+            WRITERS[args.format](records, output_file)
+    else:
+        try:
+            WRITERS[args.format](records, sys.stdout)
+        except BrokenPipeError:
+            # The reader, e.g. head, has everything it wants. Point stdout at
+            # devnull so the interpreter doesn't complain when flushing it.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            return 0
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
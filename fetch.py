@@ -0,0 +1,282 @@
+"""
+fetch.py
+
+Fetches lirc.conf pages over a shared, keep-alive requests Session and keeps
+an on-disk cache of them. Cached pages are served directly while they are
+younger than the TTL and revalidated with a conditional request
+(ETag/Last-Modified) after that. In offline mode only the cache is used.
+Many pages can be fetched concurrently with fetch_many.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Iterable, Iterator
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from atomic import atomic_write
+
+DEFAULT_CACHE_DIR: str = os.environ.get(
+        'LIRC2BROADLINKHA_CACHE',
+        os.path.join(os.path.expanduser('~'), '.cache', 'lirc2broadlinkha')
+        )
+DEFAULT_TTL: float = 24 * 60 * 60 # One day, in seconds
+DEFAULT_TIMEOUT: float = 30
+# Status codes worth retrying, as the server may recover
+RETRY_STATUSES: frozenset[int] = frozenset([429, 500, 502, 503, 504])
+
+
+class OfflineCacheMiss(requests.exceptions.ConnectionError):
+    """
+    Raised in offline mode when a url isn't in the cache
+    """
+
+
+class HostRateLimiter:
+    """
+    Spaces out requests to the same host by at least min_interval seconds,
+    across all threads
+    """
+
+    def __init__(self, min_interval: float) -> None:
+        self.min_interval: float = min_interval
+        self.lock: threading.Lock = threading.Lock()
+        self.next_slot: dict[str, float] = {}
+
+    def wait(self, url: str) -> None:
+        """
+        Blocks until a request to the host of url is allowed
+        """
+        host: str = urlsplit(url).netloc
+        with self.lock:
+            now: float = time.monotonic()
+            slot: float = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.min_interval
+        # Sleep outside the lock so other hosts aren't held up
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class ConfFetcher:
+    """
+    Fetches urls through a shared Session and an on-disk cache.
+    Parameters:
+    cache_dir:
+        Directory to store cached pages in. None disables the cache.
+    ttl:
+        Seconds a cached page is served without contacting the server
+    offline:
+        Only serve pages from the cache, never touch the network
+    timeout:
+        Timeout in seconds for each request
+    min_host_interval:
+        Minimum number of seconds between requests to the same host
+    """
+
+    def __init__(
+            self,
+            cache_dir: str | None = DEFAULT_CACHE_DIR,
+            ttl: float = DEFAULT_TTL,
+            offline: bool = False,
+            timeout: float = DEFAULT_TIMEOUT,
+            min_host_interval: float = 0) -> None:
+        self.cache_dir: str | None = cache_dir
+        self.ttl: float = ttl
+        self.offline: bool = offline
+        self.timeout: float = timeout
+        self.rate_limiter: HostRateLimiter | None = None
+        if min_host_interval > 0:
+            self.rate_limiter = HostRateLimiter(min_host_interval)
+        self.session: requests.Session = requests.Session()
+
+    def cache_paths(self, url: str) -> tuple[str, str]:
+        """
+        Paths of the cached body and its metadata for a url
+        """
+        assert self.cache_dir is not None
+        key: str = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        base: str = os.path.join(self.cache_dir, key)
+        return base + '.body', base + '.json'
+
+    def read_cache(self, url: str) -> tuple[bytes, dict[str, Any]] | None:
+        """
+        Returns the cached body and metadata for a url, if there is any
+        """
+        if self.cache_dir is None:
+            return None
+        body_path, meta_path = self.cache_paths(url)
+        try:
+            with open(meta_path) as meta_file:
+                meta: dict[str, Any] = json.load(meta_file)
+            with open(body_path, 'rb') as body_file:
+                body: bytes = body_file.read()
+        except (OSError, ValueError):
+            return None
+        return body, meta
+
+    def write_cache(self, url: str, body: bytes, meta: dict[str, Any]) -> None:
+        """
+        Stores a body and its metadata. Files are replaced atomically so a
+        concurrent reader never sees half a page.
+        """
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        body_path, meta_path = self.cache_paths(url)
+        for path, data, mode in [(body_path, body, 'wb'),
+                                 (meta_path, json.dumps(meta), 'w')]:
+            with atomic_write(path, mode) as cache_file:
+                cache_file.write(data)
+
+    @staticmethod
+    def cached_response(url: str, body: bytes, meta: dict[str, Any]) -> requests.Response:
+        """
+        Builds a Response from a cache entry, so callers can't tell the
+        difference between a cached and a fetched page
+        """
+        response: requests.Response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = body
+        response.headers = CaseInsensitiveDict(meta.get('headers', {}))
+        response.encoding = meta.get('encoding')
+        response.from_cache = True # type: ignore[attr-defined]
+        return response
+
+    def get(self, url: str) -> requests.Response:
+        """
+        Returns the page at url, from the cache when possible
+        """
+        cached: tuple[bytes, dict[str, Any]] | None = self.read_cache(url)
+        if self.offline:
+            if cached is None:
+                raise OfflineCacheMiss(f'{url} is not in the cache')
+            return self.cached_response(url, *cached)
+
+        headers: dict[str, str] = {}
+        if cached is not None:
+            body, meta = cached
+            if time.time() - meta.get('fetched', 0) < self.ttl:
+                return self.cached_response(url, body, meta)
+            # Stale, so ask the server whether it has changed
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait(url)
+        response: requests.Response = self.session.get(
+                url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304 and cached is not None:
+            body, meta = cached
+            meta['fetched'] = time.time()
+            self.write_cache(url, body, meta)
+            return self.cached_response(url, body, meta)
+        if response.status_code == 200:
+            self.write_cache(url, response.content, {
+                    'url': url,
+                    'fetched': time.time(),
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'encoding': response.encoding,
+                    'headers': {'Content-Type': response.headers.get(
+                        'Content-Type', '')},
+                    })
+        response.from_cache = False # type: ignore[attr-defined]
+        return response
+
+    def close(self) -> None:
+        """
+        Closes the pooled connections
+        """
+        self.session.close()
+
+
+_default_fetcher: ConfFetcher | None = None
+
+
+def default_fetcher() -> ConfFetcher:
+    """
+    The shared fetcher used by get_conf_file. Setting the environment variable
+    LIRC2BROADLINKHA_OFFLINE to 1 turns on offline mode.
+    """
+    global _default_fetcher
+    if _default_fetcher is None:
+        _default_fetcher = ConfFetcher(
+                offline=os.environ.get('LIRC2BROADLINKHA_OFFLINE') == '1'
+                )
+    return _default_fetcher
+
+
+def fetch_with_retry(
+        fetcher: ConfFetcher,
+        url: str,
+        retries: int = 3,
+        backoff: float = 0.5) -> requests.Response:
+    """
+    Fetches a url, retrying connection errors, timeouts and temporary server
+    errors with exponential backoff. The last response or error is returned
+    or raised once the retries run out.
+    """
+    attempt: int = 0
+    while True:
+        try:
+            response: requests.Response = fetcher.get(url)
+            if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                return response
+        except OfflineCacheMiss:
+            raise # Retrying won't put it in the cache
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            if attempt >= retries:
+                raise
+        time.sleep(backoff * 2 ** attempt)
+        attempt += 1
+
+
+def fetch_many(
+        urls: Iterable[str],
+        fetcher: ConfFetcher | None = None,
+        max_workers: int = 8,
+        retries: int = 3,
+        backoff: float = 0.5
+        ) -> Iterator[tuple[str, requests.Response | Exception]]:
+    """
+    Fetches many urls concurrently on a bounded pool of threads, yielding
+    each url with its response (or the error raised) as soon as it finishes,
+    so callers can start parsing without waiting for the slowest download.
+    Parameters:
+    urls:
+        Urls to fetch
+    fetcher:
+        Fetcher to use, defaults to the shared, cached one. Per-host rate
+        limiting is set on the fetcher with min_host_interval.
+    max_workers:
+        Maximum number of downloads in flight at once
+    retries:
+        Number of retries for each url
+    backoff:
+        Seconds to wait before the first retry, doubling for each one after
+    """
+    if fetcher is None:
+        fetcher = default_fetcher()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures: dict[Future, str] = {
+                executor.submit(fetch_with_retry, fetcher, url, retries, backoff): url
+                for url in urls
+                }
+        for future in as_completed(futures):
+            error: BaseException | None = future.exception()
+            if isinstance(error, Exception):
+                yield futures[future], error
+            elif error is not None:
+                raise error
+            else:
+                yield futures[future], future.result()
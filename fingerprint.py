@@ -0,0 +1,157 @@
+"""
+fingerprint.py
+
+Reverse lookup of Broadlink codes: given a base 64 code learned from a
+Broadlink device, find which lirc remote and button it belongs to.
+
+Each code is decoded back into pulses and reduced to a fingerprint that
+doesn't depend on exact timings: the number of pulses in its first frame and
+the bits read from them. Learned codes have jittered timings and often hold
+several repeated frames, but give the same fingerprint as the code generated
+from the lirc config. The fingerprint is a dict key, so a lookup is constant
+time, and the few candidates sharing it are then checked pulse by pulse
+within a tolerance.
+
+    python fingerprint.py bulk_convert_output_dir base64_code
+"""
+
+import sys
+from base64 import b64decode
+from sys import argv
+from typing import Iterable, Mapping
+
+from lirc2broadlinkha import broadlink_hex_to_ticks
+
+# Off pulses at least this long (in ticks, about 7.8ms) separate frames.
+# This is also where pulses switch to the 3 byte encoding.
+FRAME_GAP_TICKS: int = 256
+# The longest data pulse has to be at least this many times the shortest for
+# the frame to hold both 1s and 0s
+BIT_RATIO: float = 1.3
+
+Fingerprint = tuple[int, str]
+
+
+def to_packet(code: str | bytes) -> bytes:
+    """
+    Accepts a base 64 code, with or without the b64: prefix Home Assistant
+    uses, or a raw packet
+    """
+    if isinstance(code, str):
+        return b64decode(code.removeprefix('b64:'))
+    return code
+
+
+def decode_frame(code: str | bytes) -> list[int]:
+    """
+    Decodes a code and returns the ticks of its first frame
+    """
+    return first_frame(list(broadlink_hex_to_ticks(to_packet(code))[0].data))
+
+
+def first_frame(ticks: list[int]) -> list[int]:
+    """
+    The pulses up to and including the first long gap
+    """
+    for index in range(1, len(ticks), 2):
+        if ticks[index] >= FRAME_GAP_TICKS and index > 1:
+            return ticks[:index + 1]
+    return ticks
+
+
+def frame_bits(frame: list[int]) -> str:
+    """
+    Reads bits from the pulses between the header and the final pulse.
+    Whichever of the on or off pulses varies the most carries the data.
+    """
+    ons: list[int] = frame[2:-2:2]
+    offs: list[int] = frame[3:-2:2]
+    if not ons:
+        return ''
+    on_ratio: float = max(ons) / max(min(ons), 1)
+    off_ratio: float = max(offs) / max(min(offs), 1)
+    values: list[int] = ons if on_ratio >= off_ratio else offs
+    # Too little variation to tell a 1 from a 0
+    if max(on_ratio, off_ratio) < BIT_RATIO:
+        return '0' * len(values)
+    # Split halfway between the short and long pulses
+    threshold: float = (min(values) + max(values)) / 2
+    return ''.join('1' if value > threshold else '0' for value in values)
+
+
+def fingerprint(code: str | bytes) -> Fingerprint:
+    """
+    Timing tolerant fingerprint of a Broadlink code
+    """
+    frame: list[int] = decode_frame(code)
+    return len(frame), frame_bits(frame)
+
+
+def frames_match(first: list[int], second: list[int], tolerance: float) -> bool:
+    """
+    Checks that two frames have the same pulses to within tolerance, except
+    for the final gap which varies with how the code was captured
+    """
+    if len(first) != len(second):
+        return False
+    return all(
+            abs(a - b) <= tolerance * max(a, b) + 2
+            for a, b in zip(first[:-1], second[:-1])
+            )
+
+
+class FingerprintIndex:
+    """
+    Maps fingerprints to the (remote, button) pairs that produce them
+    """
+
+    def __init__(self) -> None:
+        self.index: dict[Fingerprint, list[tuple[str, str, list[int]]]] = {}
+
+    def add(self, remote: str, button: str, code: str | bytes) -> None:
+        """
+        Adds a single code to the index
+        """
+        frame: list[int] = decode_frame(code)
+        key: Fingerprint = (len(frame), frame_bits(frame))
+        self.index.setdefault(key, []).append((remote, button, frame))
+
+    def add_remotes(
+            self,
+            remotes: Iterable[tuple[str, Mapping[str, str | bytes]]]) -> None:
+        """
+        Adds (remote name, code_to_broadlink output) pairs to the index
+        """
+        for remote, codes in remotes:
+            for button, code in codes.items():
+                self.add(remote, button, code)
+
+    def lookup(self, code: str | bytes, tolerance: float = 0.25) -> list[tuple[str, str]]:
+        """
+        Returns every (remote, button) whose code matches, best matches first
+        """
+        frame: list[int] = decode_frame(code)
+        candidates = self.index.get((len(frame), frame_bits(frame)), [])
+        matches: list[tuple[float, str, str]] = []
+        for remote, button, candidate in candidates:
+            if frames_match(frame, candidate, tolerance):
+                error: float = sum(
+                        abs(a - b) for a, b in zip(frame[:-1], candidate[:-1]))
+                matches.append((error, remote, button))
+        return [(remote, button) for _, remote, button in sorted(matches)]
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self.index.values())
+
+
+if __name__ == '__main__':
+    if len(argv) != 3:
+        print('Usage: python fingerprint.py bulk_convert_output_dir base64_code')
+        sys.exit(2)
+    from codedb import load_json_tree
+    fingerprints: FingerprintIndex = FingerprintIndex()
+    fingerprints.add_remotes(load_json_tree(argv[1]))
+    found: list[tuple[str, str]] = fingerprints.lookup(argv[2])
+    for remote, button in found:
+        print(f'{remote} {button}')
+    sys.exit(0 if found else 1)
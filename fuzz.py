@@ -0,0 +1,453 @@
+"""
+fuzz.py
+
+Differential fuzzing of the fast encoders against the reference conversion,
+lirc_to_pulses followed by pulses_to_broadlink_hex. Random, valid, space
+encoded sections are converted by every engine and the packets compared
+byte for byte. Any section an engine gets wrong is shrunk to the smallest
+section that still shows the difference. The time each engine took is
+recorded against the reference, so a faster engine is only turned on once
+it is both correct and worth it.
+
+    python fuzz.py [--cases 500] [--buttons 32] [--seed 0] [--save results.json]
+"""
+
+import argparse
+import copy
+import dataclasses
+import functools
+import json
+import platform
+import random
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator
+
+import lirc2broadlinkha
+from lirc2broadlinkha import (Config, EncoderCache, SectionEncoder,
+                              SignalEncoder, SubConfig)
+
+# Converts the codes of a section to a packet per button
+Encode = Callable[[SubConfig], dict[str, bytes]]
+# Compiles a parsed section, without its min_repeat, into an Encode
+Engine = Callable[[Config, int], Encode]
+# The packets of every button, or the name of the error raised instead
+Outcome = dict[str, bytes] | str
+
+# Longest pulse, in microseconds, that fits in a Broadlink packet
+MAX_PULSE: int = 0xFFFF * 8192 // 269
+# Shrinking stops after this many smaller failing sections
+MAX_SHRINK_STEPS: int = 1000
+
+
+@dataclass(frozen=True)
+class FuzzSection:
+    """
+    Everything about a generated remote section that the engines see
+    """
+    bits: int
+    header: tuple[int, int]
+    one: tuple[int, int]
+    zero: tuple[int, int]
+    ptrail: int | None
+    const_length: bool
+    pre_data: int
+    pre_data_bits: int
+    post_data: int
+    post_data_bits: int
+    gap: int
+    min_repeat: int
+    codes: tuple[int, ...]
+
+    def longest(self) -> int:
+        """
+        Length of the longest frame before the gap, which the gap has to
+        cover
+        """
+        code_bits: int = max(
+                (max(self.bits, code.bit_length()) for code in self.codes),
+                default=self.bits)
+        all_bits: int = self.pre_data_bits + code_bits + self.post_data_bits
+        return (sum(self.header) + all_bits * max(sum(self.one), sum(self.zero))
+                + (self.ptrail or 0))
+
+    def valid(self) -> bool:
+        """
+        Whether lirc would accept the section: it has codes and its gap
+        outlasts every frame
+        """
+        return bool(self.codes) and self.bits > 0 and self.gap >= self.longest()
+
+    def conf(self) -> str:
+        """
+        The section as lirc.conf text
+        """
+        lines: list[str] = [
+            'begin remote',
+            '  name  FUZZ',
+            f'  bits  {self.bits}',
+            '  flags SPACE_ENC' + ('|CONST_LENGTH' if self.const_length else ''),
+            f'  header  {self.header[0]}  {self.header[1]}',
+            f'  one  {self.one[0]}  {self.one[1]}',
+            f'  zero  {self.zero[0]}  {self.zero[1]}',
+            ]
+        if self.ptrail is not None:
+            lines.append(f'  ptrail  {self.ptrail}')
+        if self.pre_data_bits:
+            lines.append(f'  pre_data_bits  {self.pre_data_bits}')
+            lines.append(f'  pre_data  {self.pre_data:#x}')
+        if self.post_data_bits:
+            lines.append(f'  post_data_bits  {self.post_data_bits}')
+            lines.append(f'  post_data  {self.post_data:#x}')
+        lines.append(f'  gap  {self.gap}')
+        lines.append(f'  min_repeat  {self.min_repeat}')
+        lines.append('  begin codes')
+        for button, code in enumerate(self.codes):
+            lines.append(f'    KEY_{button}  {code:#0{(self.bits + 3) // 4 + 2}x}')
+        lines.append('  end codes')
+        lines.append('end remote')
+        return '\n'.join(lines) + '\n'
+
+    def parse(self) -> tuple[Config, int]:
+        """
+        The section as the parser reads it, without its min_repeat, along
+        with its repeats
+        """
+        section_config: Config = next(iter(
+                lirc2broadlinkha.parse_lirc(self.conf()).values()))
+        return section_config, int(section_config.pop('min_repeat', 0))
+
+
+def generate_section(rng: random.Random, buttons: int) -> FuzzSection:
+    """
+    Generates a random, valid, space encoded section. Bits go up to 64,
+    with pre and post data on top, and some codes overflow their bit count.
+    Gaps are sometimes long enough to need 3 bytes, or too long for a
+    packet altogether, which every engine has to reject the same way.
+    """
+    bits: int = rng.randint(1, 64)
+    pre_data_bits: int = rng.choice([0, 0, 0, 8, 16])
+    post_data_bits: int = rng.choice([0, 0, 4, 8, 16, 32])
+    codes: list[int] = []
+    for _ in range(buttons):
+        code_bits: int = bits
+        if rng.random() < 0.1:
+            code_bits += rng.randint(1, 8)
+        codes.append(rng.getrandbits(code_bits))
+
+    section: FuzzSection = FuzzSection(
+            bits=bits,
+            header=(rng.randint(2000, 9000), rng.randint(500, 9000)),
+            one=(rng.randint(100, 1300), rng.randint(100, 2000)),
+            zero=(rng.randint(100, 1300), rng.randint(100, 1300)),
+            ptrail=rng.choice([None, rng.randint(100, 1000)]),
+            const_length=rng.random() < 0.5,
+            pre_data=rng.getrandbits(pre_data_bits),
+            pre_data_bits=pre_data_bits,
+            post_data=rng.getrandbits(post_data_bits),
+            post_data_bits=post_data_bits,
+            gap=0,
+            min_repeat=rng.choice([0, rng.randint(1, 5), rng.randint(0, 255)]),
+            codes=tuple(codes),
+            )
+    gap: int = section.longest() + rng.randint(0, 60000)
+    roll: float = rng.random()
+    if roll < 0.05:
+        gap = rng.randint(MAX_PULSE + 1, 2 * MAX_PULSE)
+    elif roll < 0.25:
+        gap = rng.randint(max(gap, 500000), MAX_PULSE)
+    return dataclasses.replace(section, gap=gap)
+
+
+def reference_engine(section_config: Config, repeats: int) -> Encode:
+    """
+    The conversion every other engine has to match. It has nothing to
+    compile, so all of its time is counted as encoding.
+    """
+    def encode(codes: SubConfig) -> dict[str, bytes]:
+        return {button: bytes(lirc2broadlinkha.pulses_to_broadlink_hex(pulses, repeats))
+                for button, pulses in lirc2broadlinkha.lirc_to_pulses(
+                    {**section_config, 'codes': codes}).items()}
+    return encode
+
+
+def encode_all(encoder: Any) -> Encode:
+    """
+    Encodes every button of a section one at a time
+    """
+    return lambda codes: {button: encoder.encode(code_hex)
+                          for button, code_hex in codes.items()}
+
+
+def default_engines() -> dict[str, Engine]:
+    """
+    Every engine that can stand in for the reference. cached shares one
+    encoder cache between all of the sections, so sections that only differ
+    in their codes share an encoder.
+    """
+    cache: EncoderCache = EncoderCache()
+    return {
+        'section': lambda config, repeats: encode_all(
+            SectionEncoder(config, repeats)),
+        'cached': lambda config, repeats: encode_all(
+            lirc2broadlinkha.compile_encoder(config, repeats, cache)),
+        'vectorized': lambda config, repeats: functools.partial(
+            lirc2broadlinkha.vectorized_encode, SectionEncoder(config, repeats)),
+        'signal': lambda config, repeats: encode_all(
+            SignalEncoder(config, repeats)),
+        }
+
+
+def engine_outcome(engine: Engine, section_config: Config, repeats: int) -> Outcome:
+    """
+    Runs an engine on its own copy of a section and returns what it made,
+    or the name of the error it raised
+    """
+    section_config = copy.deepcopy(section_config)
+    try:
+        return engine(section_config, repeats)(section_config['codes'])
+    except Exception as error:
+        return type(error).__name__
+
+
+def time_engine(
+        engine: Engine,
+        section_config: Config,
+        repeats: int) -> tuple[Outcome, float, float]:
+    """
+    Runs an engine on a section and returns what it made, along with the
+    time it took to compile the section and to encode all of its buttons.
+    The engine is run once untimed first, so the timings don't include
+    building the shared bit tables or importing NumPy. For cached, that run
+    also fills the cache, as every later section with the same timings
+    would find it.
+    """
+    engine_outcome(engine, section_config, repeats)
+    section_config = copy.deepcopy(section_config)
+    codes: SubConfig = section_config['codes']
+    start: float = time.perf_counter()
+    compiled: float = start
+    outcome: Outcome
+    try:
+        encode: Encode = engine(section_config, repeats)
+        compiled = time.perf_counter()
+        outcome = encode(codes)
+    except Exception as error:
+        outcome = type(error).__name__
+    return outcome, compiled - start, time.perf_counter() - compiled
+
+
+def disagrees(engine: Engine, section: FuzzSection) -> bool:
+    """
+    Whether an engine's packets, or error, differ from the reference's for
+    a section
+    """
+    section_config: Config
+    repeats: int
+    section_config, repeats = section.parse()
+    return (engine_outcome(engine, section_config, repeats)
+            != engine_outcome(reference_engine, section_config, repeats))
+
+
+def shrink_candidates(section: FuzzSection) -> Iterator[FuzzSection]:
+    """
+    Smaller or simpler versions of a section, the biggest cuts first
+    """
+    replace: Callable[..., FuzzSection] = dataclasses.replace
+    if len(section.codes) > 1:
+        for code in section.codes:
+            yield replace(section, codes=(code,))
+        yield replace(section, codes=section.codes[:len(section.codes) // 2])
+    if section.min_repeat:
+        yield replace(section, min_repeat=0)
+    if section.ptrail is not None:
+        yield replace(section, ptrail=None)
+    if section.const_length:
+        yield replace(section, const_length=False)
+    if section.pre_data_bits:
+        yield replace(section, pre_data=0, pre_data_bits=0)
+    if section.post_data_bits:
+        yield replace(section, post_data=0, post_data_bits=0)
+    for bits in (section.bits // 2, section.bits - 1):
+        if 0 < bits < section.bits:
+            mask: int = (1 << bits) - 1
+            yield replace(section, bits=bits,
+                          codes=tuple(code & mask for code in section.codes))
+    if section.gap > section.longest():
+        yield replace(section, gap=section.longest())
+        yield replace(section, gap=(section.gap + section.longest()) // 2)
+    for index, code in enumerate(section.codes):
+        for smaller in (0, code >> 1, code & (code - 1)):
+            if smaller < code:
+                codes: list[int] = list(section.codes)
+                codes[index] = smaller
+                yield replace(section, codes=tuple(codes))
+    if section.pre_data:
+        yield replace(section, pre_data=0)
+    if section.post_data:
+        yield replace(section, post_data=0)
+    # Round timings to the NEC ones, which are easier to read
+    for field, value in (('header', (9000, 4500)), ('one', (560, 1690)),
+                         ('zero', (560, 560)), ('ptrail', 560)):
+        if getattr(section, field) not in (None, value):
+            yield replace(section, **{field: value})
+
+
+def shrink(section: FuzzSection, fails: Callable[[FuzzSection], bool]) -> FuzzSection:
+    """
+    Greedily replaces a failing section with the first smaller one that
+    still fails, until none of the smaller ones do
+    """
+    for _ in range(MAX_SHRINK_STEPS):
+        for candidate in shrink_candidates(section):
+            if candidate.valid() and fails(candidate):
+                section = candidate
+                break
+        else:
+            break
+    return section
+
+
+def describe(outcome: Outcome) -> str | dict[str, str]:
+    """
+    An outcome as json, with packets in hex
+    """
+    if isinstance(outcome, str):
+        return outcome
+    return {button: packet.hex() for button, packet in outcome.items()}
+
+
+def speedup(reference_time: float, time_taken: float) -> float | None:
+    """
+    How many times faster than the reference an engine was
+    """
+    return reference_time / time_taken if time_taken else None
+
+
+def run_fuzz(
+        cases: int = 500,
+        buttons: int = 32,
+        seed: int = 0,
+        engines: dict[str, Engine] | None = None) -> dict[str, Any]:
+    """
+    Runs every engine against the reference on cases generated sections.
+    Returns the time each engine took to compile and to encode, how many
+    times faster than the reference it was and the shrunk section of every
+    disagreement, at most one per engine. Each section is compiled once for
+    all of its buttons, so speedup spreads compiling over them, as a real
+    conversion does, and encode_speedup leaves it out.
+    """
+    if engines is None:
+        engines = default_engines()
+    rng: random.Random = random.Random(seed)
+    reference_time: float = 0.0
+    compile_times: dict[str, float] = dict.fromkeys(engines, 0.0)
+    encode_times: dict[str, float] = dict.fromkeys(engines, 0.0)
+    mismatches: dict[str, int] = dict.fromkeys(engines, 0)
+    failures: list[dict[str, Any]] = []
+
+    for case in range(cases):
+        section: FuzzSection = generate_section(rng, buttons)
+        section_config: Config
+        repeats: int
+        section_config, repeats = section.parse()
+        expected: Outcome
+        compile_time: float
+        encode_time: float
+        expected, compile_time, encode_time = time_engine(
+                reference_engine, section_config, repeats)
+        reference_time += compile_time + encode_time
+        for name, engine in engines.items():
+            outcome: Outcome
+            outcome, compile_time, encode_time = time_engine(
+                    engine, section_config, repeats)
+            compile_times[name] += compile_time
+            encode_times[name] += encode_time
+            if outcome == expected:
+                continue
+            mismatches[name] += 1
+            if mismatches[name] > 1:
+                continue
+            # Only the first disagreement of each engine is shrunk, as the
+            # rest are usually the same bug
+            shrunk: FuzzSection = shrink(
+                    section, lambda candidate: disagrees(engine, candidate))
+            shrunk_config, shrunk_repeats = shrunk.parse()
+            failures.append({
+                'engine': name,
+                'case': case,
+                'conf': shrunk.conf(),
+                'expected': describe(engine_outcome(
+                    reference_engine, shrunk_config, shrunk_repeats)),
+                'actual': describe(engine_outcome(
+                    engine, shrunk_config, shrunk_repeats)),
+                })
+
+    return {
+        'parameters': {
+            'cases': cases,
+            'buttons': buttons,
+            'seed': seed,
+            'numpy': lirc2broadlinkha.load_numpy() is not None,
+            },
+        'platform': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            },
+        'reference_seconds': reference_time,
+        'engines': {
+            name: {
+                'compile_seconds': compile_times[name],
+                'encode_seconds': encode_times[name],
+                'speedup': speedup(
+                    reference_time, compile_times[name] + encode_times[name]),
+                'encode_speedup': speedup(reference_time, encode_times[name]),
+                'mismatches': mismatches[name],
+                }
+            for name in engines
+            },
+        'failures': failures,
+        }
+
+
+def main(arguments: list[str]) -> int:
+    """
+    Runs the fuzzer, prints or saves the results and prints the shrunk
+    section of every disagreement. Returns 1 if any engine disagreed.
+    """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+            description='Check the fast encoders against the reference conversion')
+    parser.add_argument('--cases', type=int, default=500)
+    parser.add_argument('--buttons', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', action='append', dest='engines',
+                        help='Only run this engine, can be given more than once')
+    parser.add_argument('--save', help='File to write the json results to')
+    args: argparse.Namespace = parser.parse_args(arguments)
+
+    engines: dict[str, Engine] = default_engines()
+    if args.engines:
+        unknown: set[str] = set(args.engines) - set(engines)
+        if unknown:
+            parser.error(f'unknown engines: {", ".join(sorted(unknown))}')
+        engines = {name: engines[name] for name in args.engines}
+
+    results: dict[str, Any] = run_fuzz(
+            args.cases, args.buttons, args.seed, engines)
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    for failure in results['failures']:
+        print(f'{failure["engine"]} disagrees with the reference on:\n'
+              f'{failure["conf"]}', file=sys.stderr)
+    return 1 if results['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,177 @@
+"""
+instrumentation.py
+
+Opt-in profiling of each stage of the conversion. Nothing is recorded unless
+a Profiler is active, so the hooks cost next to nothing otherwise.
+
+    with profile() as profiler:
+        create_mapping(url)
+    print(profiler.report())
+
+Stage times are inclusive, so create_ha_script.main includes the time spent
+in get_conf_file, parse_lirc and so on. Times are also broken down by remote
+section where the stage works on one.
+"""
+
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+# Events beyond this many are counted but not kept
+MAX_EVENTS: int = 1000
+
+# Profilers currently recording
+_active: list['Profiler'] = []
+
+
+class Profiler:
+    """
+    Collects stage timings, counters and events.
+    Parameters:
+    callback:
+        Called with a dict for every stage timing and event as it happens
+    """
+
+    def __init__(self, callback: Callable[[dict[str, Any]], None] | None = None) -> None:
+        self.callback: Callable[[dict[str, Any]], None] | None = callback
+        self.lock: threading.Lock = threading.Lock()
+        self.stages: dict[str, dict[str, float]] = {}
+        self.remotes: dict[str, dict[str, float]] = {}
+        self.counters: dict[str, int] = {}
+        self.events: list[dict[str, Any]] = []
+        self.events_dropped: int = 0
+
+    def record_stage(self, name: str, seconds: float, remote: str | None) -> None:
+        """
+        Adds the time of one call of a stage
+        """
+        with self.lock:
+            totals: dict[str, float] = self.stages.setdefault(
+                    name, {'calls': 0, 'seconds': 0.0})
+            totals['calls'] += 1
+            totals['seconds'] += seconds
+            if remote is not None:
+                remote_stages: dict[str, float] = self.remotes.setdefault(remote, {})
+                remote_stages[name] = remote_stages.get(name, 0.0) + seconds
+        if self.callback:
+            self.callback({'type': 'stage', 'stage': name, 'seconds': seconds,
+                           'remote': remote})
+
+    def count(self, name: str, amount: int) -> None:
+        """
+        Adds to a counter
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_event(self, record: dict[str, Any]) -> None:
+        """
+        Keeps an event, such as a line that couldn't be parsed
+        """
+        with self.lock:
+            if len(self.events) < MAX_EVENTS:
+                self.events.append(record)
+            else:
+                self.events_dropped += 1
+        if self.callback:
+            self.callback(record)
+
+    def report(self) -> dict[str, Any]:
+        """
+        Everything recorded so far, as a json serializable dict
+        """
+        with self.lock:
+            return {
+                'stages': {name: dict(totals)
+                           for name, totals in self.stages.items()},
+                'counters': dict(self.counters),
+                'remotes': {remote: dict(stages)
+                            for remote, stages in self.remotes.items()},
+                'events': list(self.events),
+                'events_dropped': self.events_dropped,
+                }
+
+    def write_report(self, path: str | None = None) -> None:
+        """
+        Writes the report as json to path, or to stderr without one
+        """
+        if path:
+            with open(path, 'w') as report_file:
+                json.dump(self.report(), report_file, indent=2)
+        else:
+            json.dump(self.report(), sys.stderr, indent=2)
+            print(file=sys.stderr)
+
+
+def enabled() -> bool:
+    """
+    Whether anything is recording, for hooks that have extra work to do
+    """
+    return bool(_active)
+
+
+@contextmanager
+def profile(
+        callback: Callable[[dict[str, Any]], None] | None = None
+        ) -> Iterator[Profiler]:
+    """
+    Records everything that happens inside the with block
+    """
+    profiler: Profiler = Profiler(callback)
+    _active.append(profiler)
+    try:
+        yield profiler
+    finally:
+        _active.remove(profiler)
+
+
+@contextmanager
+def stage(name: str, remote: str | None = None) -> Iterator[None]:
+    """
+    Times the with block as a call of the named stage
+    """
+    if not _active:
+        yield
+        return
+    start: float = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds: float = time.perf_counter() - start
+        for profiler in list(_active):
+            profiler.record_stage(name, seconds, remote)
+
+
+def count(name: str, amount: int = 1) -> None:
+    """
+    Adds to a named counter
+    """
+    for profiler in list(_active):
+        profiler.count(name, amount)
+
+
+def event(name: str, **fields: Any) -> None:
+    """
+    Records a structured event and counts it
+    """
+    if not _active:
+        return
+    record: dict[str, Any] = {'type': 'event', 'event': name, **fields}
+    for profiler in list(_active):
+        profiler.count(name, 1)
+        profiler.record_event(record)
+
+
+def pop_profile_argument(arguments: list[str]) -> tuple[bool, str | None]:
+    """
+    Removes --profile or --profile=path from command line arguments. Returns
+    whether profiling was asked for and where to write the report.
+    """
+    for argument in arguments:
+        if argument == '--profile' or argument.startswith('--profile='):
+            arguments.remove(argument)
+            return True, argument.partition('=')[2] or None
+    return False, None
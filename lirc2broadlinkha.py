@@ -1,19 +1,125 @@
 # lirc2broadlinkha
 """
 Creates broadlink b64 ir codes from an lirc.conf file.
+
+requests and NumPy take far longer to import than the conversion of a local
+file takes, so they are only imported once a url or batch encoding needs them.
 """
 
-import pprint
-from typing import Dict, Any
+from __future__ import annotations
+
+import logging
+from array import array
+from typing import (TYPE_CHECKING, Dict, Any, Iterable, Iterator, Protocol,
+                    Sequence)
 from base64 import b64encode
+from functools import lru_cache
+from itertools import islice
 import struct
-import requests
+import sys
+import instrumentation
+from instrumentation import count, enabled, event, stage
+from lru import LRUCache
+
+if TYPE_CHECKING:
+    import requests
+    from fetch import ConfFetcher
+
+# NumPy is optional and only used for vectorized batch encoding. It stays
+# unloaded until load_numpy is first called, then is the module or None.
+_UNLOADED: Any = object()
+np: Any = _UNLOADED
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Bump whenever the encoded output changes, so stored codes are regenerated
+ENCODER_VERSION: int = 2
+
+def load_numpy() -> Any:
+    """
+    Imports NumPy on first use. Returns None if it isn't installed.
+    """
+    global np
+    if np is _UNLOADED:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = None
+    return np
 
 # Type aliases
 Pulse = tuple[int, int]
 Pulses = list[Pulse]
 SubConfig = Dict[str, str]
 Config = Dict[str, Any]
+Record = tuple[str, str, str]
+# bits, header on/off, one on/off, zero on/off, ptrail, gap, CONST_LENGTH,
+# pre data value and bits, post data value and bits, repeats
+TimingProfile = tuple[int, int, int, int, int, int, int, int | None, int, bool,
+                      int, int, int, int, int]
+
+class PulseTrain:
+    """
+    A pulse train stored as interleaved on/off lengths in a single typed
+    array, rather than a list of tuples. It can still be used like the old
+    list of (on, off) tuples: indexing and iterating give tuples, pairs()
+    gives the whole list and it compares equal to a matching list.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data: Iterable[int] = ()) -> None:
+        # Signed, so invalid negative gaps fail where they used to
+        self.data: array = array('i', data)
+
+    @classmethod
+    def from_pairs(cls, pairs: Iterable[Pulse]) -> 'PulseTrain':
+        """
+        Builds a pulse train from (on, off) tuples
+        """
+        return cls(value for pulse in pairs for value in pulse)
+
+    def append(self, pulse: Pulse) -> None:
+        """
+        Adds an (on, off) pulse to the end of the train
+        """
+        self.data.extend(pulse)
+
+    def pairs(self) -> Pulses:
+        """
+        The pulses as a list of (on, off) tuples
+        """
+        return list(zip(self.data[::2], self.data[1::2]))
+
+    def __len__(self) -> int:
+        return len(self.data) // 2
+
+    def __getitem__(self, index: int) -> Pulse:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('pulse index out of range')
+        return (self.data[2 * index], self.data[2 * index + 1])
+
+    def __setitem__(self, index: int, pulse: Pulse) -> None:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('pulse index out of range')
+        self.data[2 * index], self.data[2 * index + 1] = pulse
+
+    def __iter__(self) -> Iterator[Pulse]:
+        return zip(self.data[::2], self.data[1::2])
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, PulseTrain):
+            return self.data == other.data
+        if isinstance(other, (list, tuple)):
+            return self.pairs() == [tuple(pulse) for pulse in other]
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f'PulseTrain({self.pairs()!r})'
 
 def pulse_to_broadlink_hex(pulse: int) -> bytearray:
     """
@@ -31,15 +137,21 @@ def pulse_to_broadlink_hex(pulse: int) -> bytearray:
         broadlink_hex += struct.pack('>H', broadlink_pulse)
     return broadlink_hex
 
-def flatten(pulses: Pulses) -> list[int]:
+def flatten(pulses: Pulses | PulseTrain | array) -> Sequence[int]:
     """
-    Flattens a list of tuples into a single list of ints
+    Flattens a list of tuples into a single list of ints. A PulseTrain, or
+    an array of lengths such as a raw code, is already flat, so its array is
+    returned as is, without copying.
     """
+    if isinstance(pulses, PulseTrain):
+        return pulses.data
+    if isinstance(pulses, array):
+        return pulses
     flat_list = [value for pulse in pulses for value in pulse]
     return flat_list
 
 def pulses_to_broadlink_hex(
-        pulses: Pulses,
+        pulses: Pulses | PulseTrain | array,
         repeats: int = 0) -> bytes:
     """
     Convert a series of pules to a broadlink hex representation of the data
@@ -55,9 +167,14 @@ def pulses_to_broadlink_hex(
 
     # Calculate packet data
     packet: bytearray = bytearray()
-    flat_pulses: list[int] = flatten(pulses)
-    for pulse in flat_pulses:
-        packet += pulse_to_broadlink_hex(pulse)
+    flat_pulses: Sequence[int] = flatten(pulses)
+    with stage('pulses_to_broadlink_hex'):
+        for pulse in flat_pulses:
+            packet += pulse_to_broadlink_hex(pulse)
+    if enabled():
+        count('pulses', len(flat_pulses))
+        # Each pulse over 255 ticks takes 2 extra bytes
+        count('multi_byte_pulses', (len(packet) - len(flat_pulses)) // 2)
 
     # Now calculate the packet length and add it to broadlink_hex as a 2 byte,
     # little endian number
@@ -67,100 +184,1100 @@ def pulses_to_broadlink_hex(
     broadlink_hex += packet
     return broadlink_hex
 
+def broadlink_hex_to_ticks(packet: bytes) -> tuple[PulseTrain, int]:
+    """
+    Reverses pulses_to_broadlink_hex, returning the pulses as Broadlink ticks
+    along with the number of repeats. Anything after the data, such as the
+    padding on learned codes, is ignored.
+    """
+    if len(packet) < 4 or packet[0] != 0x26:
+        raise ValueError('Not a Broadlink IR packet')
+    repeats: int = packet[1]
+    packet_length: int = struct.unpack_from('<H', packet, 2)[0]
+    data: bytes = bytes(packet[4:4 + packet_length])
+    if len(data) < packet_length:
+        raise ValueError('Broadlink packet is shorter than its length byte')
+
+    ticks: array = array('i')
+    index: int = 0
+    while index < packet_length:
+        # A leading 0 marks a 2 byte, big endian pulse
+        if data[index] == 0 and index + 2 < packet_length:
+            ticks.append((data[index + 1] << 8) | data[index + 2])
+            index += 3
+        else:
+            ticks.append(data[index])
+            index += 1
+    # Learned codes can end on an on pulse
+    if len(ticks) % 2:
+        ticks.append(0)
+    return PulseTrain(ticks), repeats
+
+def broadlink_hex_to_pulses(packet: bytes) -> tuple[PulseTrain, int]:
+    """
+    Reverses pulses_to_broadlink_hex, returning pulse lengths in microseconds
+    (to within the quantization of the Broadlink ticks) and the repeats
+    """
+    ticks: PulseTrain
+    repeats: int
+    ticks, repeats = broadlink_hex_to_ticks(packet)
+    return PulseTrain(round(tick * 8192 / 269) for tick in ticks.data), repeats
+
+def ticks_to_broadlink_hex(ticks: Iterable[int], repeats: int = 0) -> bytes:
+    """
+    Builds a Broadlink packet from pulses that are already in Broadlink
+    ticks, such as those from broadlink_hex_to_ticks
+    """
+    if repeats > 255:
+        raise ValueError(
+                'Repeats has to be less than 256 to fit in a single byte'
+                )
+    packet: bytearray = bytearray()
+    for tick in ticks:
+        if tick < 256:
+            packet.append(tick)
+        else:
+            packet.append(0)
+            packet += struct.pack('>H', tick)
+    return bytes([0x26, repeats]) + struct.pack('<H', len(packet)) + packet
+
+def lirc_hex_to_int(code_hex: str, bits: int) -> tuple[int, int]:
+    """
+    Converts a hex code into an integer along with its length in bits. Codes
+    that overflow the number of bits keep all of their bits.
+    """
+    value: int = int(code_hex, base=0)
+    return value, max(bits, value.bit_length() or 1)
+
 def lirc_hex_to_binary(code_hex: str, bits: int) -> str:
     """
     Converts a hex code into a binary, padded to the correct number of bits
     """
-    # Convert hex string to a decimal integer
-    decimal_representation: int = int(code_hex, base=0)
-    # Convert decimal to binary string
-    binary_representation: str = f'{decimal_representation:b}'
-    # pad binary string with 0s to match the number of bits
-    padding_length: int = bits - len(binary_representation)
-    return '0' * padding_length + binary_representation
+    value: int
+    number_of_bits: int
+    value, number_of_bits = lirc_hex_to_int(code_hex, bits)
+    return f'{value:0{number_of_bits}b}'
 
 def lirc_to_pulses(lirc_config: Config) -> Config:
     """
     Given an lirc config as a dictionary, convert the hex codes for
-    each button into a set of timed pulses
+    each button into a set of timed pulses. Sections using anything other
+    than plain space encoding are converted by their protocol's encoder.
     """
+    codes: SubConfig = lirc_config['codes']
+    if select_encoder(lirc_config) is not SectionEncoder:
+        encoder: Any = compile_encoder(lirc_config)
+        return {code: encoder.pulses(codes[code]) for code in codes}
+
     header: SubConfig = lirc_config['header']
     one: SubConfig = lirc_config['one']
     zero: SubConfig = lirc_config['zero']
-    codes: SubConfig = lirc_config['codes']
     gap: str = lirc_config.pop('gap', '0')
     ptrail: str | None = lirc_config.pop('ptrail', None)
     flags: str | None = lirc_config.pop('flags', None)
-    post_data: str | None = lirc_config.pop('post_data', None)
+
+    # Everything that's the same for every button is only converted once
+    bits: int = int(lirc_config['bits'])
+    header_pulse: Pulse = (int(header['on']), int(header['off']))
+    one_pulse: Pulse = (int(one['on']), int(one['off']))
+    zero_pulse: Pulse = (int(zero['on']), int(zero['off']))
+    const_length: bool = bool(flags and 'CONST_LENGTH' in flags)
+    pre_value, pre_bits = data_field(lirc_config, 'pre_data')
+    post_value, post_bits = data_field(lirc_config, 'post_data')
+    lirc_config.pop('post_data', None)
 
     button_pulses: Config = {}
-    for code in codes:
-        # Get the binary representation of the codes
-        number_of_bits: int = int(lirc_config['bits'])
-        binary_code: str = lirc_hex_to_binary(codes[code], number_of_bits)
-        # Add post data bits if they exist
-        if post_data:
-            number_of_bits = int(lirc_config['post_data_bits'])
-            binary_code += lirc_hex_to_binary(post_data, number_of_bits)
-        # Start with a set of pulses for the header
-        pulses: Pulses = []
-        pulse: Pulse = (int(header['on']), int(header['off']))
-        pulses.append(pulse)
-
-        # Now go through the binary string and add pulses
-        for bit in binary_code:
-            if bit == '1':
-                pulse = (int(one['on']), int(one['off']))
-            elif bit == '0':
-                pulse = (int(zero['on']), int(zero['off']))
-
-            pulses.append(pulse)
-
-        # Finish with final pulse of the trail and gap
-        pulse_gap: int = 0
-        trail: int = 0
-        if flags and 'CONST_LENGTH' in flags:
-            pulse_gap = int(gap) - sum([sum(pulse_pair) for pulse_pair in pulses])
-        elif gap:
-            pulse_gap = int(gap)
-        if ptrail:
-            trail = int(ptrail)
-            pulse_gap = pulse_gap - trail
-            pulse = (trail, pulse_gap)
-            pulses.append(pulse)
-        # If there is no ptrail, add the gap to the last value in the last tuple
-        else:
-            final_pulse: Pulse = pulses[-1]
-            pulse_gap += final_pulse[-1]
-            pulses[-1] = (final_pulse[0], pulse_gap)
+    with stage('lirc_to_pulses'):
+        for code in codes:
+            # Combine any pre data, the code and any post data into a single
+            # integer
+            value: int
+            number_of_bits: int
+            value, number_of_bits = lirc_hex_to_int(codes[code], bits)
+            value = (pre_value << number_of_bits) | value
+            number_of_bits += pre_bits
+            value = (value << post_bits) | post_value
+            number_of_bits += post_bits
+
+            # Start with a set of pulses for the header
+            pulses: PulseTrain = PulseTrain(header_pulse)
 
-        button_pulses[code] = pulses
+            # Now go through the bits, most significant first, and add pulses
+            for shift in range(number_of_bits - 1, -1, -1):
+                pulses.data.extend(
+                        one_pulse if (value >> shift) & 1 else zero_pulse)
 
+            # Finish with final pulse of the trail and gap
+            pulse_gap: int = 0
+            trail: int = 0
+            if const_length:
+                pulse_gap = int(gap) - sum(pulses.data)
+            elif gap:
+                pulse_gap = int(gap)
+            if ptrail:
+                trail = int(ptrail)
+                pulse_gap = pulse_gap - trail
+                pulses.append((trail, pulse_gap))
+            # If there is no ptrail, add the gap to the last off pulse
+            else:
+                pulses.data[-1] += pulse_gap
+
+            button_pulses[code] = pulses
+
+    count('buttons', len(codes))
     return button_pulses
 
-def get_conf_file(path: str) -> requests.Response:
+def data_field(lirc_config: Config, key: str) -> tuple[int, int]:
+    """
+    The value and length in bits of pre_data or post_data, or (0, 0) when
+    the section doesn't have it
+    """
+    data: str | None = lirc_config.get(key, None)
+    if not data:
+        return 0, 0
+    return lirc_hex_to_int(data, int(lirc_config[f'{key}_bits']))
+
+def section_flags(lirc_config: Config) -> frozenset[str]:
+    """
+    The flags of a section, e.g. RC5|CONST_LENGTH, as a set
+    """
+    flags: str = lirc_config.get('flags', None) or ''
+    return frozenset(
+            flag.strip().upper() for flag in flags.split('|') if flag.strip())
+
+def timing_value(lirc_config: Config, key: str) -> int:
+    """
+    A single timing, such as plead, or 0 when the section doesn't have it.
+    Of timings given twice, such as a gap with a second gap, the first is
+    used.
+    """
+    value: str | SubConfig | None = lirc_config.get(key, None)
+    if isinstance(value, dict):
+        return int(value['on'])
+    return int(value) if value else 0
+
+def timing_pair(lirc_config: Config, key: str) -> Pulse:
+    """
+    An on/off timing, such as the header, or (0, 0) when the section doesn't
+    have it
+    """
+    value: str | SubConfig | None = lirc_config.get(key, None)
+    if isinstance(value, dict):
+        return int(value['on']), int(value['off'])
+    return 0, 0
+
+def timing_profile(lirc_config: Config, repeats: int = 0) -> TimingProfile:
+    """
+    Normalizes everything about a remote section that affects its encoding,
+    apart from the codes themselves, into a hashable tuple of bits, header,
+    one and zero timings, ptrail, gap, CONST_LENGTH, pre and post data and
+    repeats
+    """
+    header: SubConfig = lirc_config['header']
+    one: SubConfig = lirc_config['one']
+    zero: SubConfig = lirc_config['zero']
+    gap: str = lirc_config.get('gap', '0')
+    ptrail: str | None = lirc_config.get('ptrail', None)
+    flags: str | None = lirc_config.get('flags', None)
+
+    pre_value, pre_bits = data_field(lirc_config, 'pre_data')
+    post_value, post_bits = data_field(lirc_config, 'post_data')
+    return (
+        int(lirc_config['bits']),
+        int(header['on']), int(header['off']),
+        int(one['on']), int(one['off']),
+        int(zero['on']), int(zero['off']),
+        int(ptrail) if ptrail else None,
+        int(gap) if gap else 0,
+        bool(flags and 'CONST_LENGTH' in flags),
+        pre_value, pre_bits,
+        post_value, post_bits,
+        int(repeats),
+        )
+
+# Tables are about 30kB, so only keep as many as a streamed export of the whole
+# lirc database can hold in constant memory
+@lru_cache(maxsize=128)
+def bit_tables(one: bytes, zero: bytes) -> tuple[tuple[bytes, ...], ...]:
+    """
+    Builds lookup tables mapping every value of a 1 to 8 bit chunk to its
+    ready-made Broadlink pulse bytes, most significant bit first.
+    tables[width][value] gives the bytes for a chunk of that width.
+    """
+    tables: list[tuple[bytes, ...]] = [()]
+    for width in range(1, 9):
+        table: list[bytes] = []
+        for value in range(1 << width):
+            table.append(b''.join(
+                    one if (value >> shift) & 1 else zero
+                    for shift in range(width - 1, -1, -1)
+                    ))
+        tables.append(tuple(table))
+    return tuple(tables)
+
+class SectionEncoder:
+    """
+    Encoder compiled once per remote section. All of the fixed timings are
+    converted to Broadlink bytes up front, so encoding a button is a handful
+    of table lookups and a single join. Output is byte-identical to
+    pulses_to_broadlink_hex(lirc_to_pulses(...)).
+    """
+
+    def __init__(self, lirc_config: Config, repeats: int = 0) -> None:
+        self.compile(timing_profile(lirc_config, repeats))
+
+    @classmethod
+    def from_profile(cls, profile: TimingProfile) -> 'SectionEncoder':
+        """
+        Compiles an encoder straight from a timing profile
+        """
+        encoder: SectionEncoder = cls.__new__(cls)
+        encoder.compile(profile)
+        return encoder
+
+    def compile(self, profile: TimingProfile) -> None:
+        """
+        Converts the fixed timings of a profile to Broadlink bytes
+        """
+        self.profile: TimingProfile = profile
+        repeats: int
+        (self.bits, self.header_on, self.header_off, self.one_on,
+         self.one_off, self.zero_on, self.zero_off, self.ptrail, self.gap,
+         self.const_length, self.pre_value, self.pre_bits, self.post_value,
+         self.post_bits, repeats) = profile
+        if repeats > 255:
+            raise ValueError(
+                    'Repeats has to be less than 256 to fit in a single byte'
+                    )
+        self.header_length: int = self.header_on + self.header_off
+
+        # Pre-encoded Broadlink bytes for the fixed timings
+        self.prefix: bytes = bytes([0x26, repeats])
+        self.header_bytes: bytes = bytes(
+                pulse_to_broadlink_hex(self.header_on)
+                + pulse_to_broadlink_hex(self.header_off)
+                )
+        self.one_on_bytes: bytes = bytes(pulse_to_broadlink_hex(self.one_on))
+        self.zero_on_bytes: bytes = bytes(
+                pulse_to_broadlink_hex(self.zero_on)
+                )
+        self.tables: tuple[tuple[bytes, ...], ...] = bit_tables(
+                self.one_on_bytes + bytes(pulse_to_broadlink_hex(self.one_off)),
+                self.zero_on_bytes + bytes(pulse_to_broadlink_hex(self.zero_off))
+                )
+        # The trailing pulse only depends on the gap, which only changes
+        # between buttons for CONST_LENGTH remotes, so cache it per gap
+        self.trail_cache: dict[int, bytes] = {}
+
+    def trail(self, pulse_gap: int) -> bytes:
+        """
+        Broadlink bytes for the ptrail pulse followed by the remaining gap
+        """
+        assert self.ptrail is not None
+        trail_bytes: bytes | None = self.trail_cache.get(pulse_gap)
+        if trail_bytes is None:
+            trail_bytes = bytes(
+                    pulse_to_broadlink_hex(self.ptrail)
+                    + pulse_to_broadlink_hex(pulse_gap - self.ptrail)
+                    )
+            self.trail_cache[pulse_gap] = trail_bytes
+        return trail_bytes
+
+    def code_to_int(self, code_hex: str) -> tuple[int, int]:
+        """
+        Returns the full code, including pre and post data, as an integer
+        along with its length in bits
+        """
+        value: int
+        number_of_bits: int
+        value, number_of_bits = lirc_hex_to_int(code_hex, self.bits)
+        if self.pre_bits:
+            value = (self.pre_value << number_of_bits) | value
+            number_of_bits += self.pre_bits
+        if self.post_bits:
+            value = (value << self.post_bits) | self.post_value
+            number_of_bits += self.post_bits
+        return value, number_of_bits
+
+    def pulse_count(self, code_hex: str) -> int:
+        """
+        Number of on and off pulses in the packet for a code
+        """
+        number_of_bits: int = self.code_to_int(code_hex)[1]
+        # Header and bits, plus the ptrail and gap if there is a ptrail
+        pulses: int = 2 * (number_of_bits + 1)
+        if self.ptrail is not None:
+            pulses += 2
+        return pulses
+
+    def chunk_bytes(self, value: int, number_of_bits: int) -> bytes:
+        """
+        Converts the given bits into pulse bytes a byte at a time
+        """
+        if number_of_bits <= 0:
+            return b''
+        lead: int = number_of_bits % 8
+        full: int = number_of_bits - lead
+        table: tuple[bytes, ...] = self.tables[8]
+        body: bytes = b''.join(map(
+                table.__getitem__,
+                (value & ((1 << full) - 1)).to_bytes(full // 8, 'big')
+                ))
+        if lead:
+            return self.tables[lead][value >> full] + body
+        return body
+
+    def encode(self, code_hex: str) -> bytes:
+        """
+        Converts a single lirc code to a complete Broadlink packet
+        """
+        value: int
+        number_of_bits: int
+        value, number_of_bits = self.code_to_int(code_hex)
+
+        pulse_gap: int = self.gap
+        if self.const_length:
+            ones: int = value.bit_count()
+            pulse_gap -= (
+                    self.header_length
+                    + ones * (self.one_on + self.one_off)
+                    + (number_of_bits - ones) * (self.zero_on + self.zero_off)
+                    )
+
+        if self.ptrail is not None:
+            body: bytes = self.chunk_bytes(value, number_of_bits)
+            tail: bytes = self.trail(pulse_gap)
+        else:
+            # The gap is added to the off pulse of the final bit
+            body = self.chunk_bytes(value >> 1, number_of_bits - 1)
+            if value & 1:
+                tail = self.one_on_bytes + bytes(
+                        pulse_to_broadlink_hex(self.one_off + pulse_gap)
+                        )
+            else:
+                tail = self.zero_on_bytes + bytes(
+                        pulse_to_broadlink_hex(self.zero_off + pulse_gap)
+                        )
+
+        packet_length: int = len(self.header_bytes) + len(body) + len(tail)
+        return b''.join((
+                self.prefix,
+                struct.pack('<H', packet_length),
+                self.header_bytes,
+                body,
+                tail
+                ))
+
+    @classmethod
+    def supports(cls, lirc_config: Config, repeats: int = 0) -> bool:
+        """
+        Whether a space encoded section only uses what this encoder handles:
+        a header, one and zero timings, pre and post data, a ptrail and a
+        gap, with repeats that are the whole code again
+        """
+        flags: frozenset[str] = section_flags(lirc_config)
+        if flags - {'SPACE_ENC', 'CONST_LENGTH'} - REPEAT_FLAGS:
+            return False
+        if 'header' not in lirc_config or isinstance(lirc_config.get('gap'), dict):
+            return False
+        if any(key in lirc_config for key in ('plead', 'pre', 'post', 'foot')):
+            return False
+        # lirc leaves the header out of CONST_LENGTH, even for the first frame
+        if {'NO_HEAD_REP', 'CONST_LENGTH'} <= flags:
+            return False
+        return not repeats or not (
+                flags & {'NO_HEAD_REP', 'NO_FOOT_REP'} or 'repeat' in lirc_config)
+
+    profile_of = staticmethod(timing_profile)
+
+class Encoder(Protocol):
+    """
+    What every protocol encoder provides
+    """
+    profile: tuple
+
+    def encode(self, code_hex: str) -> bytes: ...
+
+    def pulse_count(self, code_hex: str) -> int: ...
+
+class UnsupportedProtocolError(ValueError):
+    """
+    Raised for a section using a protocol no encoder is registered for
+    """
+
+# Flags that pick how bits are sent, in the order they are looked for. The
+# other flags, such as CONST_LENGTH, only change the timing around them.
+PROTOCOL_FLAGS: tuple[str, ...] = (
+    'RAW_CODES', 'RC5', 'SHIFT_ENC', 'RC6', 'RCMM', 'SPACE_FIRST', 'GOLDSTAR',
+    'GRUNDIG', 'BO', 'SERIAL', 'XMP', 'SPACE_ENC',
+    )
+# Flags that change the frames sent for repeats
+REPEAT_FLAGS: frozenset[str] = frozenset(
+        {'NO_HEAD_REP', 'NO_FOOT_REP', 'REPEAT_HEADER'})
+
+# Encoder classes by protocol flag, filled in by register_encoder
+ENCODERS: dict[str, type] = {'SPACE_ENC': SectionEncoder}
+
+def register_encoder(*flags: str) -> Any:
+    """
+    Class decorator registering an encoder for the given protocol flags. An
+    encoder class needs a profile_of(lirc_config, repeats) static method
+    returning a hashable profile, a from_profile class method, a supports
+    class method, the methods of Encoder and a pulses method giving the on
+    and off lengths of a code, which lirc_to_pulses uses.
+    """
+    def register(encoder_class: type) -> type:
+        for flag in flags:
+            ENCODERS[flag] = encoder_class
+        return encoder_class
+    return register
+
+def section_protocol(lirc_config: Config) -> str:
+    """
+    The protocol flag of a section, which is SPACE_ENC when none is given
+    """
+    flags: frozenset[str] = section_flags(lirc_config)
+    return next((flag for flag in PROTOCOL_FLAGS if flag in flags), 'SPACE_ENC')
+
+def select_encoder(lirc_config: Config, repeats: int = 0) -> type:
+    """
+    Picks the encoder class for a section from its flags. Space encoded
+    sections that need more than SectionEncoder handles, such as a plead or
+    repeat frames, use SignalEncoder.
+    """
+    protocol: str = section_protocol(lirc_config)
+    encoder_class: type | None = ENCODERS.get(protocol)
+    if encoder_class is None:
+        raise UnsupportedProtocolError(f'{protocol} remotes are not supported')
+    if encoder_class is SectionEncoder and not SectionEncoder.supports(
+            lirc_config, repeats):
+        return SignalEncoder
+    return encoder_class
+
+class LengthBytes(dict):
+    """
+    Broadlink bytes for each length, converted the first time it's looked
+    up, so encoding looks every length up without any Python calls
+    """
+
+    def __missing__(self, length: int) -> bytes:
+        length_bytes: bytes = bytes(pulse_to_broadlink_hex(length))
+        self[length] = length_bytes
+        return length_bytes
+
+class SignalBuilder:
+    """
+    Collects on and off lengths the way lirc's transmitter does: a length of
+    the same kind as the one before is added to it, and off lengths before
+    the first on length are dropped. total is the length of everything sent.
+    """
+    __slots__ = ('lengths', 'total')
+
+    def __init__(self, lengths: Iterable[int] = (), total: int = 0) -> None:
+        self.lengths: list[int] = list(lengths)
+        self.total: int = total
+
+    def copy(self) -> 'SignalBuilder':
+        """
+        A copy to add more lengths to
+        """
+        return SignalBuilder(self.lengths, self.total)
+
+    def pulse(self, length: int) -> None:
+        """
+        Adds an on length
+        """
+        if length <= 0:
+            return
+        self.total += length
+        if len(self.lengths) % 2:
+            self.lengths[-1] += length
+        else:
+            self.lengths.append(length)
+
+    def space(self, length: int) -> None:
+        """
+        Adds an off length
+        """
+        if length <= 0 or not self.lengths:
+            return
+        self.total += length
+        if len(self.lengths) % 2:
+            self.lengths.append(length)
+        else:
+            self.lengths[-1] += length
+
+# protocol, other flags, bits, header, one, zero, plead, ptrail, pre, post,
+# foot and repeat timings, pre and post data values and bits, gap, repeat gap,
+# rc6 mask, toggle mask and repeats
+SignalProfile = tuple[str, tuple[str, ...], int, Pulse, Pulse, Pulse, int, int,
+                      Pulse, Pulse, Pulse, Pulse, int, int, int, int, int, int,
+                      int, int, int]
+
+@register_encoder('SPACE_FIRST', 'RC5', 'SHIFT_ENC', 'RC6')
+class SignalEncoder:
+    """
+    Encoder for space, space first and bi-phase (RC5 and RC6) sections, with
+    everything lirc sends around the bits: plead, pre and post data and
+    pulses, ptrail, foot, repeat frames and toggle bits, in the order lirc
+    sends them. The header and pre data are built once per section, and
+    every distinct length is only converted to Broadlink bytes once, so
+    encoding a button is mostly adding the lengths of its bits.
+    """
+
+    def __init__(self, lirc_config: Config, repeats: int = 0) -> None:
+        self.compile(self.profile_of(lirc_config, repeats))
+
+    @classmethod
+    def from_profile(cls, profile: SignalProfile) -> 'SignalEncoder':
+        """
+        Compiles an encoder straight from a profile
+        """
+        encoder: SignalEncoder = cls.__new__(cls)
+        encoder.compile(profile)
+        return encoder
+
+    @staticmethod
+    def profile_of(lirc_config: Config, repeats: int = 0) -> SignalProfile:
+        """
+        Normalizes everything about a section that affects its encoding,
+        apart from the codes themselves, into a hashable tuple
+        """
+        protocol: str = section_protocol(lirc_config)
+        flags: frozenset[str] = section_flags(lirc_config)
+        bits: int = int(lirc_config['bits'])
+        one: SubConfig = lirc_config['one']
+        zero: SubConfig = lirc_config['zero']
+        pre_value, pre_bits = data_field(lirc_config, 'pre_data')
+        post_value, post_bits = data_field(lirc_config, 'post_data')
+        all_bits: int = pre_bits + bits + post_bits
+
+        # toggle_bit is the older way of giving a single bit mask, counted
+        # from the first bit sent
+        toggle_mask: int = int(lirc_config.get('toggle_bit_mask', '0'), base=0)
+        toggle_bit: int = int(lirc_config.get('toggle_bit', '0'))
+        if toggle_bit and not toggle_mask:
+            toggle_mask = 1 << (all_bits - toggle_bit)
+        # RC6 sends its trailer bit, after the start bit and 3 mode bits, at
+        # double length
+        rc6_mask: int = int(lirc_config.get('rc6_mask', '0'), base=0)
+        if protocol == 'RC6' and not rc6_mask and all_bits >= 5:
+            rc6_mask = 1 << (all_bits - 5)
+
+        return (
+            protocol,
+            tuple(sorted(flags - {protocol})),
+            bits,
+            timing_pair(lirc_config, 'header'),
+            (int(one['on']), int(one['off'])),
+            (int(zero['on']), int(zero['off'])),
+            timing_value(lirc_config, 'plead'),
+            timing_value(lirc_config, 'ptrail'),
+            timing_pair(lirc_config, 'pre'),
+            timing_pair(lirc_config, 'post'),
+            timing_pair(lirc_config, 'foot'),
+            timing_pair(lirc_config, 'repeat'),
+            pre_value, pre_bits,
+            post_value, post_bits,
+            timing_value(lirc_config, 'gap'),
+            timing_value(lirc_config, 'repeat_gap'),
+            rc6_mask,
+            toggle_mask,
+            int(repeats),
+            )
+
+    @classmethod
+    def supports(cls, lirc_config: Config, repeats: int = 0) -> bool:
+        """
+        Every section of the registered protocols is supported
+        """
+        return True
+
+    def compile(self, profile: SignalProfile) -> None:
+        """
+        Builds the parts of a frame that are the same for every button
+        """
+        self.profile: SignalProfile = profile
+        (self.protocol, self.modifiers, self.bits, self.header, self.one,
+         self.zero, self.plead, self.ptrail, self.pre, self.post, self.foot,
+         self.repeat, self.pre_value, self.pre_bits, self.post_value,
+         self.post_bits, self.gap, self.repeat_gap, self.rc6_mask,
+         self.toggle_mask, self.repeats) = profile
+        if self.repeats > 255:
+            raise ValueError(
+                    'Repeats has to be less than 256 to fit in a single byte'
+                    )
+        self.biphase: bool = self.protocol in ('RC5', 'SHIFT_ENC', 'RC6')
+        self.space_first: bool = self.protocol == 'SPACE_FIRST'
+        self.const_length: bool = 'CONST_LENGTH' in self.modifiers
+        self.reverse: bool = 'REVERSE' in self.modifiers
+        self.no_head_repeat: bool = 'NO_HEAD_REP' in self.modifiers
+        self.no_foot_repeat: bool = 'NO_FOOT_REP' in self.modifiers
+        self.repeat_header: bool = 'REPEAT_HEADER' in self.modifiers
+        self.all_bits: int = self.pre_bits + self.bits + self.post_bits
+        self.has_repeat: bool = self.repeat[0] > 0 and self.repeat[1] > 0
+        # Repeats that differ from the first frame are written out in full,
+        # as the repeat byte can only repeat the whole packet
+        self.repeat_frames: bool = bool(self.repeats) and (
+                self.has_repeat or self.no_head_repeat or self.no_foot_repeat)
+        self.prefix: bytes = bytes(
+                [0x26, 0 if self.repeat_frames else self.repeats])
+        # Broadlink bytes for each length, and the start of each kind of frame
+        self.length_bytes: LengthBytes = LengthBytes()
+        self.lead_cache: dict[tuple[bool, bool], SignalBuilder] = {}
+
+    def add_bits(
+            self,
+            signal: SignalBuilder,
+            value: int,
+            number_of_bits: int,
+            done: int,
+            toggled: bool) -> None:
+        """
+        Adds the lengths for number_of_bits bits of value, most significant
+        first. done is the number of bits of the frame sent before them,
+        which places them against the toggle and RC6 masks.
+        """
+        if number_of_bits <= 0:
+            return
+        if self.reverse:
+            value = int(f'{value:0{number_of_bits}b}'[::-1], base=2)
+        # Masks count from the last bit of the frame
+        remaining: int = self.all_bits - done - number_of_bits
+        rc6_mask: int = 0
+        if remaining >= 0:
+            part: int = (1 << number_of_bits) - 1
+            rc6_mask = (self.rc6_mask >> remaining) & part
+            if toggled:
+                value ^= (self.toggle_mask >> remaining) & part
+        one_on, one_off = self.one
+        zero_on, zero_off = self.zero
+        for shift in range(number_of_bits - 1, -1, -1):
+            scale: int = 2 if (rc6_mask >> shift) & 1 else 1
+            if (value >> shift) & 1:
+                if self.biphase or self.space_first:
+                    signal.space(one_off * scale)
+                    signal.pulse(one_on * scale)
+                else:
+                    signal.pulse(one_on)
+                    signal.space(one_off)
+            elif self.space_first:
+                signal.space(zero_off)
+                signal.pulse(zero_on)
+            else:
+                signal.pulse(zero_on * scale)
+                signal.space(zero_off * scale)
+
+    def lead(self, repeat: bool, toggled: bool) -> SignalBuilder:
+        """
+        The header, plead and pre data and pulses of a frame, which are the
+        same for every button
+        """
+        signal: SignalBuilder | None = self.lead_cache.get((repeat, toggled))
+        if signal is None:
+            signal = SignalBuilder()
+            if not repeat or not self.no_head_repeat:
+                signal.pulse(self.header[0])
+                signal.space(self.header[1])
+            signal.pulse(self.plead)
+            self.add_bits(signal, self.pre_value, self.pre_bits, 0, toggled)
+            if self.pre_bits and self.pre[0] > 0 and self.pre[1] > 0:
+                signal.pulse(self.pre[0])
+                signal.space(self.pre[1])
+            self.lead_cache[(repeat, toggled)] = signal
+        return signal.copy()
+
+    def frame(
+            self,
+            value: int,
+            number_of_bits: int,
+            repeat: bool = False,
+            toggled: bool = False) -> list[int]:
+        """
+        The on and off lengths of a single frame, ending with the gap
+        """
+        signal: SignalBuilder
+        if repeat and self.has_repeat:
+            signal = SignalBuilder()
+            if self.repeat_header:
+                signal.pulse(self.header[0])
+                signal.space(self.header[1])
+            signal.pulse(self.plead)
+            signal.pulse(self.repeat[0])
+            signal.space(self.repeat[1])
+            signal.pulse(self.ptrail)
+        else:
+            signal = self.lead(repeat, toggled)
+            self.add_bits(signal, value, number_of_bits, self.pre_bits, toggled)
+            if self.post_bits:
+                if self.post[0] > 0 and self.post[1] > 0:
+                    signal.pulse(self.post[0])
+                    signal.space(self.post[1])
+                self.add_bits(signal, self.post_value, self.post_bits,
+                              self.pre_bits + self.bits, toggled)
+            signal.pulse(self.ptrail)
+            if not repeat or not self.no_foot_repeat:
+                if self.foot[0] > 0 and self.foot[1] > 0:
+                    signal.space(self.foot[1])
+                    signal.pulse(self.foot[0])
+            if not repeat and self.no_head_repeat and self.const_length:
+                signal.total -= sum(self.header)
+
+        if self.const_length:
+            pulse_gap: int = self.gap - signal.total
+        elif repeat and self.has_repeat and self.repeat_gap:
+            pulse_gap = self.repeat_gap
+        else:
+            pulse_gap = self.gap
+        # As in SectionEncoder, a gap after a ptrail includes the ptrail
+        if self.ptrail and not self.const_length:
+            pulse_gap -= self.ptrail
+        pulse_gap = max(pulse_gap, 0)
+        lengths: list[int] = signal.lengths
+        if len(lengths) % 2:
+            lengths.append(pulse_gap)
+        elif lengths:
+            lengths[-1] += pulse_gap
+        return lengths
+
+    def lengths(self, code_hex: str, toggled: bool = False) -> list[int]:
+        """
+        The on and off lengths of every frame sent for a code
+        """
+        value: int
+        number_of_bits: int
+        value, number_of_bits = lirc_hex_to_int(code_hex, self.bits)
+        lengths: list[int] = self.frame(value, number_of_bits, toggled=toggled)
+        if self.repeat_frames:
+            repeat_frame: list[int] = self.frame(
+                    value, number_of_bits, True, toggled)
+            lengths.extend(repeat_frame * self.repeats)
+        return lengths
+
+    def pulses(self, code_hex: str) -> PulseTrain:
+        """
+        The on and off lengths of a code in microseconds
+        """
+        return PulseTrain(self.lengths(code_hex))
+
+    def pulse_count(self, code_hex: str) -> int:
+        """
+        Number of on and off pulses in the packet for a code
+        """
+        return len(self.lengths(code_hex))
+
+    def encode(self, code_hex: str, toggled: bool = False) -> bytes:
+        """
+        Converts a single lirc code to a complete Broadlink packet. toggled
+        flips the toggle bits, for the alternate presses of remotes such as
+        RC5 ones, which ignore a press that repeats the last toggle.
+        """
+        body: bytes = b''.join(map(
+                self.length_bytes.__getitem__, self.lengths(code_hex, toggled)))
+        return b''.join((self.prefix, struct.pack('<H', len(body)), body))
+
+@register_encoder('RAW_CODES')
+class RawEncoder:
+    """
+    Encoder for raw_codes sections, whose buttons are parsed straight into
+    arrays of on and off lengths. Only the gap is added, so the arrays are
+    converted as they are, without copying. Output is byte-identical to
+    pulses_to_broadlink_hex of the lengths followed by the gap.
+    """
+
+    def __init__(self, lirc_config: Config, repeats: int = 0) -> None:
+        self.compile(self.profile_of(lirc_config, repeats))
+
+    @classmethod
+    def from_profile(cls, profile: tuple[int, bool, int]) -> 'RawEncoder':
+        """
+        Compiles an encoder straight from a profile
+        """
+        encoder: RawEncoder = cls.__new__(cls)
+        encoder.compile(profile)
+        return encoder
+
+    @staticmethod
+    def profile_of(lirc_config: Config, repeats: int = 0) -> tuple[int, bool, int]:
+        """
+        The gap, CONST_LENGTH and repeats, which are all that affect the
+        encoding of raw codes
+        """
+        return (
+            timing_value(lirc_config, 'gap'),
+            'CONST_LENGTH' in section_flags(lirc_config),
+            int(repeats),
+            )
+
+    @classmethod
+    def supports(cls, lirc_config: Config, repeats: int = 0) -> bool:
+        """
+        Every raw_codes section is supported
+        """
+        return True
+
+    def compile(self, profile: tuple[int, bool, int]) -> None:
+        """
+        Builds the packet prefix
+        """
+        self.profile: tuple[int, bool, int] = profile
+        repeats: int
+        self.gap, self.const_length, repeats = profile
+        if repeats > 255:
+            raise ValueError(
+                    'Repeats has to be less than 256 to fit in a single byte'
+                    )
+        self.prefix: bytes = bytes([0x26, repeats])
+        self.length_bytes: LengthBytes = LengthBytes()
+
+    def pulse_gap(self, raw: array) -> int:
+        """
+        The gap after a raw code
+        """
+        if self.const_length:
+            return max(self.gap - sum(raw), 0)
+        return self.gap
+
+    def pulses(self, raw: array) -> PulseTrain:
+        """
+        The on and off lengths of a code in microseconds, ending with the gap
+        """
+        pulses: PulseTrain = PulseTrain(raw)
+        if len(pulses.data) % 2:
+            pulses.data.append(self.pulse_gap(raw))
+        elif pulses.data:
+            pulses.data[-1] += self.pulse_gap(raw)
+        return pulses
+
+    def pulse_count(self, raw: array) -> int:
+        """
+        Number of on and off pulses in the packet for a code
+        """
+        return len(raw) + len(raw) % 2
+
+    def encode(self, raw: array) -> bytes:
+        """
+        Converts a single raw code to a complete Broadlink packet
+        """
+        pulse_gap: int = self.pulse_gap(raw)
+        length_bytes: LengthBytes = self.length_bytes
+        if len(raw) % 2:
+            body: bytes = b''.join(map(length_bytes.__getitem__, raw))
+            body += length_bytes[pulse_gap]
+        elif raw:
+            # A code ending on an off length has the gap added to it
+            body = b''.join(map(length_bytes.__getitem__,
+                                islice(raw, len(raw) - 1)))
+            body += length_bytes[raw[-1] + pulse_gap]
+        else:
+            body = b''
+        return b''.join((self.prefix, struct.pack('<H', len(body)), body))
+
+class EncoderCache:
+    """
+    Compiled encoders keyed by timing profile, so the many remotes that share
+    a protocol share one encoder. Holds at most max_entries encoders in
+    memory.
+    """
+
+    def __init__(self, max_entries: int = 128) -> None:
+        self.entries: LRUCache = LRUCache(max_entries)
+        self.compiled: int = 0
+
+    def get(self, profile: tuple, encoder_class: type | None = None) -> Encoder:
+        """
+        Returns the encoder for a profile, compiling it if it isn't cached.
+        Profiles are SectionEncoder ones unless another encoder_class is
+        given.
+        """
+        encoder_class = encoder_class or SectionEncoder
+        key: tuple[str, tuple] = (encoder_class.__name__, profile)
+        encoder: Encoder | None = self.entries.get(key)
+        if encoder is None:
+            encoder = encoder_class.from_profile(profile)
+            self.compiled += 1
+            self.entries.put(key, encoder)
+        return encoder
+
+    def metrics(self) -> dict[str, int]:
+        """
+        Memory cache metrics, along with how many encoders were compiled
+        """
+        return {**self.entries.metrics(), 'compiled': self.compiled}
+
+_default_encoder_cache: EncoderCache | None = None
+
+def default_encoder_cache() -> EncoderCache:
+    """
+    The encoder cache shared by every conversion in this process
+    """
+    global _default_encoder_cache
+    if _default_encoder_cache is None:
+        _default_encoder_cache = EncoderCache()
+    return _default_encoder_cache
+
+def compile_encoder(
+        lirc_config: Config,
+        repeats: int = 0,
+        cache: EncoderCache | None = None) -> Encoder:
+    """
+    Returns the encoder for a single remote section, picked from its flags
+    and shared with any other section with the same profile. Raises
+    UnsupportedProtocolError for protocols without an encoder.
+    """
+    if cache is None:
+        cache = default_encoder_cache()
+    encoder_class: type = select_encoder(lirc_config, repeats)
+    return cache.get(encoder_class.profile_of(lirc_config, repeats), encoder_class)
+
+def vectorized_encode(encoder: Encoder, codes: SubConfig) -> dict[str, bytes]:
+    """
+    Encodes every button of a section with a handful of NumPy array
+    operations rather than per-pulse Python calls. Output is byte-identical
+    to SectionEncoder.encode, which is used directly when NumPy isn't
+    installed, for any codes that don't fit in 64 bits and by encoders for
+    other protocols.
+    """
+    if load_numpy() is None or not isinstance(encoder, SectionEncoder):
+        return {button: encoder.encode(code_hex)
+                for button, code_hex in codes.items()}
+
+    # Group codes by length, as codes that overflow the bit count are longer
+    groups: dict[int, list[tuple[str, int]]] = {}
+    encoded: dict[str, bytes] = {}
+    for button, code_hex in codes.items():
+        value: int
+        number_of_bits: int
+        value, number_of_bits = encoder.code_to_int(code_hex)
+        if number_of_bits > 64:
+            encoded[button] = encoder.encode(code_hex)
+        else:
+            groups.setdefault(number_of_bits, []).append((button, value))
+
+    for number_of_bits, group in groups.items():
+        buttons: list[str] = [button for button, _ in group]
+        values = np.array([value for _, value in group], dtype=np.uint64)
+        # (buttons x bits) matrix, most significant bit first
+        shifts = np.arange(number_of_bits - 1, -1, -1, dtype=np.uint64)
+        bit_matrix = ((values[:, None] >> shifts) & np.uint64(1)).astype(bool)
+
+        # Pick on/off timings for every bit, after the header pulse
+        columns: int = 2 * number_of_bits + 2
+        if encoder.ptrail is not None:
+            columns += 2
+        pulses = np.empty((len(group), columns), dtype=np.int64)
+        pulses[:, 0] = encoder.header_on
+        pulses[:, 1] = encoder.header_off
+        end: int = 2 * number_of_bits + 2
+        pulses[:, 2:end:2] = np.where(
+                bit_matrix, encoder.one_on, encoder.zero_on)
+        pulses[:, 3:end:2] = np.where(
+                bit_matrix, encoder.one_off, encoder.zero_off)
+
+        # Finish with the trail and gap
+        pulse_gap = np.full(len(group), encoder.gap, dtype=np.int64)
+        if encoder.const_length:
+            pulse_gap -= pulses[:, :end].sum(axis=1)
+        if encoder.ptrail is not None:
+            pulses[:, end] = encoder.ptrail
+            pulses[:, end + 1] = pulse_gap - encoder.ptrail
+        else:
+            pulses[:, end - 1] += pulse_gap
+
+        # Same quantization as pulse_to_broadlink_hex
+        ticks = (pulses * 269 / 8192).astype(np.int64)
+        # Leave anything that can't be encoded to the scalar path, which
+        # raises the same errors as pulses_to_broadlink_hex
+        invalid = ((ticks < 0) | (ticks > 0xFFFF)).any(axis=1)
+
+        # Pulses of 256 ticks or more take 3 bytes: 0x00 then big endian
+        flat_ticks = ticks.ravel()
+        widths = np.where(flat_ticks < 256, 1, 3)
+        ends = np.cumsum(widths)
+        starts = ends - widths
+        single = widths == 1
+        packet_bytes = np.zeros(int(ends[-1]), dtype=np.uint8)
+        packet_bytes[starts[single]] = flat_ticks[single]
+        packet_bytes[starts[~single] + 1] = flat_ticks[~single] >> 8
+        packet_bytes[starts[~single] + 2] = flat_ticks[~single] & 0xFF
+        data: bytes = packet_bytes.tobytes()
+
+        # Split the byte stream back into one packet per button
+        row_lengths = widths.reshape(ticks.shape).sum(axis=1)
+        row_ends = np.cumsum(row_lengths)
+        for row, button in enumerate(buttons):
+            if invalid[row]:
+                encoded[button] = encoder.encode(codes[button])
+                continue
+            row_end: int = int(row_ends[row])
+            row_length: int = int(row_lengths[row])
+            encoded[button] = b''.join((
+                    encoder.prefix,
+                    struct.pack('<H', row_length),
+                    data[row_end - row_length:row_end]
+                    ))
+
+    # Keep the order of the codes block
+    return {button: encoded[button] for button in codes}
+
+def get_conf_file(
+        path: str,
+        fetcher: ConfFetcher | None = None) -> requests.Response:
     """
     Pulls an lirc.conf file from the given path and returns the page text
     Parameters:
     path:
         Url to the lirc.conf file
+    fetcher:
+        Fetcher to use, defaults to the shared, cached one
     """
-    lirc_request: requests.Response = requests.get(path)
+    if fetcher is None:
+        from fetch import default_fetcher
+        fetcher = default_fetcher()
+    with stage('get_conf_file', remote=path):
+        lirc_request: requests.Response = fetcher.get(path)
+    count('bytes_fetched', len(lirc_request.content))
     return lirc_request
 
-def parse_lirc(text: str) -> Config:
+def is_url(source: str) -> bool:
     """
-    Parses a string and creates a dict with the parameters of the remote
+    Checks whether a source is a url rather than a local path
     """
-    # Create an empty dict to store the configuration
-    remote_config: Config = {}
+    return source.startswith(('http://', 'https://'))
+
+def load_conf_text(source: str) -> str:
+    """
+    Reads an lirc.conf file from a url, a local path or, given -, stdin
+    """
+    if source == '-':
+        return sys.stdin.read()
+    if is_url(source):
+        response = get_conf_file(source)
+        response.raise_for_status()
+        return response.text
+    # Some configurations in the lirc database aren't valid utf-8
+    with open(source, encoding='utf-8', errors='replace') as conf_file:
+        return conf_file.read()
 
-    # Read through text line by line until "begin remote" is found.
+def iter_lirc_sections(lines: Iterable[str | bytes]) -> Iterator[tuple[str, Config]]:
+    """
+    Parses lirc config lines from any iterable, such as an open file,
+    Response.iter_lines() or a gzip stream, and yields the name and parameters
+    of each remote as soon as its "end remote" line is read. Only the current
+    section is held in memory. The codes of a raw_codes block are read
+    straight into arrays of on and off lengths.
+    """
+    # Read through the lines until "begin remote" is found.
     read_line_flag: bool = False # determines whether to skip the line
     read_code_flag: bool = False # determines whether line is part of code block
+    read_raw_flag: bool = False # determines whether line is part of raw_codes
 
-    line: str
-    for line in text.split('\n'):
+    raw_line: str | bytes
+    for raw_line in lines:
+        # Lines from files keep their line endings and iter_lines gives bytes
+        if isinstance(raw_line, bytes):
+            raw_line = raw_line.decode('utf-8', errors='replace')
+        line: str = raw_line.rstrip('\r\n')
         if line == 'begin remote':
             read_line_flag = True
             section_config: Config = {}
@@ -168,13 +1285,49 @@ def parse_lirc(text: str) -> Config:
 
         if line == 'end remote':
             read_line_flag = False
-            remote_config[section_config.pop('name')] = section_config
+            count('sections')
+            yield section_config.pop('name'), section_config
             continue
 
         # Skip the line if read_line_flag is false
         if not read_line_flag:
             continue
 
+        # Raw codes are a name line followed by lines of lengths
+        if read_raw_flag:
+            if 'end raw_codes' in line:
+                read_raw_flag = False
+                section_config['codes'] = raw_codes
+                flags: str | None = section_config.get('flags', None)
+                if 'RAW_CODES' not in section_flags(section_config):
+                    section_config['flags'] = (
+                            f'RAW_CODES|{flags}' if flags else 'RAW_CODES')
+                continue
+            raw_elements: list[str] = line.split()
+            if not raw_elements or raw_elements[0].startswith('#'):
+                continue
+            if raw_elements[0] == 'name' and len(raw_elements) == 2:
+                raw_code = array('i')
+                raw_codes[raw_elements[1]] = raw_code
+                continue
+            length: int = len(raw_code) if raw_code is not None else 0
+            try:
+                if raw_code is None:
+                    raise ValueError('lengths before the first name')
+                raw_code.extend(map(int, raw_elements))
+            except ValueError:
+                # Drop any lengths read before the bad one
+                if raw_code is not None:
+                    del raw_code[length:]
+                logger.debug("Couldn't parse line: %s. Continuing to next line.", line)
+                event('unparsed_line', line=line, remote=section_config.get('name'))
+            continue
+        if 'begin raw_codes' in line:
+            read_raw_flag = True
+            raw_codes: dict[str, array] = {}
+            raw_code: array | None = None
+            continue
+
         # Set code block flag
         if 'begin codes' in line:
             read_code_flag = True
@@ -203,44 +1356,169 @@ def parse_lirc(text: str) -> Config:
             sub_dict['on'] = line_elements[1]
             sub_dict['off'] = line_elements[2]
             section_config[line_elements[0]] = sub_dict
-        # Else I can't parse the line. Print a warning and continue
+        # Else I can't parse the line. Record it and continue
         else:
-            print(f"Couldn't parse line: {line}. Continuing to next line.")
+            logger.debug("Couldn't parse line: %s. Continuing to next line.", line)
+            event('unparsed_line', line=line, remote=section_config.get('name'))
 
+def parse_lirc(text: str) -> Config:
+    """
+    Parses a string and creates a dict with the parameters of the remote
+    """
+    remote_config: Config = {}
+    with stage('parse_lirc'):
+        for name, section_config in iter_lirc_sections(text.split('\n')):
+            remote_config[name] = section_config
     return remote_config
 
+def section_encoder(
+        section: str,
+        section_config: Config,
+        repeats: int) -> Encoder | None:
+    """
+    The encoder for a section, or None, after logging it, if its protocol
+    isn't supported
+    """
+    try:
+        return compile_encoder(section_config, repeats)
+    except UnsupportedProtocolError as error:
+        logger.warning('Skipping %s: %s', section, error)
+        event('unsupported_protocol', remote=section, error=str(error))
+        return None
+
+def encode_section(section: str, section_config: Config) -> SubConfig:
+    """
+    Converts the parameters of a single remote to a dictionary mapping its
+    keys to base 64 broadlink codes
+    """
+    broadlink_map: SubConfig = {}
+    profiling: bool = enabled()
+    with stage('code_to_broadlink', remote=section):
+        repeats: int = int(section_config.pop('min_repeat', 0))
+        encoder: Encoder | None = section_encoder(
+                section, section_config, repeats)
+        if encoder is None:
+            return broadlink_map
+        for button, code_hex in section_config['codes'].items():
+            packet: bytes = encoder.encode(code_hex)
+            broadlink_map[button] = b64encode(packet).decode('utf-8')
+            if profiling:
+                count_packet(packet, encoder.pulse_count(code_hex))
+    return broadlink_map
+
+def iter_broadlink_codes(sections: Iterable[tuple[str, Config]]) -> Iterator[Record]:
+    """
+    Yields a (remote, button, base 64 code) record for every button, one
+    section at a time. Given iter_lirc_sections, only a single remote is
+    held in memory, and buttons that share a name in different remotes are
+    all kept.
+    """
+    for section, section_config in sections:
+        for button, code in encode_section(section, section_config).items():
+            yield section, button, code
+
+def iter_conf_lines(source: str) -> Iterator[str]:
+    """
+    Lines of an lirc.conf file from a url, a local path or, given -, stdin.
+    Files and stdin are read as the lines are needed.
+    """
+    if source == '-':
+        yield from sys.stdin
+    elif is_url(source):
+        yield from load_conf_text(source).split('\n')
+    else:
+        # Some configurations in the lirc database aren't valid utf-8
+        with open(source, encoding='utf-8', errors='replace') as conf_file:
+            yield from conf_file
+
 def code_to_broadlink(config: Config) -> Config:
     """
     Converts a parsed lirc dictionary to a dictionary mapping keys to
     base 64 broadlink codes
     """
     broadlink_map: Config = {}
+    for _, button, code in iter_broadlink_codes(config.items()):
+        broadlink_map[button] = code
+    return broadlink_map
+
+def count_packet(packet: bytes, pulses: int) -> None:
+    """
+    Counts a button, its pulses and its multi-byte pulses for the profiler
+    """
+    count('buttons')
+    count('pulses', pulses)
+    # Each pulse over 255 ticks takes 2 extra bytes after the 4 byte prefix
+    count('multi_byte_pulses', (len(packet) - 4 - pulses) // 2)
+
+def code_to_broadlink_vectorized(config: Config) -> Config:
+    """
+    Same as code_to_broadlink, but encodes all buttons of each section in one
+    batch with NumPy. Falls back to the pure Python encoder when NumPy isn't
+    installed.
+    """
+    broadlink_map: Config = {}
     for section in config:
         section_config: Config = config[section]
         repeats: int = int(section_config.pop('min_repeat', 0))
-        section_pulses: Config = lirc_to_pulses(section_config)
-        for button, pulses in section_pulses.items():
-            broadlink_map[button] = b64encode(pulses_to_broadlink_hex(
-                    pulses, repeats
-                    )).decode('utf-8')
+        encoder: Encoder | None = section_encoder(
+                section, section_config, repeats)
+        if encoder is None:
+            continue
+        encoded: dict[str, bytes] = vectorized_encode(
+                encoder, section_config['codes'])
+        for button, packet in encoded.items():
+            broadlink_map[button] = b64encode(packet).decode('utf-8')
     return broadlink_map
 
 def create_mapping(lirc_url: str) -> Config:
     """
-    Takes a url to an lirc config page and returns a base 64, Home Assistant
-    compatible list of remote codes
+    Takes a url to an lirc config page, or a local path, and returns a base 64,
+    Home Assistant compatible list of remote codes
     """
-    lirc_text: str = get_conf_file(lirc_url).text
+    lirc_text: str = load_conf_text(lirc_url)
     codes: Config = parse_lirc(lirc_text)
     return code_to_broadlink(codes)
 
-def main(lirc_url: str) -> None:
+def create_mappings(
+        lirc_urls: Iterable[str],
+        fetcher: ConfFetcher | None = None,
+        max_workers: int = 8) -> Iterator[tuple[str, Config | Exception]]:
+    """
+    Fetches many lirc config pages concurrently and yields each url with its
+    base 64 codes as soon as its download finishes. Any error fetching or
+    converting a page is yielded in place of the codes.
+    """
+    from fetch import fetch_many
+    for lirc_url, response in fetch_many(lirc_urls, fetcher, max_workers):
+        if isinstance(response, Exception):
+            yield lirc_url, response
+            continue
+        try:
+            response.raise_for_status()
+            yield lirc_url, code_to_broadlink(parse_lirc(response.text))
+        except Exception as error:
+            yield lirc_url, error
+
+def main(lirc_url: str, profile_path: str | None = None, profile: bool = False) -> None:
     """
-    Pretty prints a dictionary of base 64, Home Assistant compatible remote codes
+    Pretty prints a dictionary of base 64, Home Assistant compatible remote codes.
+    With profile, a json report of the time spent in each stage is written
+    to profile_path, or stderr without one.
     """
-    pprint.pprint(create_mapping(lirc_url))
+    import pprint
+    if not profile:
+        pprint.pprint(create_mapping(lirc_url))
+        return
+    with instrumentation.profile() as profiler:
+        pprint.pprint(create_mapping(lirc_url))
+    profiler.write_report(profile_path)
 
 if __name__=='__main__':
+    arguments: list[str] = sys.argv[1:]
+    profile: bool
+    profile_path: str | None
+    profile, profile_path = instrumentation.pop_profile_argument(arguments)
     base_url: str = 'https://sourceforge.net/p/lirc-remotes/code/ci/master/tree/remotes/'
     remote_path: str = 'sony/RM-U306A.lircd.conf'
-    main(base_url + remote_path)
+    lirc_url: str = arguments[0] if arguments else base_url + remote_path
+    main(lirc_url, profile_path, profile)
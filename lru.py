@@ -0,0 +1,61 @@
+"""
+lru.py
+
+Size-bounded least recently used cache shared by the conversion service and
+the encoder cache.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any
+
+
+class LRUCache:
+    """
+    Thread safe least recently used cache holding at most max_entries items,
+    with hit, miss and eviction counts
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries: int = max_entries
+        self.entries: OrderedDict[Any, Any] = OrderedDict()
+        self.lock: threading.Lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    def get(self, key: Any) -> Any | None:
+        """
+        Returns the cached value, or None, and marks it as recently used
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key: Any, value: Any) -> None:
+        """
+        Adds a value, evicting the least recently used ones if full
+        """
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def metrics(self) -> dict[str, int]:
+        """
+        Current size and counts
+        """
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                }
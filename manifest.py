@@ -0,0 +1,112 @@
+"""
+manifest.py
+
+Keeps a record of what has already been converted, so later runs only
+re-encode what changed upstream. For every input the manifest stores a hash
+of its content, and for every remote section in it a hash of the section,
+the encoder version and the generated script names and codes.
+"""
+
+import hashlib
+import json
+from typing import Any
+
+from atomic import atomic_write
+from lirc2broadlinkha import (ENCODER_VERSION, Config, code_to_broadlink,
+                              iter_lirc_sections)
+from create_ha_script import script_name
+
+MANIFEST_VERSION: int = 1
+
+
+def content_hash(text: str) -> str:
+    """
+    Hash of the text of an lirc.conf file
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def section_hash(section_config: Config) -> str:
+    """
+    Hash of a parsed remote section, independent of key order. Raw codes,
+    which are arrays, are hashed as lists.
+    """
+    canonical: str = json.dumps(section_config, sort_keys=True, default=list)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class Manifest:
+    """
+    Record of converted inputs, stored as json at path. Keeps count of how
+    many sections were reused and how many were encoded.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.inputs: dict[str, Any] = {}
+        self.reused_sections: int = 0
+        self.encoded_sections: int = 0
+        try:
+            with open(path) as manifest_file:
+                data: dict[str, Any] = json.load(manifest_file)
+        except FileNotFoundError:
+            return
+        # Start again if the manifest was written by a different version
+        if data.get('version') == MANIFEST_VERSION:
+            self.inputs = data['inputs']
+
+    def save(self) -> None:
+        """
+        Writes the manifest, replacing the old one atomically
+        """
+        with atomic_write(self.path) as manifest_file:
+            json.dump({'version': MANIFEST_VERSION, 'inputs': self.inputs},
+                      manifest_file, indent=1)
+
+    def convert(self, source: str, text: str) -> Config:
+        """
+        Returns the base 64 codes for the lirc.conf text from source, only
+        encoding the sections whose hash or encoder version has changed since
+        the last run
+        """
+        text_hash: str = content_hash(text)
+        previous: dict[str, Any] = self.inputs.get(source, {})
+        previous_sections: dict[str, Any] = previous.get('sections', {})
+
+        # Nothing has changed, so there's no need to parse at all
+        if (previous.get('hash') == text_hash and all(
+                entry['encoder'] == ENCODER_VERSION
+                for entry in previous_sections.values())):
+            self.reused_sections += len(previous_sections)
+            return self.merged_codes(previous_sections)
+
+        sections: dict[str, Any] = {}
+        for name, section_config in iter_lirc_sections(text.split('\n')):
+            digest: str = section_hash(section_config)
+            entry: dict[str, Any] | None = previous_sections.get(name)
+            if (entry and entry['hash'] == digest
+                    and entry['encoder'] == ENCODER_VERSION):
+                self.reused_sections += 1
+            else:
+                codes: Config = code_to_broadlink({name: section_config})
+                entry = {
+                    'hash': digest,
+                    'encoder': ENCODER_VERSION,
+                    'scripts': [script_name(button) for button in codes],
+                    'codes': codes,
+                    }
+                self.encoded_sections += 1
+            sections[name] = entry
+
+        self.inputs[source] = {'hash': text_hash, 'sections': sections}
+        return self.merged_codes(sections)
+
+    @staticmethod
+    def merged_codes(sections: dict[str, Any]) -> Config:
+        """
+        Merges the codes of every section, as code_to_broadlink does
+        """
+        codes: Config = {}
+        for entry in sections.values():
+            codes.update(entry['codes'])
+        return codes
@@ -0,0 +1,471 @@
+"""
+sender.py
+
+Sends codes straight to Broadlink devices over their local UDP protocol,
+rather than through one Home Assistant service call per button. Each device
+gets a single authenticated session that is reused for every command, and
+sequences of commands are pipelined, with a configurable gap between the
+start of one command and the next.
+
+FakeDevice is a local stand-in that speaks the same protocol, so the whole
+path can be tested and benchmarked without any hardware.
+
+Needs the cryptography package, as the protocol is AES encrypted.
+
+    python sender.py host mac source button [button ...] [--gap 0.3]
+"""
+
+import argparse
+import socket
+import struct
+import sys
+import threading
+import time
+from typing import Iterable, Mapping
+
+from fingerprint import to_packet
+
+# cryptography is optional and only needed to talk to devices
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+# Every device starts with this key and iv, until authentication gives a
+# per-session key
+INITIAL_KEY: bytes = bytes.fromhex('097628343fe99e23765c1513accf8b02')
+IV: bytes = bytes.fromhex('562e17996d093d28ddb3ba695a2e6f58')
+MAGIC: bytes = bytes.fromhex('5aa5aa555aa5aa55')
+HEADER_SIZE: int = 0x38
+DEFAULT_PORT: int = 80
+# Device type of an RM mini 3, which any RM accepts
+DEFAULT_DEVTYPE: int = 0x2737
+
+AUTH_COMMAND: int = 0x65
+AUTH_RESPONSE: int = 0x3e9
+COMMAND: int = 0x6a
+COMMAND_RESPONSE: int = 0x3ee
+SEND_DATA: int = 0x02
+
+
+class BroadlinkError(Exception):
+    """
+    Raised when a device reports an error or stops answering
+    """
+
+
+def require_cryptography() -> None:
+    """
+    Raises a helpful error if cryptography isn't installed
+    """
+    if Cipher is None:
+        raise ImportError(
+                'Sending to Broadlink devices needs the cryptography package')
+
+
+def encrypt(key: bytes, payload: bytes) -> bytes:
+    """
+    AES-128-CBC encrypts a payload, padding it to the block size with zeros
+    """
+    padded: bytes = payload + bytes(-len(payload) % 16)
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(IV)).encryptor()
+    return encryptor.update(padded) + encryptor.finalize()
+
+
+def decrypt(key: bytes, payload: bytes) -> bytes:
+    """
+    Reverses encrypt, leaving any padding in place
+    """
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(IV)).decryptor()
+    return decryptor.update(payload) + decryptor.finalize()
+
+
+def checksum(data: bytes) -> int:
+    """
+    The 16 bit checksum used for both the payload and the whole packet
+    """
+    return sum(data, 0xbeaf) & 0xffff
+
+
+def build_packet(
+        key: bytes,
+        packet_type: int,
+        count: int,
+        devtype: int,
+        mac: bytes,
+        device_id: int,
+        payload: bytes,
+        error: int = 0) -> bytes:
+    """
+    Builds a complete packet: a 0x38 byte header followed by the encrypted
+    payload. Devices answer with the same layout, with an error code.
+    """
+    header: bytearray = bytearray(HEADER_SIZE)
+    header[0x00:0x08] = MAGIC
+    struct.pack_into('<H', header, 0x22, error)
+    struct.pack_into('<HHH', header, 0x24, devtype, packet_type, count)
+    header[0x2a:0x30] = mac[::-1]
+    struct.pack_into('<I', header, 0x30, device_id)
+    struct.pack_into('<H', header, 0x34, checksum(payload))
+    packet: bytearray = header + encrypt(key, payload)
+    struct.pack_into('<H', packet, 0x20, checksum(packet))
+    return bytes(packet)
+
+
+def parse_mac(mac: str | bytes) -> bytes:
+    """
+    Accepts a mac address as aa:bb:cc:dd:ee:ff, aabbccddeeff or bytes
+    """
+    if isinstance(mac, bytes):
+        return mac
+    return bytes.fromhex(mac.replace(':', '').replace('-', ''))
+
+
+class DeviceSession:
+    """
+    A single authenticated UDP session with one device. Commands are matched
+    to their acknowledgements by the packet count, so several can be in
+    flight at once.
+    Parameters:
+    host:
+        Address of the device
+    mac:
+        Mac address of the device, which is part of every packet
+    timeout:
+        Seconds to wait for each acknowledgement
+    rm4:
+        RM4 devices expect the data to be preceded by its length
+    """
+
+    def __init__(
+            self,
+            host: str,
+            mac: str | bytes,
+            port: int = DEFAULT_PORT,
+            devtype: int = DEFAULT_DEVTYPE,
+            timeout: float = 5,
+            rm4: bool = False) -> None:
+        require_cryptography()
+        self.address: tuple[str, int] = (host, port)
+        self.mac: bytes = parse_mac(mac)
+        self.devtype: int = devtype
+        self.timeout: float = timeout
+        self.rm4: bool = rm4
+        self.key: bytes = INITIAL_KEY
+        self.device_id: int = 0
+        self.count: int = 0
+        self.lock: threading.Lock = threading.Lock()
+        self.socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.settimeout(timeout)
+        self.authenticated: bool = False
+
+    def next_count(self) -> int:
+        """
+        The count for the next packet, which wraps around at 16 bits
+        """
+        self.count = (self.count + 1) & 0xffff
+        return self.count
+
+    def send_packet(self, packet_type: int, payload: bytes) -> int:
+        """
+        Sends a packet without waiting for the answer and returns its count
+        """
+        count: int = self.next_count()
+        self.socket.sendto(build_packet(
+                self.key, packet_type, count, self.devtype, self.mac,
+                self.device_id, payload), self.address)
+        return count
+
+    def receive(self) -> tuple[int, bytes]:
+        """
+        Waits for the next answer and returns its count and decrypted payload
+        """
+        try:
+            response, _ = self.socket.recvfrom(2048)
+        except OSError as error: # Timed out, or nothing listening
+            raise BroadlinkError(
+                    f'No answer from {self.address[0]}: {error}') from error
+        status: int
+        count: int
+        status, = struct.unpack_from('<H', response, 0x22)
+        count, = struct.unpack_from('<H', response, 0x28)
+        if status:
+            raise BroadlinkError(
+                    f'{self.address[0]} reported error {status:#06x}')
+        return count, decrypt(self.key, response[HEADER_SIZE:])
+
+    def request(self, packet_type: int, payload: bytes) -> bytes:
+        """
+        Sends a packet and waits for its answer
+        """
+        count: int = self.send_packet(packet_type, payload)
+        while True:
+            answer_count, answer = self.receive()
+            # Skip any late answers to earlier packets
+            if answer_count == count:
+                return answer
+
+    def authenticate(self) -> None:
+        """
+        Swaps the initial key for a session key
+        """
+        payload: bytearray = bytearray(0x50)
+        payload[0x04:0x14] = bytes([0x31]) * 16
+        payload[0x1e] = 0x01
+        payload[0x2d] = 0x01
+        payload[0x30:0x36] = b'Test 1'
+        self.key = INITIAL_KEY
+        self.device_id = 0
+        answer: bytes = self.request(AUTH_COMMAND, bytes(payload))
+        self.device_id, = struct.unpack_from('<I', answer)
+        self.key = answer[0x04:0x14]
+        self.authenticated = True
+
+    def command_payload(self, packet: bytes) -> bytes:
+        """
+        Wraps a Broadlink IR packet in a send data command
+        """
+        if self.rm4:
+            return struct.pack('<HI', len(packet) + 4, SEND_DATA) + packet
+        return struct.pack('<I', SEND_DATA) + packet
+
+    def send_codes(
+            self,
+            codes: Iterable[str | bytes],
+            gap: float = 0.0,
+            window: int = 1) -> int:
+        """
+        Sends a sequence of codes, starting each one at least gap seconds
+        after the one before. Up to window commands can be waiting for their
+        acknowledgement at once. Returns the number of codes sent.
+        """
+        with self.lock:
+            if not self.authenticated:
+                self.authenticate()
+            pending: set[int] = set()
+            sent: int = 0
+            next_start: float = time.monotonic()
+            for code in codes:
+                while len(pending) >= window:
+                    pending.discard(self.receive()[0])
+                delay: float = next_start - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_start = time.monotonic() + gap
+                pending.add(self.send_packet(
+                        COMMAND, self.command_payload(to_packet(code))))
+                sent += 1
+            while pending:
+                pending.discard(self.receive()[0])
+            return sent
+
+    def close(self) -> None:
+        """
+        Closes the session's socket
+        """
+        self.socket.close()
+
+
+class Sender:
+    """
+    Keeps one session per device, so each device is only authenticated once
+    however many sequences are sent to it. A device is its host, mac address
+    and whether it's an RM4, as all three go into every packet.
+    """
+
+    def __init__(self, timeout: float = 5, port: int = DEFAULT_PORT) -> None:
+        self.timeout: float = timeout
+        self.port: int = port
+        self.sessions: dict[tuple[str, bytes, bool], DeviceSession] = {}
+        self.lock: threading.Lock = threading.Lock()
+
+    def session(self, host: str, mac: str | bytes, rm4: bool = False) -> DeviceSession:
+        """
+        Returns the session for a device, opening it if needed
+        """
+        key: tuple[str, bytes, bool] = (host, parse_mac(mac), rm4)
+        with self.lock:
+            session: DeviceSession | None = self.sessions.get(key)
+            if session is None:
+                session = DeviceSession(host, mac, self.port,
+                                        timeout=self.timeout, rm4=rm4)
+                self.sessions[key] = session
+            return session
+
+    def send(
+            self,
+            host: str,
+            mac: str | bytes,
+            codes: Iterable[str | bytes],
+            gap: float = 0.0,
+            window: int = 1,
+            rm4: bool = False) -> int:
+        """
+        Sends codes to a device. After an error the session is authenticated
+        again on the next send. The codes aren't retried, as some of them may
+        already have been sent and pressing a button twice can undo it.
+        """
+        session: DeviceSession = self.session(host, mac, rm4)
+        try:
+            return session.send_codes(codes, gap, window)
+        except BroadlinkError:
+            session.authenticated = False
+            raise
+
+    def send_buttons(
+            self,
+            host: str,
+            mac: str | bytes,
+            mapping: Mapping[str, str],
+            buttons: Iterable[str],
+            gap: float = 0.0,
+            window: int = 1,
+            rm4: bool = False) -> int:
+        """
+        Sends buttons by name from a code_to_broadlink mapping
+        """
+        return self.send(host, mac, [mapping[button] for button in buttons],
+                         gap, window, rm4)
+
+    def close(self) -> None:
+        """
+        Closes every session
+        """
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+
+class FakeDevice:
+    """
+    Local UDP stand-in for a Broadlink RM. Authenticates sessions, checks the
+    checksums of every packet and keeps the IR packets it was sent, with the
+    time each arrived.
+    Parameters:
+    delay:
+        Seconds to wait before acknowledging a command, as a real device
+        does while transmitting
+    rm4:
+        Expect commands in the RM4 layout, with a leading length
+    """
+
+    def __init__(
+            self,
+            host: str = '127.0.0.1',
+            delay: float = 0.0,
+            rm4: bool = False) -> None:
+        require_cryptography()
+        self.delay: float = delay
+        self.rm4: bool = rm4
+        self.socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, 0))
+        self.address: tuple[str, int] = self.socket.getsockname()
+        self.session_key: bytes = bytes(range(16))
+        self.device_id: int = 0x1234
+        self.authentications: int = 0
+        self.received: list[tuple[float, bytes]] = []
+        self.thread: threading.Thread = threading.Thread(
+                target=self.serve, daemon=True)
+        self.running: bool = True
+        self.thread.start()
+
+    def serve(self) -> None:
+        """
+        Answers packets on a background thread until the device is closed
+        """
+        while self.running:
+            try:
+                packet, address = self.socket.recvfrom(4096)
+            except OSError: # Closed
+                return
+            # Shutting the socket down wakes recvfrom with an empty packet
+            if not self.running:
+                return
+            self.answer(packet, address)
+
+    def answer(self, packet: bytes, address: tuple[str, int]) -> None:
+        """
+        Answers a single packet
+        """
+        devtype, packet_type, count = struct.unpack_from('<HHH', packet, 0x24)
+        mac: bytes = packet[0x2a:0x30][::-1]
+        header: bytearray = bytearray(packet)
+        header[0x20:0x22] = b'\0\0'
+        error: int = 0
+        payload: bytes = b''
+        if (packet[:8] != MAGIC
+                or struct.unpack_from('<H', packet, 0x20)[0] != checksum(header)):
+            error = 0xfff9 # Checksum error
+        elif packet_type == AUTH_COMMAND:
+            self.authentications += 1
+            payload = (struct.pack('<I', self.device_id) + self.session_key
+                       + bytes(12))
+            key: bytes = INITIAL_KEY
+            response_type: int = AUTH_RESPONSE
+        elif packet_type == COMMAND:
+            command: bytes = decrypt(self.session_key, packet[HEADER_SIZE:])
+            # The command number, then the IR packet with its own length
+            ir_packet: bytes = command[6 if self.rm4 else 4:]
+            length: int = struct.unpack_from('<H', ir_packet, 2)[0]
+            self.received.append((time.monotonic(), ir_packet[:4 + length]))
+            if self.delay:
+                time.sleep(self.delay)
+            payload = struct.pack('<I', 0)
+            key = self.session_key
+            response_type = COMMAND_RESPONSE
+        else:
+            error = 0xfffb # Unknown command
+        if error:
+            key, response_type = INITIAL_KEY, packet_type
+        self.socket.sendto(build_packet(
+                key, response_type, count, devtype, mac, self.device_id,
+                payload, error), address)
+
+    def close(self) -> None:
+        """
+        Stops answering and waits for the background thread to finish
+        """
+        self.running = False
+        # Closing alone doesn't wake a thread blocked in recvfrom
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        self.thread.join(timeout=1)
+
+
+def main(arguments: list[str] | None = None) -> int:
+    """
+    Sends buttons from an lirc config to a device
+    """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+            description='Send buttons straight to a Broadlink device')
+    parser.add_argument('host')
+    parser.add_argument('mac', help='e.g. aa:bb:cc:dd:ee:ff')
+    parser.add_argument('source', help='Url, local file or - for stdin')
+    parser.add_argument('buttons', nargs='+')
+    parser.add_argument('--gap', type=float, default=0.3,
+                        help='Seconds between the start of each button')
+    parser.add_argument('--rm4', action='store_true',
+                        help='The device is an RM4')
+    args: argparse.Namespace = parser.parse_args(arguments)
+
+    from lirc2broadlinkha import create_mapping
+    mapping: dict[str, str] = create_mapping(args.source)
+    sender: Sender = Sender()
+    try:
+        sender.send(args.host, args.mac,
+                    [mapping[button] for button in args.buttons],
+                    args.gap, rm4=args.rm4)
+    except (BroadlinkError, KeyError) as error:
+        print(f'Failed: {error}', file=sys.stderr)
+        return 1
+    finally:
+        sender.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
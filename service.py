@@ -0,0 +1,294 @@
+"""
+service.py
+
+A small long-running conversion service, so automations that ask for codes
+all day don't pay for starting Python and importing requests and yaml every
+time. Listens on localhost HTTP or a Unix socket and keeps parsed remotes,
+encoded codes and generated scripts in size-bounded in-memory LRU caches.
+
+Endpoints, all taking and returning json unless noted:
+    POST /mapping   {"url": ...} or {"text": ...}
+                    -> {button: base 64 code}
+    POST /scripts   {"url": ...} or {"text": ...}, "entity": name and
+                    optionally "emitter": "yaml" or "template"
+                    -> Home Assistant scripts as yaml text
+    GET  /metrics   -> cache sizes, hits, misses and evictions
+
+    python service.py [--host 127.0.0.1] [--port 8765] [--unix path]
+                      [--cache-size 256] [--url-ttl 300]
+"""
+
+import argparse
+import copy
+import hashlib
+import io
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+import create_ha_script
+from fetch import ConfFetcher
+from lirc2broadlinkha import Config, code_to_broadlink, get_conf_file, parse_lirc
+from lru import LRUCache
+
+DEFAULT_PORT: int = 8765
+
+
+class ConversionService:
+    """
+    Converts lirc configs from urls or text, caching every step in memory.
+    Parameters:
+    max_entries:
+        Size of each cache
+    url_ttl:
+        Seconds to trust the last fetched content of a url before fetching
+        it again (through the fetcher's own on-disk cache)
+    fetcher:
+        Fetcher to use for urls, defaults to the shared, cached one
+    """
+
+    def __init__(
+            self,
+            max_entries: int = 256,
+            url_ttl: float = 300,
+            fetcher: ConfFetcher | None = None) -> None:
+        self.url_ttl: float = url_ttl
+        self.fetcher: ConfFetcher | None = fetcher
+        # url -> (content hash, time fetched)
+        self.urls: LRUCache = LRUCache(max_entries)
+        # content hash -> text, parsed sections, codes and scripts
+        self.texts: LRUCache = LRUCache(max_entries)
+        self.sections: LRUCache = LRUCache(max_entries)
+        self.mappings: LRUCache = LRUCache(max_entries)
+        self.scripts: LRUCache = LRUCache(max_entries)
+        # Requests are handled on many threads, so the count has a lock
+        self.requests: int = 0
+        self.lock: threading.Lock = threading.Lock()
+
+    def count_request(self) -> None:
+        """
+        Adds a request to the count in the metrics
+        """
+        with self.lock:
+            self.requests += 1
+
+    def resolve(self, url: str | None = None, text: str | None = None) -> str:
+        """
+        Returns the content hash of the config, fetching the url if it hasn't
+        been seen within url_ttl
+        """
+        if text is None:
+            if url is None:
+                raise ValueError('Either a url or the config text is needed')
+            cached: tuple[str, float] | None = self.urls.get(url)
+            if cached and time.monotonic() - cached[1] < self.url_ttl:
+                return cached[0]
+            response = get_conf_file(url, self.fetcher)
+            response.raise_for_status()
+            text = response.text
+        digest: str = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if url is not None:
+            self.urls.put(url, (digest, time.monotonic()))
+        self.texts.put(digest, text)
+        return digest
+
+    def mapping(self, url: str | None = None, text: str | None = None) -> Config:
+        """
+        Returns the base 64 codes for a config. The result is shared with the
+        cache, so mustn't be modified.
+        """
+        self.count_request()
+        return self.encoded(self.resolve(url, text), url, text)
+
+    def encoded(self, digest: str, url: str | None, text: str | None) -> Config:
+        """
+        Returns the base 64 codes for already resolved content
+        """
+        mapping: Config | None = self.mappings.get(digest)
+        if mapping is not None:
+            return mapping
+        sections: Config | None = self.sections.get(digest)
+        if sections is None:
+            source_text: str | None = text if text is not None else self.texts.get(digest)
+            if source_text is None:
+                # Evicted since it was resolved, so fetch it again
+                response = get_conf_file(url, self.fetcher) # type: ignore[arg-type]
+                response.raise_for_status()
+                source_text = response.text
+            sections = parse_lirc(source_text)
+            self.sections.put(digest, sections)
+        # code_to_broadlink modifies its input, so keep the cached copy intact
+        mapping = code_to_broadlink(copy.deepcopy(sections))
+        self.mappings.put(digest, mapping)
+        return mapping
+
+    def scripts_yaml(
+            self,
+            entity_name: str,
+            url: str | None = None,
+            text: str | None = None,
+            emitter: str = 'yaml') -> str:
+        """
+        Returns the Home Assistant scripts for a config as yaml text
+        """
+        self.count_request()
+        entity_name = create_ha_script.remote_entity(entity_name)
+        digest: str = self.resolve(url, text)
+        key: tuple[str, str, str] = (digest, entity_name, emitter)
+        scripts: str | None = self.scripts.get(key)
+        if scripts is None:
+            mapping: Config = self.encoded(digest, url, text)
+            stream: io.StringIO = io.StringIO()
+            create_ha_script.EMITTERS[emitter](
+                    create_ha_script.create_scripts(mapping, entity_name), stream)
+            scripts = stream.getvalue()
+            self.scripts.put(key, scripts)
+        return scripts
+
+    def request_count(self) -> int:
+        """
+        Number of requests handled so far
+        """
+        with self.lock:
+            return self.requests
+
+    def metrics(self) -> dict[str, Any]:
+        """
+        Request count and the metrics of every cache
+        """
+        return {
+            'requests': self.request_count(),
+            'urls': self.urls.metrics(),
+            'texts': self.texts.metrics(),
+            'sections': self.sections.metrics(),
+            'mappings': self.mappings.metrics(),
+            'scripts': self.scripts.metrics(),
+            }
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    Answers requests with the ConversionService attached to the server
+    """
+    protocol_version = 'HTTP/1.1' # Keep connections open between requests
+    # Buffer each response so headers and body go out in one write, rather
+    # than waiting on a delayed ack between them
+    wbufsize = 65536
+
+    def send_body(self, status: int, body: bytes, content_type: str) -> None:
+        """
+        Sends a complete response with the given status and body
+        """
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status: int, data: Any) -> None:
+        """
+        Sends data as a json response
+        """
+        self.send_body(status, json.dumps(data).encode('utf-8'),
+                       'application/json')
+
+    def do_GET(self) -> None:
+        """
+        Reports the request count and cache metrics at /metrics
+        """
+        if self.path == '/metrics':
+            self.send_json(200, self.server.service.metrics()) # type: ignore[attr-defined]
+        else:
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self) -> None:
+        """
+        Converts the url or text in a json request, to codes at /mapping or
+        to Home Assistant scripts at /scripts. Any error is sent back as a
+        400 with its message.
+        """
+        service: ConversionService = self.server.service # type: ignore[attr-defined]
+        try:
+            length: int = int(self.headers.get('Content-Length', 0))
+            request: dict[str, Any] = json.loads(self.rfile.read(length) or b'{}')
+            url: str | None = request.get('url')
+            text: str | None = request.get('text')
+            if self.path == '/mapping':
+                self.send_json(200, service.mapping(url, text))
+            elif self.path == '/scripts':
+                scripts: str = service.scripts_yaml(
+                        request['entity'], url, text,
+                        request.get('emitter', 'yaml'))
+                self.send_body(200, scripts.encode('utf-8'),
+                               'application/yaml')
+            else:
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+        except Exception as error: # Report it to the client and keep serving
+            self.send_json(400, {'error': f'{type(error).__name__}: {error}'})
+
+    def log_message(self, *args: Any) -> None:
+        """
+        Logging every request would cost more than answering it
+        """
+
+
+class ServiceHTTPServer(ThreadingHTTPServer):
+    """
+    Localhost HTTP server carrying a ConversionService
+    """
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], service: ConversionService) -> None:
+        super().__init__(address, ServiceHandler)
+        self.service: ConversionService = service
+
+
+class ServiceUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    The same HTTP service over a Unix socket
+    """
+    daemon_threads = True
+
+    def __init__(self, path: str, service: ConversionService) -> None:
+        # Clear out a socket left behind by a previous run
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, ServiceHandler)
+        self.service: ConversionService = service
+
+
+def main(arguments: list[str] | None = None) -> None:
+    """
+    Runs the service until interrupted
+    """
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+            description='Serve lirc to Broadlink conversions from a warm cache')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--unix', help='Listen on this Unix socket instead')
+    parser.add_argument('--cache-size', type=int, default=256)
+    parser.add_argument('--url-ttl', type=float, default=300)
+    args: argparse.Namespace = parser.parse_args(arguments)
+
+    service: ConversionService = ConversionService(args.cache_size, args.url_ttl)
+    server: socketserver.BaseServer
+    if args.unix:
+        server = ServiceUnixServer(args.unix, service)
+        print(f'Listening on {args.unix}')
+    else:
+        server = ServiceHTTPServer((args.host, args.port), service)
+        print(f'Listening on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
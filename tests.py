@@ -1,14 +1,77 @@
 """Test suite for the lirc to broadlink ir codes conversion module"""
+import base64
+import copy
+import csv
+import gzip
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import lirc2broadlinkha
+import atomic
+import benchmarks
+import bulk_convert
+import cli
+import codedb
+import compact
+import create_ha_script
+import export
+import requests
+import yaml
+import fetch
+import fingerprint
+import fuzz
+import instrumentation
+import manifest
+import sender
+import service
+
+# A cut down lirc.conf file for tests that don't need the network
+SAMPLE_CONF = """
+# Sony RM-U306A, cut down for testing
+begin remote
+
+  name  RM-U306A
+  bits           14
+  flags SPACE_ENC|CONST_LENGTH
+  eps            30
+  aeps          100
+
+  header       2437   553
+  one          1237   553
+  zero          637   553
+  ptrail        667
+  gap          44822
+  min_repeat      2
+
+      begin codes
+          SLEEP                    0x0186
+          POWER                    0x2A06
+          VOL+                     0x0486
+          VOL-                     0x2486
+      end codes
+
+end remote
+"""
 
 class TestLircRetrieval(unittest.TestCase):
     """Tests that the LIRC configuration file is retrieved correctly"""
-    # Set up with a get request to a lirc conf file
+    # Set up with a get request to a lirc conf file. The fetcher has no
+    # cache, so the live response is checked and nothing is left behind.
     def setUp(self):
+        self.fetcher = fetch.ConfFetcher(cache_dir=None)
+        self.addCleanup(self.fetcher.close)
         self.response = lirc2broadlinkha.get_conf_file(
             'https://sourceforge.net/p/lirc-remotes' \
-            '/code/ci/master/tree/remotes/sony/RM-U306A.lircd.conf'
+            '/code/ci/master/tree/remotes/sony/RM-U306A.lircd.conf',
+            self.fetcher
             )
 
     # Ensure that requests is working and can access the lirc database
@@ -16,6 +79,121 @@ class TestLircRetrieval(unittest.TestCase):
         """Test that url of a known configuration file gives a 200 response"""
         self.assertEqual(self.response.status_code, 200)
 
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves SAMPLE_CONF with an ETag, standing in for SourceForge"""
+    etag = '"rm-u306a"'
+    requests_seen = []
+
+    def do_GET(self):
+        """
+        Answers conditional requests with a 304. Slow paths take a while to
+        answer and flaky paths fail the first time they're requested.
+        """
+        flaky = 'flaky' in self.path and self.path not in self.requests_seen
+        self.requests_seen.append(self.headers.get('If-None-Match'))
+        self.requests_seen.append(self.path)
+        if 'slow' in self.path:
+            time.sleep(0.3)
+        if flaky:
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = SAMPLE_CONF.encode('utf-8')
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep the test output clean"""
+
+class TestCachedFetching(unittest.TestCase):
+    """Tests the cached fetch layer against a local stand-in server"""
+
+    def setUp(self):
+        StandInHandler.requests_seen = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/RM-U306A.lircd.conf'
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tempdir.cleanup()
+
+    def test_cache_within_ttl(self):
+        """Test that a fresh cache entry is served without a request"""
+        fetcher = fetch.ConfFetcher(self.tempdir.name, ttl=3600)
+        first = lirc2broadlinkha.get_conf_file(self.url, fetcher)
+        second = lirc2broadlinkha.get_conf_file(self.url, fetcher)
+        self.assertEqual(first.text, SAMPLE_CONF)
+        self.assertEqual(second.text, SAMPLE_CONF)
+        self.assertTrue(second.from_cache)
+        self.assertEqual(len(StandInHandler.requests_seen), 2)
+
+    def test_revalidation(self):
+        """Test that a stale cache entry is revalidated with its ETag"""
+        fetcher = fetch.ConfFetcher(self.tempdir.name, ttl=0)
+        fetcher.get(self.url)
+        response = fetcher.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, SAMPLE_CONF)
+        self.assertEqual(StandInHandler.requests_seen[::2],
+                         [None, StandInHandler.etag])
+
+    def test_offline(self):
+        """Test that offline mode only uses the cache"""
+        fetch.ConfFetcher(self.tempdir.name).get(self.url)
+        offline = fetch.ConfFetcher(self.tempdir.name, ttl=0, offline=True)
+        self.assertEqual(offline.get(self.url).text, SAMPLE_CONF)
+        with self.assertRaises(fetch.OfflineCacheMiss):
+            offline.get(self.url + '.missing')
+        self.assertEqual(len(StandInHandler.requests_seen), 2)
+
+    def test_concurrent_fetching(self):
+        """
+        Test that many slow pages are fetched in about the time of one, and
+        that each is converted as it arrives
+        """
+        fetcher = fetch.ConfFetcher(cache_dir=None)
+        urls = [f'{self.url}?slow={number}' for number in range(6)]
+        start = time.monotonic()
+        results = dict(lirc2broadlinkha.create_mappings(
+                urls, fetcher, max_workers=6))
+        self.assertLess(time.monotonic() - start, 6 * 0.3)
+        self.assertEqual(set(results), set(urls))
+        expected = lirc2broadlinkha.code_to_broadlink(
+                lirc2broadlinkha.parse_lirc(SAMPLE_CONF))
+        for mapping in results.values():
+            self.assertEqual(mapping, expected)
+
+    def test_retry(self):
+        """Test that temporary server errors are retried"""
+        fetcher = fetch.ConfFetcher(cache_dir=None)
+        response = fetch.fetch_with_retry(
+                fetcher, self.url + '?flaky', backoff=0.01)
+        self.assertEqual(response.status_code, 200)
+        response = fetch.fetch_with_retry(
+                fetcher, self.url + '?flaky=again', retries=0)
+        self.assertEqual(response.status_code, 503)
+
+    def test_host_rate_limit(self):
+        """Test that requests to one host are spaced out"""
+        limiter = fetch.HostRateLimiter(0.1)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.wait(self.url)
+        limiter.wait('http://other.host/')
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertLess(time.monotonic() - start, 0.3)
+
 class TestLircToPulseConversion(unittest.TestCase):
     """Test that code correctly converts LIRC files to pulses"""
 
@@ -234,6 +412,257 @@ class TestLircToPulseConversion(unittest.TestCase):
         pulses = lirc2broadlinkha.lirc_to_pulses(self.code_with_post_data)
         self.assertEqual(pulses, self.correct_post_data_pulses)
 
+    def test_hex_to_int_conversion(self):
+        """Test that hex codes convert to integers with their bit lengths"""
+        self.assertEqual(lirc2broadlinkha.lirc_hex_to_int('0x410D', 15), (0x410D, 15))
+        self.assertEqual(lirc2broadlinkha.lirc_hex_to_int('0x0', 15), (0, 15))
+        # Codes that overflow the bit count keep all of their bits
+        self.assertEqual(lirc2broadlinkha.lirc_hex_to_int('0x1FF', 4), (0x1FF, 9))
+        self.assertEqual(lirc2broadlinkha.lirc_hex_to_binary('0x1FF', 4), '111111111')
+
+    def test_compiled_encoder_matches_reference(self):
+        """
+        Test that the compiled section encoder gives byte-identical output to
+        converting pulses to Broadlink hex
+        """
+        for config in [self.simple_code, self.code_with_trail,
+                       self.code_without_trail, self.code_with_post_data]:
+            encoder = lirc2broadlinkha.compile_encoder(
+                    copy.deepcopy(config), repeats=3)
+            pulses = lirc2broadlinkha.lirc_to_pulses(copy.deepcopy(config))
+            for button, code_hex in config['codes'].items():
+                self.assertEqual(
+                        encoder.encode(code_hex),
+                        lirc2broadlinkha.pulses_to_broadlink_hex(
+                            pulses[button], 3)
+                        )
+
+    @unittest.skipIf(importlib.util.find_spec('numpy') is None,
+                     'NumPy is not installed')
+    def test_vectorized_encoder_matches_reference(self):
+        """
+        Test that batch encoding with NumPy gives the same packets as the
+        compiled section encoder
+        """
+        for config in [self.simple_code, self.code_with_trail,
+                       self.code_without_trail, self.code_with_post_data]:
+            encoder = lirc2broadlinkha.compile_encoder(config, repeats=3)
+            packets = lirc2broadlinkha.vectorized_encode(
+                    encoder, config['codes'])
+            for button, code_hex in config['codes'].items():
+                self.assertEqual(packets[button], encoder.encode(code_hex))
+
+    def test_vectorized_encoder_fallback(self):
+        """Test that batch encoding still works without NumPy"""
+        numpy_module = lirc2broadlinkha.np
+        lirc2broadlinkha.np = None
+        try:
+            encoder = lirc2broadlinkha.compile_encoder(self.code_with_trail)
+            packets = lirc2broadlinkha.vectorized_encode(
+                    encoder, self.code_with_trail['codes'])
+        finally:
+            lirc2broadlinkha.np = numpy_module
+        for button, code_hex in self.code_with_trail['codes'].items():
+            self.assertEqual(packets[button], encoder.encode(code_hex))
+
+class TestEncoderCache(unittest.TestCase):
+    """Tests for sharing compiled encoders between sections"""
+
+    def setUp(self):
+        # Two remotes with the same timings but different names and codes
+        self.sections = lirc2broadlinkha.parse_lirc(
+                SAMPLE_CONF + SAMPLE_CONF.replace('RM-U306A', 'RM-COPY').replace(
+                    '0x0186', '0x0123'))
+
+    def compile_all(self, cache):
+        return [lirc2broadlinkha.compile_encoder(copy.deepcopy(section), 2, cache)
+                for section in self.sections.values()]
+
+    def test_shared_profile(self):
+        """Test that sections with the same timings compile one encoder"""
+        cache = lirc2broadlinkha.EncoderCache()
+        first, second = self.compile_all(cache)
+        self.assertIs(first, second)
+        self.assertEqual(cache.metrics()['compiled'], 1)
+        self.assertEqual(cache.metrics()['hits'], 1)
+        # Any difference in timing or repeats is a different profile
+        different = copy.deepcopy(self.sections['RM-COPY'])
+        different['gap'] = '45000'
+        self.assertIsNot(lirc2broadlinkha.compile_encoder(different, 2, cache), first)
+        self.assertIsNot(lirc2broadlinkha.compile_encoder(
+                self.sections['RM-COPY'], 3, cache), first)
+
+
+class TestProtocols(unittest.TestCase):
+    """Tests for the encoders picked from a section's flags"""
+
+    def section(self, text):
+        return next(iter(lirc2broadlinkha.parse_lirc(text).values()))
+
+    def test_signal_encoder_matches_section_encoder(self):
+        """
+        Test that the general encoder gives the same packets as the space
+        encoder for sections they can both encode
+        """
+        variants = [
+            SAMPLE_CONF,
+            SAMPLE_CONF.replace('  ptrail        667\n', '').replace(
+                    '|CONST_LENGTH', ''),
+            SAMPLE_CONF.replace('  min_repeat', '  post_data_bits 4\n'
+                                '  post_data 0x9\n  min_repeat'),
+            ]
+        for text in variants:
+            section = self.section(text)
+            repeats = int(section.pop('min_repeat'))
+            encoder = lirc2broadlinkha.compile_encoder(section, repeats)
+            self.assertIsInstance(encoder, lirc2broadlinkha.SectionEncoder)
+            signal = lirc2broadlinkha.SignalEncoder(section, repeats)
+            for code_hex in section['codes'].values():
+                self.assertEqual(signal.encode(code_hex), encoder.encode(code_hex))
+
+    def test_pre_data(self):
+        """Test that pre data is sent before the code"""
+        section = self.section(SAMPLE_CONF.replace(
+                '  min_repeat', '  pre_data_bits 8\n  pre_data 0x12\n  min_repeat'))
+        combined = self.section(SAMPLE_CONF.replace('bits           14',
+                                                    'bits 22'))
+        for button, code_hex in section['codes'].items():
+            combined_hex = hex((0x12 << 14) | int(code_hex, 16))
+            self.assertEqual(
+                    lirc2broadlinkha.compile_encoder(section).encode(code_hex),
+                    lirc2broadlinkha.compile_encoder(combined).encode(
+                        combined_hex))
+
+    def test_rc5(self):
+        """
+        Test bi-phase encoding, where a 1 is off then on, a 0 is on then off
+        and neighbouring lengths of the same kind are merged
+        """
+        section = {'bits': '3', 'flags': 'RC5', 'plead': '889',
+                   'one': {'on': '889', 'off': '889'},
+                   'zero': {'on': '889', 'off': '889'},
+                   'gap': '10000', 'codes': {'KEY': '0x5'}}
+        self.assertIsInstance(lirc2broadlinkha.compile_encoder(section),
+                              lirc2broadlinkha.SignalEncoder)
+        pulses = lirc2broadlinkha.lirc_to_pulses(section)
+        self.assertEqual(pulses['KEY'], [(889, 889), (1778, 1778), (889, 10000)])
+        encoder = lirc2broadlinkha.compile_encoder(section)
+        self.assertEqual(encoder.encode('0x5'),
+                         lirc2broadlinkha.pulses_to_broadlink_hex(pulses['KEY']))
+
+    def test_rc6_trailer_bit(self):
+        """Test that the bit in the rc6 mask is sent at double length"""
+        section = {'bits': '4', 'flags': 'RC6', 'rc6_mask': '0x4',
+                   'header': {'on': '2666', 'off': '889'},
+                   'one': {'on': '444', 'off': '444'},
+                   'zero': {'on': '444', 'off': '444'},
+                   'gap': '10000', 'codes': {'KEY': '0xA'}}
+        pulses = lirc2broadlinkha.lirc_to_pulses(section)
+        self.assertEqual(pulses['KEY'],
+                         [(2666, 1333), (1332, 1332), (888, 10444)])
+
+    def test_toggle_bit(self):
+        """Test that the toggled press only flips the toggle bit"""
+        section = {'bits': '3', 'flags': 'RC5|CONST_LENGTH', 'plead': '889',
+                   'toggle_bit_mask': '0x2',
+                   'one': {'on': '889', 'off': '889'},
+                   'zero': {'on': '889', 'off': '889'},
+                   'gap': '20000', 'codes': {'KEY': '0x5'}}
+        encoder = lirc2broadlinkha.compile_encoder(section)
+        self.assertEqual(encoder.encode('0x5', toggled=True),
+                         encoder.encode('0x7'))
+        self.assertNotEqual(encoder.encode('0x5', toggled=True),
+                            encoder.encode('0x5'))
+
+    def test_repeat_frames(self):
+        """
+        Test that repeats of a section with a repeat code are sent as repeat
+        frames after the first frame, rather than with the repeat byte
+        """
+        section = self.section(SAMPLE_CONF.replace(
+                '  min_repeat', '  repeat 9000 2250\n  min_repeat'))
+        first = lirc2broadlinkha.lirc_to_pulses(self.section(SAMPLE_CONF))
+        repeats = int(section.pop('min_repeat'))
+        encoder = lirc2broadlinkha.compile_encoder(section, repeats)
+        # CONST_LENGTH, so the gap is counted from the start of the frame
+        repeat_frame = [(9000, 2250), (667, 44822 - 9000 - 2250 - 667)]
+        for button, code_hex in section['codes'].items():
+            self.assertEqual(
+                    encoder.encode(code_hex),
+                    lirc2broadlinkha.pulses_to_broadlink_hex(
+                        first[button].pairs() + repeat_frame * repeats))
+
+    def test_unsupported_protocol(self):
+        """Test that sections of unsupported protocols are skipped"""
+        config = lirc2broadlinkha.parse_lirc(
+                SAMPLE_CONF + SAMPLE_CONF.replace('RM-U306A', 'RCMM-REMOTE')
+                .replace('SPACE_ENC', 'RCMM').replace('SLEEP', 'OTHER'))
+        with self.assertLogs('lirc2broadlinkha', 'WARNING'):
+            mapping = lirc2broadlinkha.code_to_broadlink(config)
+        self.assertEqual(set(mapping), {'SLEEP', 'POWER', 'VOL+', 'VOL-'})
+
+RAW_CONF = """
+begin remote
+
+  name  RAW-REMOTE
+  eps            30
+  aeps          100
+  gap          40000
+
+      begin raw_codes
+          name POWER
+             9024    4512     564     564     564    1692
+              564
+          # A comment between codes
+          name MUTE
+             9024    4512     564    1692     564    1692
+      end raw_codes
+
+end remote
+"""
+
+class TestRawCodes(unittest.TestCase):
+    """Tests for remotes given as raw_codes blocks"""
+
+    def test_parse(self):
+        """
+        Test that raw codes are read into arrays of lengths, without any
+        unparsed lines, and the section is flagged as raw
+        """
+        with self.assertNoLogs('lirc2broadlinkha', 'DEBUG'):
+            config = lirc2broadlinkha.parse_lirc(RAW_CONF)
+        section = config['RAW-REMOTE']
+        self.assertEqual(section['flags'], 'RAW_CODES')
+        self.assertEqual(list(section['codes']['POWER']),
+                         [9024, 4512, 564, 564, 564, 1692, 564])
+        self.assertEqual(list(section['codes']['MUTE']),
+                         [9024, 4512, 564, 1692, 564, 1692])
+
+    def test_encode(self):
+        """
+        Test that raw codes come out of code_to_broadlink as their lengths
+        followed by the gap
+        """
+        mapping = lirc2broadlinkha.code_to_broadlink(
+                lirc2broadlinkha.parse_lirc(RAW_CONF))
+        power = lirc2broadlinkha.pulses_to_broadlink_hex(
+                [(9024, 4512), (564, 564), (564, 1692), (564, 40000)])
+        # A code ending on an off length has the gap added to it
+        mute = lirc2broadlinkha.pulses_to_broadlink_hex(
+                [(9024, 4512), (564, 1692), (564, 1692 + 40000)])
+        self.assertEqual(mapping, {
+            'POWER': base64.b64encode(power).decode('utf-8'),
+            'MUTE': base64.b64encode(mute).decode('utf-8'),
+            })
+
+    def test_const_length(self):
+        """Test that a CONST_LENGTH gap is counted from the start of the code"""
+        section = lirc2broadlinkha.parse_lirc(RAW_CONF.replace(
+                'eps', 'flags CONST_LENGTH\n  eps', 1))['RAW-REMOTE']
+        self.assertEqual(section['flags'], 'RAW_CODES|CONST_LENGTH')
+        pulses = lirc2broadlinkha.lirc_to_pulses(section)
+        self.assertEqual(pulses['POWER'][-1], (564, 40000 - 17484))
+
 class TestPulseToBroadlinkHexConversion(unittest.TestCase):
     """Tests for converting pulses to Broadlink valid hex"""
 
@@ -243,6 +672,28 @@ class TestPulseToBroadlinkHexConversion(unittest.TestCase):
         flat_list = [40, 40, 80, 40, 40, 40, 40, 3600]
         self.assertEqual(lirc2broadlinkha.flatten(pulses), flat_list)
 
+    def test_pulse_train_flatten(self):
+        """Tests that a pulse train flattens without copying"""
+        pulses = lirc2broadlinkha.PulseTrain.from_pairs(
+                [(40, 40), (80, 40), (40, 40), (40, 3600)])
+        self.assertIs(lirc2broadlinkha.flatten(pulses), pulses.data)
+        self.assertEqual(list(lirc2broadlinkha.flatten(pulses)),
+                         [40, 40, 80, 40, 40, 40, 40, 3600])
+
+    def test_pulse_train_tuple_view(self):
+        """Tests that a pulse train can still be used as a list of tuples"""
+        pairs = [(40, 40), (80, 40), (40, 3600)]
+        pulses = lirc2broadlinkha.PulseTrain.from_pairs(pairs)
+        self.assertEqual(pulses, pairs)
+        self.assertEqual(pulses.pairs(), pairs)
+        self.assertEqual(list(pulses), pairs)
+        self.assertEqual(len(pulses), 3)
+        self.assertEqual(pulses[-1], (40, 3600))
+        pulses[-1] = (40, 1800)
+        self.assertEqual(pulses[2], (40, 1800))
+        with self.assertRaises(IndexError):
+            pulses[3]
+
     def test_pulse_to_broadlink_hex_single_byte(self):
         """
         Tests that pulse that fits into single byte correctly converts to
@@ -278,6 +729,774 @@ class TestPulseToBroadlinkHexConversion(unittest.TestCase):
                 lirc2broadlinkha.pulses_to_broadlink_hex(pulses),
                 correct_broadlink_hex
                 )
+        self.assertEqual(
+                lirc2broadlinkha.pulses_to_broadlink_hex(
+                    lirc2broadlinkha.PulseTrain.from_pairs(pulses)),
+                correct_broadlink_hex
+                )
+
+class TestStreamingParser(unittest.TestCase):
+    """Tests for parsing lirc configs a line at a time"""
+
+    def test_sections_from_stream(self):
+        """
+        Test that sections of a concatenated, gzipped dump are yielded one at
+        a time and match parse_lirc
+        """
+        dump = (SAMPLE_CONF + SAMPLE_CONF.replace('RM-U306A', 'RM-OTHER'))
+        stream = gzip.GzipFile(fileobj=io.BytesIO(
+                gzip.compress(dump.replace('\n', '\r\n').encode('utf-8'))))
+        sections = lirc2broadlinkha.iter_lirc_sections(stream)
+        name, section = next(sections)
+        self.assertEqual(name, 'RM-U306A')
+        self.assertEqual(section, lirc2broadlinkha.parse_lirc(
+                SAMPLE_CONF)['RM-U306A'])
+        self.assertEqual([name for name, _ in sections], ['RM-OTHER'])
+
+class TestStreamingExport(unittest.TestCase):
+    """Tests for streaming (remote, button, code) records"""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for name in ['RM-U306A', 'RM-COPY']:
+            path = os.path.join(self.tempdir.name, f'{name}.lircd.conf')
+            with open(path, 'w') as conf_file:
+                conf_file.write(SAMPLE_CONF.replace('RM-U306A', name))
+            self.paths.append(path)
+        self.codes = lirc2broadlinkha.code_to_broadlink(
+                lirc2broadlinkha.parse_lirc(SAMPLE_CONF))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_records_are_lazy(self):
+        """Test that a remote is yielded before the next one is read"""
+        def lines():
+            yield from SAMPLE_CONF.split('\n')
+            raise AssertionError('Read past the first remote')
+        records = lirc2broadlinkha.iter_broadlink_codes(
+                lirc2broadlinkha.iter_lirc_sections(lines()))
+        self.assertEqual(next(records),
+                         ('RM-U306A', 'SLEEP', self.codes['SLEEP']))
+
+    def test_ndjson(self):
+        """Test that buttons with the same name in two remotes are kept"""
+        stream = io.StringIO()
+        written = export.write_ndjson(
+                export.iter_source_records(self.paths), stream)
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(written, 8)
+        self.assertEqual(
+                [(record['remote'], record['button']) for record in records[3:5]],
+                [('RM-U306A', 'VOL-'), ('RM-COPY', 'SLEEP')])
+        for record in records:
+            self.assertEqual(record['code'], self.codes[record['button']])
+
+    def test_csv_skips_failed_sources(self):
+        """Test csv output and that a missing file doesn't stop the export"""
+        failures = []
+        stream = io.StringIO()
+        export.write_csv(export.iter_source_records(
+                [self.paths[0], 'missing.lircd.conf', self.paths[1]],
+                lambda source, error: failures.append(source)), stream)
+        rows = list(csv.reader(io.StringIO(stream.getvalue())))
+        self.assertEqual(rows[0], ['remote', 'button', 'code'])
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(rows[8], ['RM-COPY', 'VOL-', self.codes['VOL-']])
+        self.assertEqual(failures, ['missing.lircd.conf'])
+
+
+def crash_chunk(chunk):
+    """Stands in for bulk_convert.convert_chunk in a worker that dies"""
+    os._exit(1)
+
+class TestBulkConversion(unittest.TestCase):
+    """Tests for converting a directory of lirc.conf files in parallel"""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tempdir.name, 'remotes')
+        self.outdir = os.path.join(self.tempdir.name, 'output')
+        os.makedirs(os.path.join(self.root, 'sony'))
+        with open(os.path.join(self.root, 'sony', 'RM-U306A.lircd.conf'),
+                  'w') as conf_file:
+            conf_file.write(SAMPLE_CONF)
+        # Missing the one timings, so there's no way to send a 1 bit and
+        # conversion will fail
+        with open(os.path.join(self.root, 'sony', 'BROKEN.lircd.conf'),
+                  'w') as conf_file:
+            conf_file.write(SAMPLE_CONF.replace('  one', '  #one'))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_bulk_conversion(self):
+        """
+        Test that a checkout converts to one file per remote and that a bad
+        file is reported without stopping the run
+        """
+        results = bulk_convert.bulk_convert(
+                [self.root], self.outdir, workers=2, chunksize=1,
+                progress=None)
+        errors = {os.path.basename(result.source): result.error
+                  for result in results}
+        self.assertIsNone(errors['RM-U306A.lircd.conf'])
+        self.assertIsNotNone(errors['BROKEN.lircd.conf'])
+
+        with open(os.path.join(self.outdir, 'sony', 'RM-U306A.json')) as out:
+            mapping = json.load(out)
+        self.assertEqual(
+                mapping,
+                {'RM-U306A': lirc2broadlinkha.code_to_broadlink(
+                    lirc2broadlinkha.parse_lirc(SAMPLE_CONF))}
+                )
+
+    def test_clashing_names(self):
+        """
+        Test that remotes in one file and files with the same name in
+        different directories are all kept
+        """
+        for directory in ('a', 'b'):
+            os.makedirs(os.path.join(self.tempdir.name, directory))
+            with open(os.path.join(self.tempdir.name, directory, 'lircd.conf'),
+                      'w') as conf_file:
+                conf_file.write(SAMPLE_CONF + SAMPLE_CONF.replace(
+                    'RM-U306A', f'RM-{directory.upper()}').replace(
+                        '0x0186', '0x0123'))
+        sources = [os.path.join(self.tempdir.name, directory, 'lircd.conf')
+                   for directory in ('a', 'b')]
+        results = bulk_convert.bulk_convert(
+                sources, self.outdir, workers=2, chunksize=1, progress=None)
+        self.assertEqual(sorted(os.path.basename(result.output)
+                                for result in results),
+                         ['lircd.json', 'lircd_2.json'])
+        remotes = dict(codedb.load_json_tree(self.outdir))
+        self.assertEqual(sorted(remotes),
+                         ['lircd/RM-A', 'lircd/RM-U306A',
+                          'lircd_2/RM-B', 'lircd_2/RM-U306A'])
+        self.assertNotEqual(remotes['lircd/RM-A']['SLEEP'],
+                            remotes['lircd/RM-U306A']['SLEEP'])
+
+    def test_crashed_worker(self):
+        """Test that a worker dying is reported rather than raised"""
+        convert_chunk = bulk_convert.convert_chunk
+        bulk_convert.convert_chunk = crash_chunk
+        try:
+            results = bulk_convert.bulk_convert(
+                    [self.root], self.outdir, workers=1, progress=None)
+        finally:
+            bulk_convert.convert_chunk = convert_chunk
+        self.assertEqual(len(results), 2)
+        for result in results:
+            self.assertTrue(result.error.startswith('BrokenProcessPool'))
+
+class TestCompaction(unittest.TestCase):
+    """Tests for shrinking Broadlink packets"""
+
+    def setUp(self):
+        self.codes = lirc2broadlinkha.code_to_broadlink(
+                lirc2broadlinkha.parse_lirc(SAMPLE_CONF))
+
+    def test_merge_zero_pulses(self):
+        """Test that empty pulses join their neighbours"""
+        self.assertEqual(compact.merge_zero_pulses([10, 5, 0, 7, 10, 300]),
+                         ([10, 12, 10, 300], 2))
+        self.assertEqual(compact.merge_zero_pulses([10, 5, 10, 0]),
+                         ([10, 5, 10], 1))
+
+    def test_snap_within_tolerance(self):
+        """Test that only pulses within tolerance of a single byte change"""
+        ticks = [270, 20, 20, 300, 20, 1000]
+        self.assertEqual(compact.snap_pulses(ticks, 0.1),
+                         ([255, 20, 20, 300, 20, 1000], 1))
+        # The final gap is only changed within tolerance too
+        self.assertEqual(compact.snap_pulses(ticks, 0), (ticks, 0))
+        self.assertEqual(compact.snap_pulses([20, 270], 0.1), ([20, 255], 1))
+
+    def test_fold_repeated_frames(self):
+        """Test that identical frames move into the repeat byte"""
+        packet = base64.b64decode(self.codes['POWER'])
+        ticks, repeats = lirc2broadlinkha.broadlink_hex_to_ticks(packet)
+        # A learned code with three copies of the frame and trailing padding
+        learned = lirc2broadlinkha.ticks_to_broadlink_hex(
+                list(ticks.data) * 3, 0) + bytes(12)
+        compacted, report = compact.compact_packet(learned, tolerance=0)
+        self.assertEqual(report.folded, 2)
+        self.assertEqual(report.after, len(compacted))
+        self.assertLess(report.after, report.before)
+        folded_ticks, folded_repeats = lirc2broadlinkha.broadlink_hex_to_ticks(
+                compacted)
+        self.assertEqual(folded_repeats, 2)
+        self.assertEqual(folded_ticks, ticks)
+
+    def test_empty_packet(self):
+        """Test that a packet without any pulses is left as it is"""
+        self.assertEqual(compact.fold_repeats([], 0, 0.1), ([], 0, 0))
+        packet = b'&\x00\x00\x00'
+        compacted, report = compact.compact_packet(packet)
+        self.assertEqual(compacted, packet)
+        self.assertEqual(report.before, report.after)
+
+    def test_mapping_never_grows(self):
+        """Test that codes that can't be shrunk are left as they are"""
+        compacted, report = compact.compact_mapping(self.codes)
+        self.assertEqual(compacted, self.codes)
+        self.assertEqual(report.before, report.after)
+
+
+class TestCodeDatabase(unittest.TestCase):
+    """Tests for the memory mapped code database"""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'codes.db')
+        self.codes = lirc2broadlinkha.code_to_broadlink(
+                lirc2broadlinkha.parse_lirc(SAMPLE_CONF))
+        # Same button names in two remotes must not collide
+        self.remotes = {
+            'sony/RM-U306A': self.codes,
+            'sony/RM-OTHER': {'SLEEP': self.codes['POWER']}
+            }
+        codedb.build_code_db(self.remotes, self.path)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_lookup(self):
+        """Test that every code can be looked up by remote and button"""
+        with codedb.CodeDatabase(self.path) as database:
+            self.assertEqual(len(database), 5)
+            for remote, codes in self.remotes.items():
+                for button, code in codes.items():
+                    self.assertEqual(database.get_b64(remote, button), code)
+            self.assertIsNone(database.get('sony/RM-OTHER', 'POWER'))
+            self.assertNotIn(('missing', 'SLEEP'), database)
+            self.assertEqual(
+                    set(database),
+                    {(remote, button) for remote, codes in self.remotes.items()
+                     for button in codes})
+
+class TestBenchmarks(unittest.TestCase):
+    """Tests for the benchmark suite's generator and regression check"""
+
+    def test_generated_conf(self):
+        """Test that generated configs parse and convert"""
+        config = lirc2broadlinkha.parse_lirc(benchmarks.generate_conf(4, 6))
+        self.assertEqual(len(config), 4)
+        for section in config.values():
+            self.assertEqual(len(section['codes']), 6)
+        self.assertEqual(
+                len(lirc2broadlinkha.code_to_broadlink(config)), 6)
+
+    def test_compare_results(self):
+        """Test that only stages slower than the threshold are reported"""
+        baseline = {'stages': {'fast': {'median': 1.0},
+                               'slow': {'median': 1.0}}}
+        results = {'stages': {'fast': {'median': 1.1},
+                              'slow': {'median': 2.0},
+                              'new': {'median': 1.0}}}
+        regressions = benchmarks.compare_results(results, baseline, 1.25)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('slow'))
+
+class TestFuzzing(unittest.TestCase):
+    """Tests for the differential fuzzer of the encoders"""
+
+    def test_engines_agree(self):
+        """Test that every engine matches the reference on generated remotes"""
+        results = fuzz.run_fuzz(cases=40, buttons=4)
+        self.assertEqual(results['failures'], [])
+        self.assertEqual(set(results['engines']), set(fuzz.default_engines()))
+        for engine in results['engines'].values():
+            self.assertGreater(engine['speedup'], 0)
+
+    def test_shrink(self):
+        """Test that a disagreement is shrunk to a small remote that shows it"""
+        section_engine = fuzz.default_engines()['section']
+
+        def broken(config, repeats):
+            # Drops the last byte of codes with a ptrail
+            encode = section_engine(config, repeats)
+            if 'ptrail' in config:
+                return lambda codes: {button: packet[:-1]
+                                      for button, packet in encode(codes).items()}
+            return encode
+
+        results = fuzz.run_fuzz(cases=30, buttons=4, engines={'broken': broken})
+        self.assertGreater(results['engines']['broken']['mismatches'], 0)
+        self.assertEqual(len(results['failures']), 1)
+        conf = results['failures'][0]['conf']
+        self.assertIn('ptrail', conf)
+        self.assertIn('bits  1\n', conf)
+        self.assertIn('min_repeat  0', conf)
+        self.assertNotIn('CONST_LENGTH', conf)
+        self.assertNotIn('post_data', conf)
+        self.assertEqual(conf.count('KEY_'), 1)
+
+class TestScriptEmission(unittest.TestCase):
+    """Tests that every emitter writes the same Home Assistant scripts"""
+
+    def setUp(self):
+        self.mapping = lirc2broadlinkha.code_to_broadlink(
+                lirc2broadlinkha.parse_lirc(SAMPLE_CONF))
+        # Names that need quoting in yaml
+        self.mapping['0'] = self.mapping['SLEEP']
+        self.mapping['KEY: "#1"'] = self.mapping['POWER']
+        # What main used to write, one dump per button
+        self.expected = yaml.safe_load('\n'.join(
+                yaml.dump(create_ha_script.create_script(
+                    button, code, 'remote.test'))
+                for button, code in self.mapping.items()))
+
+    def test_emitters(self):
+        """Test that the yaml and template emitters match the old output"""
+        scripts = create_ha_script.create_scripts(self.mapping, 'remote.test')
+        for emitter in create_ha_script.EMITTERS.values():
+            stream = io.StringIO()
+            emitter(scripts, stream)
+            self.assertEqual(yaml.safe_load(stream.getvalue()), self.expected)
+
+class TestHomeAssistantPackages(unittest.TestCase):
+    """Tests for writing one Home Assistant package per remote"""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tempdir.name, 'remotes.lircd.conf')
+        self.outdir = os.path.join(self.tempdir.name, 'packages')
+        # Two remotes with the same button names
+        with open(self.source, 'w') as conf_file:
+            conf_file.write(SAMPLE_CONF + SAMPLE_CONF.replace(
+                    'RM-U306A', 'RM.OTHER').replace('0x0186', '0x0123'))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def load(self, name):
+        with open(os.path.join(self.outdir, name)) as package_file:
+            return yaml.safe_load(package_file)
+
+    def test_packages(self):
+        """
+        Test that each remote gets its own package, with script names
+        prefixed by the remote, from either emitter and from worker processes
+        """
+        sections = lirc2broadlinkha.parse_lirc(SAMPLE_CONF)
+        expected = create_ha_script.create_scripts(
+                lirc2broadlinkha.code_to_broadlink(sections), 'remote.test',
+                'RM-U306A')
+        for emitter, workers in [('yaml', 1), ('template', 2)]:
+            results = create_ha_script.write_packages(
+                    [self.source], 'remote.test', self.outdir, emitter,
+                    workers, chunksize=1)
+            self.assertEqual([result.remote for result in results],
+                             ['RM-U306A', 'RM.OTHER'])
+            self.assertEqual(self.load('rm_u306a.yaml'), {'script': expected})
+            other = self.load('rm_other.yaml')['script']
+            self.assertEqual(other['rm_other_sleep']['alias'], 'RM.OTHER SLEEP')
+            self.assertNotEqual(
+                    other['rm_other_sleep']['sequence'],
+                    expected['rm_u306a_sleep']['sequence'])
+
+    def test_unchanged_packages(self):
+        """Test that packages are only rewritten when their content changes"""
+        create_ha_script.write_packages(
+                [self.source], 'remote.test', self.outdir, workers=1)
+        path = os.path.join(self.outdir, 'rm_u306a.yaml')
+        os.utime(path, (0, 0))
+        results = create_ha_script.write_packages(
+                [self.source], 'remote.test', self.outdir, workers=1)
+        self.assertEqual([result.changed for result in results], [False, False])
+        self.assertEqual(os.stat(path).st_mtime, 0)
+        results = create_ha_script.write_packages(
+                [self.source], 'remote.other', self.outdir, workers=1)
+        self.assertEqual([result.changed for result in results], [True, True])
+        self.assertEqual(os.listdir(self.outdir).count('rm_u306a.yaml'), 1)
+        self.assertFalse([name for name in os.listdir(self.outdir)
+                          if name.endswith('.tmp')])
+
+    def test_clashing_names(self):
+        """Test that numbered duplicates don't take a real remote's package"""
+        other = os.path.join(self.tempdir.name, 'other.lircd.conf')
+        with open(other, 'w') as conf_file:
+            conf_file.write(SAMPLE_CONF.replace('RM-U306A', 'RM-U306A_2'))
+        results = create_ha_script.write_packages(
+                [self.source, self.source, other], 'remote.test', self.outdir,
+                workers=1)
+        self.assertEqual([result.remote for result in results],
+                         ['RM-U306A', 'RM.OTHER', 'RM-U306A_2', 'RM.OTHER_2',
+                          'RM-U306A_2_2'])
+        self.assertEqual(len({result.path for result in results}), 5)
+        self.assertEqual(len(os.listdir(self.outdir)), 5)
+
+class TestAtomicWrite(unittest.TestCase):
+    """Tests for replacing files atomically"""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'file.txt')
+        with open(self.path, 'w') as old_file:
+            old_file.write('old')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_replace(self):
+        """Test that the file is only replaced once the write finishes"""
+        with atomic.atomic_write(self.path) as new_file:
+            new_file.write('new')
+            with open(self.path) as old_file:
+                self.assertEqual(old_file.read(), 'old')
+        with open(self.path) as new_file:
+            self.assertEqual(new_file.read(), 'new')
+        self.assertEqual(os.listdir(self.tempdir.name), ['file.txt'])
+
+    def test_failed_write(self):
+        """Test that a failed write leaves the old file and no temporary one"""
+        with self.assertRaises(ValueError):
+            with atomic.atomic_write(self.path, 'wb') as new_file:
+                new_file.write(b'half')
+                raise ValueError('failed part way')
+        with open(self.path) as old_file:
+            self.assertEqual(old_file.read(), 'old')
+        self.assertEqual(os.listdir(self.tempdir.name), ['file.txt'])
+
+class TestIncrementalManifest(unittest.TestCase):
+    """Tests that only changed remote sections are re-encoded"""
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'manifest.json')
+        self.text = SAMPLE_CONF + SAMPLE_CONF.replace('RM-U306A', 'RM-OTHER')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def convert(self, text):
+        """Converts text with a freshly loaded manifest"""
+        run = manifest.Manifest(self.path)
+        codes = run.convert('remotes.conf', text)
+        run.save()
+        self.assertEqual(codes, lirc2broadlinkha.code_to_broadlink(
+                lirc2broadlinkha.parse_lirc(text)))
+        return run
+
+    def test_incremental_conversion(self):
+        """Test that unchanged inputs and sections are reused"""
+        first = self.convert(self.text)
+        self.assertEqual((first.encoded_sections, first.reused_sections),
+                         (2, 0))
+        unchanged = self.convert(self.text)
+        self.assertEqual((unchanged.encoded_sections,
+                          unchanged.reused_sections), (0, 2))
+        # Change a code in the second remote only
+        changed = self.convert(self.text[:-200] + self.text[-200:].replace(
+                '0x2486', '0x2487'))
+        self.assertEqual((changed.encoded_sections, changed.reused_sections),
+                         (1, 1))
+        entry = changed.inputs['remotes.conf']['sections']['RM-OTHER']
+        self.assertIn('vol_plus', entry['scripts'])
+
+    def test_raw_codes(self):
+        """Test that remotes with raw codes are hashed and reused too"""
+        self.convert(RAW_CONF)
+        self.assertEqual(self.convert(RAW_CONF).reused_sections, 1)
+
+class TestInstrumentation(unittest.TestCase):
+    """Tests for the opt-in profiling hooks"""
+
+    def test_profile(self):
+        """
+        Test that stages, counters and unparsed lines are recorded and passed
+        to the callback
+        """
+        records = []
+        text = SAMPLE_CONF.replace('  eps', '  eps 30 extra')
+        with instrumentation.profile(records.append) as profiler:
+            config = lirc2broadlinkha.parse_lirc(text)
+            lirc2broadlinkha.code_to_broadlink(copy.deepcopy(config))
+            for pulses in lirc2broadlinkha.lirc_to_pulses(
+                    config['RM-U306A']).values():
+                lirc2broadlinkha.pulses_to_broadlink_hex(pulses)
+        report = profiler.report()
+        self.assertEqual(
+                set(report['stages']),
+                {'parse_lirc', 'code_to_broadlink', 'lirc_to_pulses',
+                 'pulses_to_broadlink_hex'})
+        self.assertIn('code_to_broadlink', report['remotes']['RM-U306A'])
+        # Each button is counted by both paths, with 2 multi-byte gaps each
+        self.assertEqual(report['counters']['sections'], 1)
+        self.assertEqual(report['counters']['buttons'], 8)
+        self.assertEqual(report['counters']['pulses'], 8 * 32)
+        self.assertEqual(report['counters']['multi_byte_pulses'], 8)
+        self.assertEqual(report['counters']['unparsed_line'], 1)
+        self.assertEqual(report['events'][0]['remote'], 'RM-U306A')
+        self.assertIn(report['events'][0], records)
+        self.assertEqual(json.loads(json.dumps(report)), report)
+
+    def test_disabled(self):
+        """Test that nothing is recorded outside of a profile block"""
+        with instrumentation.profile() as profiler:
+            pass
+        lirc2broadlinkha.parse_lirc(SAMPLE_CONF)
+        self.assertEqual(profiler.report()['stages'], {})
+
+class TestConversionService(unittest.TestCase):
+    """Tests for the long-running conversion service"""
+
+    def setUp(self):
+        self.service = service.ConversionService(max_entries=1)
+        self.expected = lirc2broadlinkha.code_to_broadlink(
+                lirc2broadlinkha.parse_lirc(SAMPLE_CONF))
+
+    def test_cache(self):
+        """Test that repeat requests are served from the cache"""
+        self.assertEqual(self.service.mapping(text=SAMPLE_CONF), self.expected)
+        self.assertEqual(self.service.mapping(text=SAMPLE_CONF), self.expected)
+        metrics = self.service.metrics()
+        self.assertEqual(metrics['mappings']['hits'], 1)
+        self.assertEqual(metrics['mappings']['misses'], 1)
+        # Storing the resolved text isn't a lookup
+        self.assertEqual(metrics['texts']['misses'], 0)
+        # A second remote evicts the first from the size 1 caches
+        self.service.mapping(text=SAMPLE_CONF.replace('0x0186', '0x0187'))
+        self.assertEqual(self.service.metrics()['mappings']['evictions'], 1)
+
+    def test_concurrent_request_count(self):
+        """Test that requests from many threads are all counted"""
+        def request():
+            for _ in range(200):
+                self.service.mapping(text=SAMPLE_CONF)
+        threads = [threading.Thread(target=request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.service.metrics()['requests'], 1600)
+
+    def test_http(self):
+        """Test the json and yaml endpoints over localhost HTTP"""
+        server = service.ServiceHTTPServer(('127.0.0.1', 0), self.service)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_port}'
+        try:
+            mapping = requests.post(f'{url}/mapping',
+                                    json={'text': SAMPLE_CONF}, timeout=5)
+            self.assertEqual(mapping.json(), self.expected)
+            scripts = requests.post(
+                    f'{url}/scripts',
+                    json={'text': SAMPLE_CONF, 'entity': 'receiver'}, timeout=5)
+            self.assertEqual(
+                    yaml.safe_load(scripts.text),
+                    create_ha_script.create_scripts(
+                        self.expected, 'remote.receiver'))
+            error = requests.post(f'{url}/mapping', json={}, timeout=5)
+            self.assertEqual(error.status_code, 400)
+            metrics = requests.get(f'{url}/metrics', timeout=5).json()
+            self.assertEqual(metrics['requests'], 3)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class TestFingerprintIndex(unittest.TestCase):
+    """Tests for decoding Broadlink codes and looking up learned codes"""
+
+    def setUp(self):
+        nec_conf = SAMPLE_CONF.replace('RM-U306A', 'NEC').replace(
+                'bits           14', 'bits           32').replace(
+                'header       2437   553', 'header       9000  4500').replace(
+                'one          1237   553', 'one           560  1690').replace(
+                'zero          637   553', 'zero          560   560').replace(
+                'gap          44822', 'gap          108000').replace(
+                '0x0186', '0x20DF10EF').replace('0x2A06', '0x20DF40BF')
+        self.remotes = {
+            name: lirc2broadlinkha.code_to_broadlink(
+                lirc2broadlinkha.parse_lirc(conf))
+            for name, conf in [('sony', SAMPLE_CONF), ('nec', nec_conf)]
+            }
+        self.index = fingerprint.FingerprintIndex()
+        self.index.add_remotes(self.remotes.items())
+
+    def test_decode(self):
+        """Test that decoding reverses pulses_to_broadlink_hex"""
+        pulses = [(2400, 600), (1200, 600), (600, 600), (600, 21600)]
+        packet = lirc2broadlinkha.pulses_to_broadlink_hex(pulses, 3)
+        ticks, repeats = lirc2broadlinkha.broadlink_hex_to_ticks(packet)
+        self.assertEqual(repeats, 3)
+        self.assertEqual(ticks, [(78, 19), (39, 19), (19, 19), (19, 709)])
+        decoded, _ = lirc2broadlinkha.broadlink_hex_to_pulses(packet)
+        for (on, off), (decoded_on, decoded_off) in zip(pulses, decoded):
+            self.assertLess(abs(on - decoded_on), 31)
+            self.assertLess(abs(off - decoded_off), 31)
+
+    def test_exact_lookup(self):
+        """Test that every generated code finds its own remote and button"""
+        for remote, codes in self.remotes.items():
+            for button, code in codes.items():
+                self.assertEqual(self.index.lookup(code)[0], (remote, button))
+
+    def test_learned_lookup(self):
+        """
+        Test that a learned code, with jittered timings, no repeat byte,
+        several frames and padding, is found
+        """
+        for remote, codes in self.remotes.items():
+            for number, (button, code) in enumerate(codes.items()):
+                ticks, _ = lirc2broadlinkha.broadlink_hex_to_ticks(
+                        fingerprint.to_packet(code))
+                jitter = [1.05, 0.95, 1.0, 0.97, 1.03][number % 5]
+                microseconds = [int(tick * 8192 / 269 * jitter)
+                                for tick in ticks.data]
+                learned = lirc2broadlinkha.pulses_to_broadlink_hex(
+                        lirc2broadlinkha.PulseTrain(microseconds * 3))
+                learned = bytes(learned) + bytes([0x0d, 0x05])
+                self.assertEqual(self.index.lookup(learned)[0],
+                                 (remote, button))
+
+    def test_unknown_code(self):
+        """Test that a code that isn't in the catalogue isn't matched"""
+        unknown = lirc2broadlinkha.pulses_to_broadlink_hex(
+                [(2400, 600)] + [(1200, 600)] * 14 + [(600, 30000)])
+        self.assertEqual(self.index.lookup(unknown), [])
+
+
+@unittest.skipIf(sender.Cipher is None, 'cryptography is not installed')
+class TestSender(unittest.TestCase):
+    """Tests for sending codes to a stand-in Broadlink device"""
+
+    def setUp(self):
+        self.device = sender.FakeDevice()
+        self.sender = sender.Sender(timeout=1, port=self.device.address[1])
+        self.codes = lirc2broadlinkha.code_to_broadlink(
+                lirc2broadlinkha.parse_lirc(SAMPLE_CONF))
+
+    def tearDown(self):
+        self.sender.close()
+        self.device.close()
+
+    def test_sequence_over_one_session(self):
+        """Test that every code arrives intact and the device is authenticated once"""
+        host = self.device.address[0]
+        buttons = ['POWER', 'VOL+', 'VOL+', 'VOL-']
+        self.sender.send_buttons(host, 'aa:bb:cc:dd:ee:ff', self.codes, buttons)
+        self.sender.send(host, 'aa:bb:cc:dd:ee:ff', [self.codes['SLEEP']],
+                         window=4)
+        self.assertEqual(self.device.authentications, 1)
+        self.assertEqual(
+                [packet for _, packet in self.device.received],
+                [base64.b64decode(self.codes[button])
+                 for button in buttons + ['SLEEP']])
+
+    def test_session_per_device(self):
+        """Test that a different mac or RM4 layout gets its own session"""
+        host = self.device.address[0]
+        first = self.sender.session(host, 'aa:bb:cc:dd:ee:ff')
+        self.assertIs(self.sender.session(host, 'AABBCCDDEEFF'), first)
+        other_mac = self.sender.session(host, '11:22:33:44:55:66')
+        rm4 = self.sender.session(host, 'aa:bb:cc:dd:ee:ff', rm4=True)
+        self.assertIsNot(other_mac, first)
+        self.assertEqual(other_mac.mac, bytes.fromhex('112233445566'))
+        self.assertIsNot(rm4, first)
+        self.assertTrue(rm4.rm4)
+
+    def test_rm4_buttons(self):
+        """Test that buttons can be sent to an RM4"""
+        device = sender.FakeDevice(rm4=True)
+        self.addCleanup(device.close)
+        rm4_sender = sender.Sender(timeout=1, port=device.address[1])
+        self.addCleanup(rm4_sender.close)
+        rm4_sender.send_buttons(device.address[0], 'aabbccddeeff', self.codes,
+                                ['POWER', 'SLEEP'], rm4=True)
+        self.assertEqual(
+                [packet for _, packet in device.received],
+                [base64.b64decode(self.codes[button])
+                 for button in ('POWER', 'SLEEP')])
+
+    def test_gap_and_window(self):
+        """Test that commands are spaced by the gap, even when pipelined"""
+        self.sender.send(self.device.address[0], 'aabbccddeeff',
+                         list(self.codes.values()), gap=0.05, window=3)
+        arrivals = [arrival for arrival, _ in self.device.received]
+        self.assertEqual(len(arrivals), 4)
+        for first, second in zip(arrivals, arrivals[1:]):
+            self.assertGreaterEqual(second - first, 0.04)
+
+    def test_no_device(self):
+        """Test that a device that doesn't answer raises an error"""
+        self.device.close()
+        self.sender.timeout = 0.2
+        with self.assertRaises(sender.BroadlinkError):
+            self.sender.send(self.device.address[0], 'aabbccddeeff',
+                             [self.codes['POWER']])
+
+
+class TestCommandLine(unittest.TestCase):
+    """Tests for the single command line entry point"""
+
+    # Most time the command line may add to starting the interpreter, for
+    # converting a local file
+    STARTUP_BUDGET = 0.15
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.conf_path = os.path.join(self.tempdir.name, 'sony.lircd.conf')
+        with open(self.conf_path, 'w') as conf_file:
+            conf_file.write(SAMPLE_CONF)
+        self.expected = lirc2broadlinkha.code_to_broadlink(
+                lirc2broadlinkha.parse_lirc(SAMPLE_CONF))
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def run_cli(self, *arguments, stdin=None):
+        return subprocess.run(
+                [sys.executable, 'cli.py', *arguments], input=stdin,
+                capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def test_codes_from_file_and_stdin(self):
+        """Test that local files and stdin convert without a url"""
+        from_file = self.run_cli('codes', self.conf_path)
+        self.assertEqual(json.loads(from_file.stdout), self.expected)
+        from_stdin = self.run_cli('codes', '-', stdin=SAMPLE_CONF)
+        self.assertEqual(json.loads(from_stdin.stdout), self.expected)
+
+    def test_scripts(self):
+        """Test that both emitters write the scripts for a local file"""
+        outfile = os.path.join(self.tempdir.name, 'scripts.yaml')
+        cli.main(['scripts', self.conf_path, 'tv', outfile])
+        with open(outfile) as yaml_file:
+            scripts = yaml.safe_load(yaml_file)
+        self.assertEqual(
+                scripts['vol_plus']['sequence'][0]['target']['entity_id'],
+                'remote.tv')
+        templated = self.run_cli('scripts', self.conf_path, 'tv', '--template')
+        self.assertEqual(yaml.safe_load(templated.stdout), scripts)
+
+    def test_lazy_imports(self):
+        """Test that requests, yaml and NumPy aren't imported for local json"""
+        check = ('import sys, cli; cli.main(sys.argv[1:]); '
+                 'print([name for name in ("requests", "yaml", "numpy") '
+                 'if name in sys.modules], file=sys.stderr)')
+        result = subprocess.run(
+                [sys.executable, '-c', check, 'codes', self.conf_path],
+                capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.stderr.strip(), '[]')
+
+    def test_startup_budget(self):
+        """Test that converting a local file starts within the budget"""
+        def fastest(command):
+            timings = []
+            for _ in range(3):
+                start = time.perf_counter()
+                subprocess.run(command, stdout=subprocess.DEVNULL, check=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+                timings.append(time.perf_counter() - start)
+            return min(timings)
+        interpreter = fastest([sys.executable, '-c', 'pass'])
+        conversion = fastest([sys.executable, 'cli.py', 'codes', self.conf_path])
+        self.assertLess(conversion - interpreter, self.STARTUP_BUDGET)
 
 
 if __name__ == '__main__':